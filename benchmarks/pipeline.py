@@ -0,0 +1,445 @@
+"""Measures the throughput of the whole pipeline, from the Twitter stream to
+Tumblr, without touching the network.
+
+A local fake stream server sends synthetic tweets (single tweets and threads
+of replies) at a steady rate. They are read the same way tweepy reads the real
+stream and handed to a TwitterListener. The posts end up at a local fake Tumblr
+API, threads are fetched from a fake Twitter client with the same data, and
+screenshots come from a stub renderer that only waits and returns an image.
+Everything else (the queue, database, pipeline, templates and image
+processing) is the real thing, wired up like `main.run`.
+
+    python -m benchmarks.pipeline [--tweets N] [--rate PER_SECOND] [--thread-length N] ...
+
+Reports posts per second, the latency from the stream sending a tweet to Tumblr
+receiving its post (p50, p99 and max), how far the queue backed up, how long
+every stage took on average, and the peak RSS of the process, which includes
+the fake servers. `benchmarks.replay` runs the same pipeline on recorded traffic.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import re
+import resource
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter, sleep, time
+from typing import Any, Awaitable, Callable, Optional, Union
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+from tweepy import Response, Tweet, User
+
+from hopperbot.config import RoutingIndex
+from hopperbot.context import app
+from hopperbot.images import ImageProcessor
+from hopperbot.metrics import STAGE_SECONDS
+from hopperbot.people import THEY, Person
+from hopperbot.pipeline import PostPipeline
+from hopperbot.ratelimit import LIMITS, limiter
+from hopperbot.tracing import percentile
+from hopperbot.tumblr_client import TumblrApi
+from hopperbot.twitter import TwitterListener
+from hopperbot.twitter_update import TwitterUpdate
+from hopperbot.work_queue import DurableQueue, WorkQueue
+
+# The first synthetic tweet id, and the first user id
+FIRST_TWEET_ID = 1_600_000_000_000_000_000
+FIRST_USER_ID = 1000
+
+# Every post links to the tweet it is about, that is how the fake Tumblr knows which tweet a post is for
+STATUS_ID = re.compile(r"/status/(\d+)")
+
+# Seconds between looking how far the queue backed up
+SAMPLE_INTERVAL = 0.1
+
+
+def screenshot(height: int = 300) -> bytes:
+    """A screenshot sized like a rendered tweet, with some detail so it does not compress to nothing"""
+    image = Image.new("RGB", (598, height), "white")
+    for y in range(20, height - 20, 24):
+        image.paste((15, 20, 25), (16, y, 16 + (y * 7) % 560, y + 14))
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+class SyntheticTwitter:
+    """Makes up accounts that post threads of `thread_length` tweets, one
+    account after the other. Also answers the thread fetches of the resolver,
+    like the API would, after waiting `latency` seconds."""
+
+    def __init__(self, accounts: int, thread_length: int, latency: float = 0.0) -> None:
+        self.thread_length = thread_length
+        self.latency = latency
+        self.session = None
+        self.users = [
+            {
+                "id": str(FIRST_USER_ID + index),
+                "name": f"Account {index}",
+                "username": f"account{index}",
+                "profile_image_url": f"https://pbs.twimg.com/profile_images/{index}/avatar_normal.png",
+                "verified": False,
+            }
+            for index in range(accounts)
+        ]
+        self.tweets: dict[int, dict[str, Any]] = {}
+        # The last tweet of every account, and how long its current thread is
+        self.threads: dict[int, tuple[int, int]] = {}
+        self.next_id = FIRST_TWEET_ID
+        self.requests = 0
+
+    def user(self, user_id: Union[int, str]) -> dict[str, Any]:
+        return self.users[int(user_id) - FIRST_USER_ID]
+
+    def payload(self, index: int) -> dict[str, Any]:
+        """The stream payload of the `index`th tweet"""
+        account = index % len(self.users)
+        user = self.users[account]
+        tweet_id = self.next_id
+        self.next_id += 1
+
+        tweet = {
+            "id": str(tweet_id),
+            "text": f"Synthetic tweet {index} by @{user['username']}, long enough to wrap in the template",
+            "author_id": user["id"],
+            "conversation_id": str(tweet_id),
+            "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "edit_history_tweet_ids": [str(tweet_id)],
+        }
+        includes: dict[str, Any] = {"users": [user]}
+
+        (parent_id, length) = self.threads.get(account, (0, self.thread_length))
+        if length < self.thread_length:
+            parent = self.tweets[parent_id]
+            tweet["conversation_id"] = parent["conversation_id"]
+            tweet["in_reply_to_user_id"] = user["id"]
+            tweet["referenced_tweets"] = [{"type": "replied_to", "id": parent["id"]}]
+            includes["tweets"] = [parent]
+            self.threads[account] = (tweet_id, length + 1)
+        else:
+            self.threads[account] = (tweet_id, 1)
+
+        self.tweets[tweet_id] = tweet
+        return {"data": tweet, "includes": includes, "matching_rules": [{"id": "1", "tag": "hopperbot"}]}
+
+    def response(self, tweets: list[dict[str, Any]]) -> Response:
+        users = [User(self.user(tweet["author_id"])) for tweet in tweets]
+        return Response([Tweet(tweet) for tweet in tweets], {"users": users}, [], {})
+
+    async def get_tweets(self, ids: list[int], **params: Any) -> Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return self.response([self.tweets[int(id)] for id in ids if int(id) in self.tweets])
+
+    async def search_recent_tweets(self, query: str, **params: Any) -> Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        conversation_id = query.removeprefix("conversation_id:")
+        return self.response([tweet for tweet in self.tweets.values() if tweet["conversation_id"] == conversation_id])
+
+
+class FakeStream:
+    """Serves the synthetic tweets as a filtered stream, `rate` tweets per
+    second (or as fast as possible if `rate` is 0), remembering when every
+    tweet was sent"""
+
+    def __init__(self, twitter: SyntheticTwitter, tweets: int, rate: float) -> None:
+        self.twitter = twitter
+        self.tweets = tweets
+        self.rate = rate
+        self.sent: dict[int, float] = {}
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+
+        started = perf_counter()
+        for index in range(self.tweets):
+            if self.rate > 0:
+                await asyncio.sleep(max(0.0, started + index / self.rate - perf_counter()))
+            payload = self.twitter.payload(index)
+            self.sent[int(payload["data"]["id"])] = time()
+            await response.write(json.dumps(payload).encode() + b"\r\n")
+            if self.rate <= 0 and index % 64 == 0:
+                await asyncio.sleep(0)
+
+        # Keep alive signals are empty lines
+        await response.write(b"\r\n")
+        await response.write_eof()
+        return response
+
+
+class FakeTumblr:
+    """Accepts posts and reblogs after waiting `latency` seconds, and measures
+    how long after it was sent (a time in `sent`) the tweet of a post arrived"""
+
+    def __init__(self, sent: dict[int, float], expected: int, latency: float = 0.0) -> None:
+        self.sent = sent
+        self.expected = expected
+        self.latency = latency
+        self.next_id = 1
+        self.latencies: list[float] = []
+        self.posted = asyncio.Event()
+
+    async def create(self, request: web.Request) -> web.Response:
+        if request.content_type == "multipart/form-data":
+            body = ""
+            async for part in await request.multipart():
+                contents = await part.read()  # type: ignore[union-attr]
+                if part.name == "json":  # type: ignore[union-attr]
+                    body = contents.decode()
+        else:
+            body = await request.text()
+        await asyncio.sleep(self.latency)
+
+        # The newest tweet in a post is the one it was made for
+        ids = [int(id) for id in STATUS_ID.findall(body) if int(id) in self.sent]
+        if ids:
+            self.latencies.append(time() - self.sent[max(ids)])
+        if len(self.latencies) >= self.expected:
+            self.posted.set()
+
+        post_id = self.next_id
+        self.next_id += 1
+        response = {"meta": {"status": 201, "msg": "Created"}, "response": {"id": str(post_id), "state": "published"}}
+        return web.json_response(response)
+
+    async def get(self, request: web.Request) -> web.Response:
+        blogname = request.match_info["blog"].removesuffix(".tumblr.com")
+        post = {"id": request.query["id"], "reblog_key": "key", "blog": {"name": blogname, "uuid": f"t:{blogname}"}}
+        return web.json_response({"meta": {"status": 200, "msg": "OK"}, "response": {"posts": [post]}})
+
+
+class StubRenderer:
+    """Stands in for a Chrome renderer: every render waits `render_time`
+    seconds (blocking, like selenium) and returns one screenshot per tweet"""
+
+    render_time = 0.05
+
+    def __init__(self) -> None:
+        self.renders = 0
+        self.wait_time = 0.0
+        self.time_saved = 0.0
+        self.image = screenshot()
+
+    def is_healthy(self) -> bool:
+        return True
+
+    def quit(self) -> None:
+        pass
+
+    def render(self, count: int) -> list[bytes]:
+        sleep(self.render_time)
+        return [self.image] * count
+
+    def render_tweets(self, url: str, thread_range: Optional[range]) -> list[bytes]:
+        return self.render(len(thread_range) if thread_range is not None else 1)
+
+    def render_statuses(self, urls: list[str]) -> list[bytes]:
+        return self.render(len(urls))
+
+    def render_html(self, page: str) -> list[bytes]:
+        return self.render(page.count("<article "))
+
+
+async def start_server(routes: list[web.RouteDef]) -> tuple[web.AppRunner, str]:
+    server = web.Application()
+    server.add_routes(routes)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", 0).start()
+    return (runner, f"http://localhost:{runner.addresses[0][1]}")
+
+
+async def read_stream(listener: TwitterListener, url: str) -> None:
+    """Reads the stream line by line and hands every tweet to the listener, like tweepy does"""
+    async with aiohttp.ClientSession() as session, session.get(url) as response:
+        async for line in response.content:
+            line = line.strip()
+            if line:
+                await listener.on_data(line)
+            else:
+                await listener.on_keep_alive()
+
+
+async def queue_depth(queue: WorkQueue) -> int:
+    if isinstance(queue, DurableQueue):
+        (jobs, _) = await queue.database.count_jobs()
+        return jobs
+    return queue.qsize()
+
+
+async def run_pipeline(
+    args: argparse.Namespace,
+    workdir: str,
+    twitter_api: Any,
+    users: list[dict[str, Any]],
+    routes: dict[str, str],
+    feed: Callable[[TwitterListener], Awaitable[None]],
+    sent: dict[int, float],
+    expected: int,
+) -> dict[str, Any]:
+    """Wires up the pipeline like `main.run`, with the fake Tumblr API, the stub
+    renderer and `twitter_api` to fetch threads with. `feed` hands the tweets
+    to the listener, recording when it sent them in `sent`. Returns the results
+    once `expected` posts arrived, or after `args.timeout` seconds"""
+    tumblr = FakeTumblr(sent, expected, args.tumblr_latency)
+    StubRenderer.render_time = args.render_time
+
+    # The real limits would make a benchmark take days, only the scheduling is measured
+    limiter.limits = {endpoint: (1_000_000_000, 1.0) for endpoint in LIMITS}
+    limiter.buckets.clear()
+
+    app.configure(
+        database_filename=f"{workdir}/benchmark.db",
+        renderer_pool_size=args.renderers,
+        renderer_factory=StubRenderer,
+        twitter_api=twitter_api,
+    )
+    for user in users:
+        await app.database.add_person(int(user["id"]), Person(user["name"], [THEY]))
+
+    (tumblr_runner, tumblr_url) = await start_server(
+        [web.post("/v2/blog/{blog}/posts", tumblr.create), web.get("/v2/blog/{blog}/posts", tumblr.get)]
+    )
+
+    queue: WorkQueue
+    if args.memory_queue:
+        queue = asyncio.Queue(args.queue_size)
+    else:
+        queue = DurableQueue(app.database, {"tweet": TwitterUpdate.from_job}, poll_interval=0.05)
+        await queue.recover()
+
+    api = TumblrApi("consumer", "secret", "token", "token_secret", host=tumblr_url, limiter=limiter)
+    images = ImageProcessor(args.image_format) if args.image_format else None
+    pipeline = PostPipeline(
+        queue, RoutingIndex(routes, list(routes), args.fallback_blog), api, app.renderers, images, args.concurrency, args.max_pending
+    )
+    listener = TwitterListener(queue, "benchmark")
+
+    # How far the queue backs up, sampled while the benchmark runs
+    peak = {"queued": 0, "taken": 0}
+
+    async def sample() -> None:
+        while True:
+            peak["queued"] = max(peak["queued"], await queue_depth(queue))
+            peak["taken"] = max(peak["taken"], pipeline.taken)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    started = perf_counter()
+    tasks = [asyncio.create_task(pipeline.run()), asyncio.create_task(sample())]
+    try:
+        await feed(listener)
+        await asyncio.wait_for(tumblr.posted.wait(), args.timeout)
+    except TimeoutError:
+        print(f"Timed out after {args.timeout} seconds")
+    finally:
+        elapsed = perf_counter() - started
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if images is not None:
+            images.close()
+        await api.close()
+        await app.close()
+        await tumblr_runner.cleanup()
+
+    stages = {
+        key[0]: (sum(counts), STAGE_SECONDS.sums[key] / max(1, sum(counts))) for (key, counts) in STAGE_SECONDS.counts.items()
+    }
+    return {
+        "tweets": expected,
+        "posts": len(tumblr.latencies),
+        "seconds": elapsed,
+        "posts_per_second": len(tumblr.latencies) / elapsed,
+        "latency_p50": percentile(tumblr.latencies, 0.5) if tumblr.latencies else None,
+        "latency_p99": percentile(tumblr.latencies, 0.99) if tumblr.latencies else None,
+        "latency_max": max(tumblr.latencies) if tumblr.latencies else None,
+        "peak_queued": peak["queued"],
+        "peak_taken": peak["taken"],
+        "stages": stages,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+async def benchmark(args: argparse.Namespace, workdir: str) -> dict[str, Any]:
+    twitter = SyntheticTwitter(args.accounts, args.thread_length, args.twitter_latency)
+    stream = FakeStream(twitter, args.tweets, args.rate)
+    (stream_runner, stream_url) = await start_server([web.get("/2/tweets/search/stream", stream.stream)])
+
+    async def feed(listener: TwitterListener) -> None:
+        await read_stream(listener, f"{stream_url}/2/tweets/search/stream")
+
+    routes = {user["username"]: f"blog{index % args.blogs}" for (index, user) in enumerate(twitter.users)}
+    try:
+        result = await run_pipeline(args, workdir, twitter, twitter.users, routes, feed, stream.sent, args.tweets)
+    finally:
+        await stream_runner.cleanup()
+    result["thread_requests"] = twitter.requests
+    return result
+
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser) -> None:
+    """The options of the pipeline itself, and of the fakes around it"""
+    parser.add_argument("--render-time", type=float, default=0.05, help="seconds a stub render takes")
+    parser.add_argument("--tumblr-latency", type=float, default=0.1, help="seconds a post takes")
+    parser.add_argument("--renderers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-pending", type=int, default=16)
+    parser.add_argument("--image-format", default="PNG", help='"PNG", "WEBP" or "JPEG", empty to skip processing')
+    parser.add_argument("--memory-queue", action="store_true", help="use the in memory queue instead of the durable one")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--fallback-blog", default=None, help="the blog of tweets by accounts without a blog")
+    parser.add_argument("--timeout", type=float, default=600)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tweets", type=int, default=500, help="number of tweets the stream sends")
+    parser.add_argument("--rate", type=float, default=0, help="tweets per second, 0 sends them as fast as possible")
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--blogs", type=int, default=5)
+    parser.add_argument("--thread-length", type=int, default=3, help="tweets per thread, 1 for no replies")
+    parser.add_argument("--twitter-latency", type=float, default=0.05, help="seconds a thread fetch takes")
+    add_pipeline_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def show_warnings() -> None:
+    # The loggers of hopperbot log everything, only warnings are shown
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(handler)
+
+
+def print_result(result: dict[str, Any]) -> None:
+    print(f"posts:      {result['posts']}/{result['tweets']} in {result['seconds']:.2f}s")
+    print(f"throughput: {result['posts_per_second']:.1f} posts/s")
+    if result["posts"]:
+        print(
+            f"latency:    p50 {result['latency_p50'] * 1000:.0f}ms, p99 {result['latency_p99'] * 1000:.0f}ms, "
+            f"max {result['latency_max'] * 1000:.0f}ms"
+        )
+    print(f"backlog:    at most {result['peak_queued']} queued, {result['peak_taken']} taken by the pipeline")
+    print("stages:")
+    for (stage, (count, mean)) in result["stages"].items():
+        print(f"  {stage + ':':<14}{count} times, {mean * 1000:.0f}ms on average")
+    print(f"threads:    {result['thread_requests']} Twitter requests")
+    print(f"peak RSS:   {result['peak_rss_mb']:.1f} MB")
+
+
+def main() -> None:
+    args = parse_args()
+    show_warnings()
+    with tempfile.TemporaryDirectory() as workdir:
+        result = asyncio.run(benchmark(args, workdir))
+    print_result(result)
+
+
+if __name__ == "__main__":
+    main()
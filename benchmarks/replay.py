@@ -0,0 +1,144 @@
+"""Replays a capture of real Twitter traffic through the pipeline, to see how
+it copes with real bursts and real threads instead of synthetic ones.
+
+A capture is recorded by the bot itself, when `CAPTURE_FILENAME` is set in
+main.py: every line the stream sent, and every response to a thread fetch.
+The lines are handed to a TwitterListener again, in the same order and with
+the same gaps between them (or `--speed` times faster, 0 replays them as fast
+as possible). Threads are fetched from a fake Twitter client that knows every
+tweet in the capture. Like `benchmarks.pipeline`, posts go to a local fake
+Tumblr API and screenshots come from a stub renderer, everything in between
+is the real thing.
+
+    python -m benchmarks.replay capture.jsonl.gz [--speed N] [--blogs N] ...
+
+Reports the same as `benchmarks.pipeline`: throughput, latency, how far the
+queue backed up and how long every stage took on average.
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+from time import perf_counter, time
+from typing import Any, Optional
+
+from tweepy import Media, Response, Tweet, User
+
+from benchmarks.pipeline import add_pipeline_arguments, print_result, run_pipeline, show_warnings
+from hopperbot.capture import RESPONSE, STREAM, read_capture
+from hopperbot.twitter import TwitterListener
+
+
+class CapturedTwitter:
+    """Answers the thread fetches of the resolver from the tweets, users and
+    media found anywhere in a capture, after waiting `latency` seconds"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.session = None
+        self.tweets: dict[int, dict[str, Any]] = {}
+        self.users: dict[int, dict[str, Any]] = {}
+        self.media: dict[str, dict[str, Any]] = {}
+        self.requests = 0
+
+    def add(self, payload: dict[str, Any]) -> None:
+        """Remembers everything in a line of the stream or an API response"""
+        data = payload.get("data")
+        includes = payload.get("includes", {})
+        for tweet in (data if isinstance(data, list) else [data] if data else []) + includes.get("tweets", []):
+            self.tweets[int(tweet["id"])] = tweet
+        for user in includes.get("users", []):
+            self.users[int(user["id"])] = user
+        for item in includes.get("media", []):
+            self.media[item["media_key"]] = item
+
+    def response(self, tweets: list[dict[str, Any]]) -> Response:
+        # Like the real API, the tweets that were replied to are included
+        referenced = [
+            self.tweets[int(reference["id"])]
+            for tweet in tweets
+            for reference in tweet.get("referenced_tweets", [])
+            if int(reference["id"]) in self.tweets
+        ]
+        authors = {int(tweet["author_id"]) for tweet in tweets + referenced if "author_id" in tweet}
+        media_keys = {key for tweet in tweets + referenced for key in tweet.get("attachments", {}).get("media_keys", [])}
+        includes = {
+            "tweets": [Tweet(tweet) for tweet in referenced],
+            "users": [User(self.users[id]) for id in authors if id in self.users],
+            "media": [Media(self.media[key]) for key in media_keys if key in self.media],
+        }
+        return Response([Tweet(tweet) for tweet in tweets], includes, [], {})
+
+    async def get_tweets(self, ids: list[int], **params: Any) -> Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return self.response([self.tweets[int(id)] for id in ids if int(id) in self.tweets])
+
+    async def search_recent_tweets(self, query: str, **params: Any) -> Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        conversation_id = query.removeprefix("conversation_id:")
+        return self.response([tweet for tweet in self.tweets.values() if tweet.get("conversation_id") == conversation_id])
+
+
+def load(filename: str, twitter: CapturedTwitter) -> list[tuple[float, str]]:
+    """The lines of the stream in a capture, with when they came in. Everything
+    in the capture is handed to `twitter`"""
+    lines = []
+    for record in read_capture(filename):
+        if record["kind"] == STREAM:
+            twitter.add(json.loads(record["data"]))
+            lines.append((record["at"], record["data"]))
+        elif record["kind"] == RESPONSE:
+            twitter.add(record["response"])
+    return lines
+
+
+async def replay(args: argparse.Namespace, workdir: str) -> dict[str, Any]:
+    twitter = CapturedTwitter(args.twitter_latency)
+    lines = load(args.capture, twitter)
+
+    # Every tweet the stream sent is expected to be posted once
+    tweet_ids = {int(payload["data"]["id"]) for payload in (json.loads(data) for (_, data) in lines) if "data" in payload}
+    users = list(twitter.users.values())
+    routes = {user["username"].lower(): f"blog{index % args.blogs}" for (index, user) in enumerate(users)}
+    sent: dict[int, float] = {}
+
+    async def feed(listener: TwitterListener) -> None:
+        if not lines:
+            return
+        first = lines[0][0]
+        started = perf_counter()
+        for (at, data) in lines:
+            if args.speed > 0:
+                await asyncio.sleep(max(0.0, started + (at - first) / args.speed - perf_counter()))
+            payload = json.loads(data)
+            if "data" in payload:
+                sent.setdefault(int(payload["data"]["id"]), time())
+            await listener.on_data(data)
+
+    result = await run_pipeline(args, workdir, twitter, users, routes, feed, sent, len(tweet_ids))
+    result["thread_requests"] = twitter.requests
+    return result
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="a capture recorded by the bot, like capture.jsonl.gz")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster to replay, 0 for no waiting")
+    parser.add_argument("--blogs", type=int, default=5, help="the blogs the accounts in the capture are spread over")
+    parser.add_argument("--twitter-latency", type=float, default=0.05, help="seconds a thread fetch takes")
+    add_pipeline_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    show_warnings()
+    with tempfile.TemporaryDirectory() as workdir:
+        result = asyncio.run(replay(args, workdir))
+    print_result(result)
+
+
+if __name__ == "__main__":
+    main()
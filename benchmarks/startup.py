@@ -0,0 +1,57 @@
+"""Measures what importing hopperbot costs: how long importing each module
+takes in a fresh interpreter, and whether it leaves a database file behind.
+
+    python -m benchmarks.startup [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+MODULES = [
+    "hopperbot.database",
+    "hopperbot.renderer",
+    "hopperbot.tumblr",
+    "hopperbot.pipeline",
+    "hopperbot.context",
+    "hopperbot.twitter_update",
+    "hopperbot.twitter",
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module: str, workdir: str) -> float:
+    """Seconds it takes a fresh interpreter to import `module` and exit"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    started = perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=workdir, env=env, check=True, capture_output=True)
+    return perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = statistics.median(import_time("sys", ROOT) for _ in range(args.runs))
+    print(f"{'module':<28}{'median ms':>10}{'over python':>13}  side effects")
+    for module in MODULES:
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                times = [import_time(module, workdir) for _ in range(args.runs)]
+            except subprocess.CalledProcessError as e:
+                print(f"{module:<28}{'failed':>10}{'':>13}  {e.stderr.decode().strip().splitlines()[-1]}")
+                continue
+            created = sorted(os.listdir(workdir))
+
+        median = statistics.median(times)
+        effects = ", ".join(created) if created else "none"
+        print(f"{module:<28}{median * 1000:>10.1f}{(median - baseline) * 1000:>13.1f}  {effects}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A thread safe cache holding at most `maxsize` entries, when it is full the
+    least recently used entry is evicted. Hits and misses are counted, so that
+    it is possible to see if the cache is worth it."""
+
+    def __init__(self, maxsize: int) -> None:
+        if maxsize < 1:
+            raise ValueError("Cache should be able to hold at least one entry")
+
+        self.maxsize = maxsize
+        self.entries: OrderedDict[K, V] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> Optional[V]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                (evicted, _) = self.entries.popitem(last=False)
+                self.forget(evicted)
+
+    def forget(self, key: K) -> None:
+        """Called (with the lock held) when an entry is evicted or invalidated"""
+        pass
+
+    def invalidate(self, key: K) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.forget(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            for key in self.entries:
+                self.forget(key)
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __str__(self) -> str:
+        return f"LRUCache({len(self.entries)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses)"
+
+
+class TTLCache(LRUCache[K, V]):
+    """An LRUCache where entries also expire `ttl` seconds after they were put
+    in the cache"""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = monotonic) -> None:
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.clock = clock
+        self.expires: dict[K, float] = {}
+
+    def get(self, key: K) -> Optional[V]:
+        with self.lock:
+            expires = self.expires.get(key)
+            if expires is not None and expires <= self.clock():
+                del self.entries[key]
+                self.forget(key)
+        return super().get(key)
+
+    def put(self, key: K, value: V) -> None:
+        with self.lock:
+            self.expires[key] = self.clock() + self.ttl
+        super().put(key, value)
+
+    def forget(self, key: K) -> None:
+        self.expires.pop(key, None)
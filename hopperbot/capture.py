@@ -0,0 +1,119 @@
+import gzip
+import json
+import logging
+from threading import Lock
+from time import time
+from typing import IO, Any, Iterator, Optional, Union
+
+from tweepy import Media, Response, Tweet, User
+
+logger = logging.getLogger("Capture")
+logger.setLevel(logging.DEBUG)
+
+# The kinds of records in a capture: a line the stream sent, as it was sent,
+# and a response to a request the thread resolver made
+STREAM = "stream"
+RESPONSE = "response"
+
+# How the objects in the includes of a response are turned back into tweepy's
+# classes, other includes (like places and polls) are kept as dictionaries
+INCLUDE_TYPES: dict[str, type] = {"tweets": Tweet, "users": User, "media": Media}
+
+
+def to_raw(item: Any) -> Any:
+    """The JSON the API sent for a tweepy object, tweepy keeps it in `data`"""
+    if isinstance(item, list):
+        return [to_raw(element) for element in item]
+    return item.data if isinstance(item, (Tweet, User, Media)) else item
+
+
+def response_to_json(response: Response) -> dict[str, Any]:
+    """A response of the API in the shape the API sent it"""
+    (data, includes, errors, meta) = response
+    return {
+        "data": to_raw(data),
+        "includes": {key: to_raw(items) for (key, items) in (includes or {}).items()},
+        "errors": errors or [],
+        "meta": meta or {},
+    }
+
+
+def response_from_json(raw: dict[str, Any]) -> Response:
+    """The response of the API that `response_to_json` was given"""
+    data = raw.get("data")
+    if isinstance(data, list):
+        data = [Tweet(item) for item in data]
+    elif data is not None:
+        data = Tweet(data)
+
+    includes = {}
+    for (key, items) in raw.get("includes", {}).items():
+        item_type = INCLUDE_TYPES.get(key)
+        includes[key] = [item_type(item) for item in items] if item_type is not None else items
+    return Response(data, includes, raw.get("errors", []), raw.get("meta", {}))
+
+
+class Recorder:
+    """Writes what the stream sends, and what the thread resolver fetches, to
+    a gzipped JSON lines file, so that real traffic can be replayed later
+    (with "python -m benchmarks.replay").
+
+    Recording is off until a file is opened. Every record has the time it was
+    made, its kind, and either the line of the stream as it came in, or the
+    response to a request and what was requested.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.file: Optional[IO[str]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def open(self, filename: str) -> None:
+        self.close()
+        logger.info(f"Recording Twitter traffic to {filename}")
+        self.file = gzip.open(filename, "at", encoding="utf-8")
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def write(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + "\n")
+
+    def record_stream(self, raw_data: Union[str, bytes]) -> None:
+        if self.file is None:
+            return
+        if isinstance(raw_data, bytes):
+            raw_data = raw_data.decode("utf-8")
+        self.write({"at": time(), "kind": STREAM, "data": raw_data})
+
+    def record_response(self, request: str, response: Any) -> None:
+        """Records the response to a request like "lookup" or "search", if
+        the API returned one"""
+        if self.file is None or not isinstance(response, Response):
+            return
+        self.write({"at": time(), "kind": RESPONSE, "request": request, "response": response_to_json(response)})
+
+
+# Shared by the whole bot, `main` opens the capture file at startup
+recorder = Recorder()
+
+
+def read_capture(filename: str) -> Iterator[dict[str, Any]]:
+    """The records of a capture, in the order they were made. A capture that
+    was cut off (because the bot was killed) is read up to where it ends"""
+    with gzip.open(filename, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            logger.warning(f"Capture {filename} ends in the middle of a record")
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import re
+import tomllib
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from hopperbot.errors import ConfigError
+
+logger = logging.getLogger("Config")
+logger.setLevel(logging.DEBUG)
+
+# Seconds between checks whether the config file changed
+POLL_INTERVAL = 5.0
+
+# Twitter usernames are 1 to 15 letters, digits and underscores
+USERNAME = re.compile("[A-Za-z0-9_]{1,15}")
+
+
+class RoutingIndex:
+    """Decides which blog a post goes to, by its route keys (see
+    `TumblrPost.route_keys`). Twitter usernames are looked up case
+    insensitively, Twitter user ids and Youtube channel ids exactly.
+
+    An index is never changed after it is made, a new config gives a new
+    index, which replaces the old one as a whole.
+    """
+
+    def __init__(
+        self, routes: dict[str, str], twitter_usernames: Optional[list[str]] = None, fallback: Optional[str] = None
+    ) -> None:
+        self.routes = routes
+        self.twitter_usernames = twitter_usernames if twitter_usernames is not None else []
+        self.fallback = fallback
+
+    def blogname(self, keys: list[str]) -> Optional[str]:
+        """The blog for the first key that has one, otherwise the fallback blog"""
+        for key in keys:
+            blogname = self.routes.get(key, self.routes.get(key.lower()))
+            if blogname is not None:
+                return blogname
+        return self.fallback
+
+    def __str__(self) -> str:
+        return f"RoutingIndex(routes: {len(self.routes)}, usernames: {len(self.twitter_usernames)}, fallback: {self.fallback})"
+
+
+def required_str(table: dict[str, Any], key: str, where: str) -> str:
+    value = table.get(key)
+    if not isinstance(value, str) or not value:
+        raise ConfigError(f'{where} should have a "{key}"')
+    return value
+
+
+def tables(table: dict[str, Any], key: str, where: str) -> list[dict[str, Any]]:
+    """The list of tables under `key`, like [[Update.Twitter]], if there is one"""
+    value = table.get(key, [])
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise ConfigError(f'"{key}" of {where} should be a list of tables, use [[Update.{key}]]')
+    return value
+
+
+def add_route(routes: dict[str, str], key: str, blogname: str, where: str) -> None:
+    existing = routes.get(key)
+    if existing is not None and existing != blogname:
+        raise ConfigError(f"{where} is already updated on {existing}, it can't also go to {blogname}")
+    routes[key] = blogname
+
+
+def parse_config(data: dict[str, Any]) -> RoutingIndex:
+    """Validates a config and compiles it into a routing index.
+
+    A config is a list of updates, every update has a name, a blogname, and
+    the accounts it is about:
+
+        fallback_blogname = "test37"  # optional, for posts without a blog
+
+        [[Update]]
+        name = "Thomas"
+        blogname = "test37"
+
+            [[Update.Twitter]]
+            username = "space_stew"
+            id = 1478064563358740481  # optional
+
+            [[Update.Youtube]]
+            channel_id = "UC..."
+
+    Raises a ConfigError if the config is not like that
+    """
+    routes: dict[str, str] = {}
+    usernames: dict[str, str] = {}
+
+    fallback = data.get("fallback_blogname")
+    if fallback is not None and not isinstance(fallback, str):
+        raise ConfigError('"fallback_blogname" should be a string')
+
+    updates = data.get("Update", [])
+    if not isinstance(updates, list):
+        raise ConfigError('"Update" should be a list of tables, use [[Update]]')
+
+    for (index, update) in enumerate(updates):
+        where = f"Update {index + 1}"
+        if not isinstance(update, dict):
+            raise ConfigError(f"{where} should be a table")
+        name = required_str(update, "name", where)
+        blogname = required_str(update, "blogname", f"Update {name}")
+
+        for account in tables(update, "Twitter", name):
+            username = required_str(account, "username", f"A Twitter account of {name}")
+            if not USERNAME.fullmatch(username):
+                raise ConfigError(f'"{username}" of {name} is not a valid Twitter username')
+            add_route(routes, username.lower(), blogname, f"@{username}")
+            usernames.setdefault(username.lower(), username)
+
+            user_id = account.get("id")
+            if user_id is not None:
+                if not isinstance(user_id, int):
+                    raise ConfigError(f"The id of @{username} should be a number")
+                add_route(routes, str(user_id), blogname, f"@{username}")
+
+        for channel in tables(update, "Youtube", name):
+            channel_id = required_str(channel, "channel_id", f"A Youtube channel of {name}")
+            add_route(routes, channel_id, blogname, f"Youtube channel {channel_id}")
+
+    return RoutingIndex(routes, list(usernames.values()), fallback)
+
+
+def load_config(filename: str) -> RoutingIndex:
+    try:
+        with open(filename, "rb") as f:
+            data = tomllib.load(f)
+    except tomllib.TOMLDecodeError as e:
+        raise ConfigError(f"{filename} is not valid TOML: {e}")
+    return parse_config(data)
+
+
+def init_twitter_blognames(filename: str) -> dict[str, str]:
+    """Maps every (lowercase) Twitter username in the config to its blogname"""
+    index = load_config(filename)
+    twitter_blognames = {username.lower(): index.routes[username.lower()] for username in index.twitter_usernames}
+    logger.debug(f"Initalized twitter_blognames: {twitter_blognames}")
+    return twitter_blognames
+
+
+def file_stamp(filename: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ConfigWatcher:
+    """Keeps the routing index up to date with the config file.
+
+    The file is checked every `interval` seconds. When it changed, it is loaded
+    and validated, and if it is valid the new index replaces the old one and is
+    handed to every subscriber (to swap the routes of the pipeline, or to
+    synchronise the stream rules). An invalid config is logged and ignored, so
+    the bot keeps running with the config it had.
+    """
+
+    def __init__(self, filename: str, interval: float = POLL_INTERVAL) -> None:
+        self.filename = filename
+        self.interval = interval
+        self.stamp = file_stamp(filename)
+        self.index = load_config(filename)
+        self.subscribers: list[Callable[[RoutingIndex], Awaitable[None]]] = []
+        logger.info(f"Loaded {filename}: {self.index}")
+
+    def subscribe(self, callback: Callable[[RoutingIndex], Awaitable[None]]) -> None:
+        self.subscribers.append(callback)
+
+    async def check(self) -> bool:
+        """Reloads the config if the file changed, returns whether it did"""
+        stamp = file_stamp(self.filename)
+        if stamp is None or stamp == self.stamp:
+            return False
+        self.stamp = stamp
+
+        try:
+            index = load_config(self.filename)
+        except (ConfigError, OSError) as e:
+            logger.error(f"Ignoring changed config, because it is not valid: {e}")
+            return False
+
+        self.index = index
+        logger.info(f"Reloaded {self.filename}: {index}")
+        for callback in self.subscribers:
+            try:
+                await callback(index)
+            except Exception:
+                logger.exception("Something went wrong applying the reloaded config")
+        return True
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
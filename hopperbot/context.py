@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from hopperbot.database import FILENAME, AsyncDatabase, Database
+from hopperbot.renderer import Renderer, RendererPool
+
+if TYPE_CHECKING:
+    from tweepy.asynchronous import AsyncClient
+
+    from hopperbot.twitter_thread import ThreadResolver
+
+logger = logging.getLogger("Context")
+logger.setLevel(logging.DEBUG)
+
+
+class AppContext:
+    """Owns the long lived parts of hopperbot: the database, the renderer pool
+    and the thread resolver (with its Twitter client and tweet cache).
+
+    Nothing is made when hopperbot is imported: every part is made the first
+    time it is used, so importing a module (or running a test) does not open
+    the database or start a browser. `configure` changes the settings before
+    anything is made, and `close` takes everything that was made down again.
+    """
+
+    def __init__(
+        self,
+        database_filename: str = FILENAME,
+        renderer_pool_size: int = 2,
+        renderer_max_renders: int = 50,
+        persist_tweet_cache: bool = True,
+        renderer_factory: Callable[[], Renderer] = Renderer,
+        twitter_api: Optional["AsyncClient"] = None,
+    ) -> None:
+        self.database_filename = database_filename
+        self.renderer_pool_size = renderer_pool_size
+        self.renderer_max_renders = renderer_max_renders
+        # Whether fetched tweets are also stored in the database, so they survive restarts
+        self.persist_tweet_cache = persist_tweet_cache
+        # How renderers are made, and the client threads are fetched with (made
+        # from the keys in hopperbot.secrets if None), benchmarks swap in fakes
+        self.renderer_factory = renderer_factory
+        self.twitter_api = twitter_api
+        self.lock = Lock()
+        self._database: Optional[AsyncDatabase] = None
+        self._renderers: Optional[RendererPool] = None
+        self._resolver: Optional["ThreadResolver"] = None
+
+    def configure(self, **settings: Any) -> None:
+        with self.lock:
+            if self._database is not None or self._renderers is not None or self._resolver is not None:
+                raise RuntimeError("The context can only be configured before it is used")
+            for (name, value) in settings.items():
+                if not hasattr(self, name) or name.startswith("_"):
+                    raise AttributeError(f"Unknown setting: {name}")
+                setattr(self, name, value)
+
+    @property
+    def database(self) -> AsyncDatabase:
+        with self.lock:
+            if self._database is None:
+                logger.debug(f"Opening database {self.database_filename}")
+                self._database = AsyncDatabase(Database(self.database_filename))
+            return self._database
+
+    @property
+    def renderers(self) -> RendererPool:
+        """The renderer pool, its browsers are only started when it is used"""
+        with self.lock:
+            if self._renderers is None:
+                self._renderers = RendererPool(self.renderer_pool_size, self.renderer_max_renders, self.renderer_factory)
+            return self._renderers
+
+    @property
+    def resolver(self) -> "ThreadResolver":
+        database = self.database if self.persist_tweet_cache else None
+        with self.lock:
+            if self._resolver is None:
+                # The keys (and the modules that need them) are only loaded
+                # when Twitter is actually used
+                from hopperbot.twitter_thread import ThreadResolver, TweetCache
+
+                api = self.twitter_api
+                if api is None:
+                    from hopperbot.ratelimit import RateLimitedClient, limiter
+                    from hopperbot.secrets import twitter_keys
+
+                    api = RateLimitedClient(limiter, **twitter_keys)
+                self._resolver = ThreadResolver(api, TweetCache(database=database))
+            return self._resolver
+
+    async def close(self) -> None:
+        """Closes everything that was made, in the reverse order of use"""
+        with self.lock:
+            (resolver, renderers, database) = (self._resolver, self._renderers, self._database)
+            (self._resolver, self._renderers, self._database) = (None, None, None)
+
+        if resolver is not None:
+            await resolver.close()
+        # Quitting browsers and waiting for the last queries both block
+        if renderers is not None:
+            await asyncio.to_thread(renderers.close)
+        if database is not None:
+            await asyncio.to_thread(database.close)
+
+
+# Shared by the whole bot, `main` configures it at startup
+app = AppContext()
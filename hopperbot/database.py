@@ -1,6 +1,12 @@
+import asyncio
+import json
 import logging
 import sqlite3 as sqlite
-from typing import Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from typing import Any, Callable, Tuple, Optional, TypeVar
+from hopperbot.cache import LRUCache
 from hopperbot.people import Person, adapt_person, convert_person
 
 logger = logging.getLogger("Database")
@@ -11,95 +17,283 @@ sqlite.register_converter("PERSON", convert_person)
 
 FILENAME = "hopperbot.db"
 
+# The sqlite3 module keeps this many prepared statements around per connection
+STATEMENT_CACHE_SIZE = 64
+
+# How many people are kept in memory, so they don't have to be read again
+PEOPLE_CACHE_SIZE = 1024
+
+T = TypeVar("T")
+
+# A job of the work queue: its key, kind, payload and how often it was leased before
+Job = Tuple[str, str, dict[str, Any], int]
+
 
 class Database:
+    """A hopperbot database, with a single connection that is kept open for as
+    long as the database is used. The connection can be shared between threads,
+    every query takes the lock of the database.
+
+    People are cached in a least recently used cache in front of the
+    twitter_names table, which is invalidated when a person is added."""
 
     filename: str
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, people_cache_size: int = PEOPLE_CACHE_SIZE):
         self.filename = filename
-        con = sqlite.connect(filename, detect_types=sqlite.PARSE_DECLTYPES)
-        cur = con.cursor()
+        self.lock = Lock()
+        self.people: LRUCache[int, Person] = LRUCache(people_cache_size)
+        self.connection = sqlite.connect(
+            filename,
+            detect_types=sqlite.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
 
-        tweets = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tweets'").fetchone()
+        with self.lock, self.connection as con:
+            # Write ahead logging lets readers and the writer work at the same time,
+            # and with it "NORMAL" syncing is still safe from corruption
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
 
-        if tweets is None:
-            logger.info("Created table: tweets")
-            cur.execute(
-                "CREATE TABLE tweets(tweet_id INTEGER PRIMARY KEY, tweet_index INTEGER, reblog_id INTEGER, blogname STRING)"
-            )
+            cur = con.cursor()
 
-        twitter_names = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='twitter_names'").fetchone()
+            tweets = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tweets'").fetchone()
 
-        if twitter_names is None:
-            logger.info("Created table: twitter_names")
-            cur.execute(
-                "CREATE TABLE twitter_names(twitter_id INTEGER PRIMARY KEY, person PERSON)"
-            )
+            if tweets is None:
+                logger.info("Created table: tweets")
+                cur.execute(
+                    "CREATE TABLE tweets(tweet_id INTEGER PRIMARY KEY, tweet_index INTEGER, reblog_id INTEGER, blogname STRING)"
+                )
+
+            twitter_names = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='twitter_names'").fetchone()
+
+            if twitter_names is None:
+                logger.info("Created table: twitter_names")
+                cur.execute(
+                    "CREATE TABLE twitter_names(twitter_id INTEGER PRIMARY KEY, person PERSON)"
+                )
+
+            tweet_cache = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tweet_cache'").fetchone()
+
+            if tweet_cache is None:
+                logger.info("Created table: tweet_cache")
+                cur.execute(
+                    "CREATE TABLE tweet_cache(tweet_id INTEGER PRIMARY KEY, tweet TEXT, author TEXT, fetched_at REAL)"
+                )
+
+            jobs = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='jobs'").fetchone()
+
+            if jobs is None:
+                logger.info("Created table: jobs")
+                cur.execute(
+                    "CREATE TABLE jobs(key TEXT PRIMARY KEY, kind TEXT, payload TEXT, attempts INTEGER, enqueued_at REAL, available_at REAL, leased_until REAL)"
+                )
+
+            state = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='state'").fetchone()
+
+            if state is None:
+                logger.info("Created table: state")
+                cur.execute("CREATE TABLE state(key TEXT PRIMARY KEY, value TEXT)")
 
-        con.commit()
-        con.close()
+            dead_jobs = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dead_jobs'").fetchone()
+
+            if dead_jobs is None:
+                logger.info("Created table: dead_jobs")
+                cur.execute(
+                    "CREATE TABLE dead_jobs(key TEXT PRIMARY KEY, kind TEXT, payload TEXT, attempts INTEGER, error TEXT, failed_at REAL)"
+                )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
 
     def add_tweet(self, tweet_id: int, tweet_index: int, tumblr_id: int, blogname: str) -> None:
         """The tweet index of a single tweet would be 1"""
-        database = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
-
-        with database:
-            database.execute(
+        with self.lock, self.connection as con:
+            con.execute(
                 "INSERT INTO tweets(tweet_id, tweet_index, reblog_id, blogname) VALUES(?, ?, ?, ?)",
                 (tweet_id, tweet_index, tumblr_id, blogname),
             )
             logger.debug(f"Inserted tweet id {tweet_id} with tumblr id: {tumblr_id}")
 
-        database.close()
-
     def get_tweet(self, tweet_id: int) -> Optional[Tuple[int, int, str]]:
-        database = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
-
-        result = None
-
-        with database:
-            cur = database.execute("SELECT tweet_index, reblog_id, blogname FROM tweets WHERE tweet_id = ?", [tweet_id])
-            result = cur.fetchone()
-
-        database.close()
-
-        return result
+        with self.lock:
+            cur = self.connection.execute("SELECT tweet_index, reblog_id, blogname FROM tweets WHERE tweet_id = ?", [tweet_id])
+            return cur.fetchone()
 
     def add_person(self, twitter_id: int, person: Person) -> None:
-        database = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
-
-        with database:
-            database.execute(
+        with self.lock, self.connection as con:
+            con.execute(
                 "INSERT INTO twitter_names(twitter_id, person) VALUES(?, ?)",
                 (twitter_id, person),
             )
             logger.debug(f"Inserted person {person.name} with twitter id: {twitter_id} into twitter names table")
 
-        database.close()
+        self.people.invalidate(twitter_id)
 
     def get_person(self, twitter_id: int) -> Optional[Person]:
-        database = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
+        person = self.people.get(twitter_id)
+        if person is not None:
+            return person
+
+        return self.fetch_person(twitter_id)
 
+    def fetch_person(self, twitter_id: int) -> Optional[Person]:
+        """Reads a person from the database, bypassing (but filling) the cache"""
         result: Optional[Tuple[Person]] = None
 
-        with database:
+        with self.lock:
             # We need to pass the arguments as something with a length, so that the
             # number of question marks can be matched with that length, wo we pass
             # twitter_id as a list of length 1
-            cur = database.execute("SELECT person FROM twitter_names WHERE twitter_id = ?", [twitter_id])
+            cur = self.connection.execute("SELECT person FROM twitter_names WHERE twitter_id = ?", [twitter_id])
             result = cur.fetchone()
 
-        database.close()
-
         # Just like we needed to pass the arguments as something with length, the
         # database always returns a tuple, so we need to take the first element of
         # that tuple to get the actual person
-        return result[0] if result is not None else None
+        if result is None:
+            return None
+
+        self.people.put(twitter_id, result[0])
+        return result[0]
+
+    def preload_people(self) -> int:
+        """Fills the people cache with the twitter_names table (as far as it
+        fits), returns the number of people that were loaded"""
+        with self.lock:
+            cur = self.connection.execute("SELECT twitter_id, person FROM twitter_names LIMIT ?", [self.people.maxsize])
+            rows = cur.fetchall()
+
+        for (twitter_id, person) in rows:
+            self.people.put(twitter_id, person)
+
+        logger.info(f"Preloaded {len(rows)} people")
+        return len(rows)
+
+    def cache_tweets(self, tweets: list[Tuple[int, dict[str, Any], dict[str, Any]]]) -> None:
+        """Stores the raw data of fetched tweets and their authors, as tuples of
+        (tweet id, tweet data, author data)"""
+        fetched_at = time()
+        with self.lock, self.connection as con:
+            con.executemany(
+                "INSERT OR REPLACE INTO tweet_cache(tweet_id, tweet, author, fetched_at) VALUES(?, ?, ?, ?)",
+                [(tweet_id, json.dumps(tweet), json.dumps(author), fetched_at) for (tweet_id, tweet, author) in tweets],
+            )
+
+    def get_cached_tweet(self, tweet_id: int, max_age: float) -> Optional[Tuple[dict[str, Any], dict[str, Any]]]:
+        """Gets the raw data of a tweet and its author, if it was fetched at most
+        `max_age` seconds ago"""
+        with self.lock:
+            cur = self.connection.execute(
+                "SELECT tweet, author FROM tweet_cache WHERE tweet_id = ? AND fetched_at > ?", [tweet_id, time() - max_age]
+            )
+            result = cur.fetchone()
+
+        if result is None:
+            return None
+
+        (tweet, author) = result
+        return (json.loads(tweet), json.loads(author))
+
+    def prune_tweet_cache(self, max_age: float, max_rows: Optional[int] = None) -> int:
+        """Deletes tweets fetched more than `max_age` seconds ago, and the oldest
+        tweets beyond the newest `max_rows`. Returns how many were deleted"""
+        with self.lock, self.connection as con:
+            deleted = con.execute("DELETE FROM tweet_cache WHERE fetched_at <= ?", [time() - max_age]).rowcount
+            if max_rows is not None:
+                deleted += con.execute(
+                    "DELETE FROM tweet_cache WHERE tweet_id NOT IN "
+                    "(SELECT tweet_id FROM tweet_cache ORDER BY fetched_at DESC LIMIT ?)",
+                    [max_rows],
+                ).rowcount
+            return deleted
+
+    def set_state(self, key: str, value: str) -> None:
+        """Stores a value that should survive a restart, like the stream watermark"""
+        with self.lock, self.connection as con:
+            con.execute("INSERT OR REPLACE INTO state(key, value) VALUES(?, ?)", (key, value))
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self.lock:
+            result = self.connection.execute("SELECT value FROM state WHERE key = ?", [key]).fetchone()
+        return None if result is None else result[0]
+
+    def enqueue_job(self, key: str, kind: str, payload: dict[str, Any]) -> bool:
+        """Adds a job to the work queue, unless a job with the same key is
+        already in it. Returns whether the job was added"""
+        now = time()
+        with self.lock, self.connection as con:
+            cur = con.execute(
+                "INSERT OR IGNORE INTO jobs(key, kind, payload, attempts, enqueued_at, available_at, leased_until) VALUES(?, ?, ?, 0, ?, ?, NULL)",
+                (key, kind, json.dumps(payload), now, now),
+            )
+            return cur.rowcount > 0
+
+    def lease_job(self, lease_time: float) -> Optional[Job]:
+        """Takes the oldest job that is available and not leased, and leases it
+        for `lease_time` seconds. After that, it can be leased again"""
+        now = time()
+        with self.lock, self.connection as con:
+            result = con.execute(
+                "SELECT key, kind, payload, attempts FROM jobs WHERE available_at <= ? AND (leased_until IS NULL OR leased_until < ?) ORDER BY enqueued_at LIMIT 1",
+                [now, now],
+            ).fetchone()
+            if result is None:
+                return None
+
+            (key, kind, payload, attempts) = result
+            con.execute("UPDATE jobs SET attempts = attempts + 1, leased_until = ? WHERE key = ?", [now + lease_time, key])
+
+        return (key, kind, json.loads(payload), attempts + 1)
+
+    def ack_job(self, key: str) -> None:
+        """Removes a job that was done from the work queue"""
+        with self.lock, self.connection as con:
+            con.execute("DELETE FROM jobs WHERE key = ?", [key])
+
+    def renew_jobs(self, keys: list[str], lease_time: float) -> None:
+        """Extends the leases of jobs that are still being worked on, so that
+        they end `lease_time` seconds from now"""
+        leased_until = time() + lease_time
+        with self.lock, self.connection as con:
+            con.executemany(
+                "UPDATE jobs SET leased_until = ? WHERE key = ? AND leased_until IS NOT NULL",
+                [(leased_until, key) for key in keys],
+            )
+
+    def retry_job(self, key: str, delay: float) -> None:
+        """Gives up the lease of a job, and makes it available again after `delay` seconds"""
+        with self.lock, self.connection as con:
+            con.execute("UPDATE jobs SET available_at = ?, leased_until = NULL WHERE key = ?", [time() + delay, key])
+
+    def bury_job(self, key: str, error: str) -> None:
+        """Moves a job that keeps failing from the work queue to the dead_jobs table"""
+        with self.lock, self.connection as con:
+            con.execute(
+                "INSERT OR REPLACE INTO dead_jobs(key, kind, payload, attempts, error, failed_at) SELECT key, kind, payload, attempts, ?, ? FROM jobs WHERE key = ?",
+                [error, time(), key],
+            )
+            con.execute("DELETE FROM jobs WHERE key = ?", [key])
+
+    def release_jobs(self) -> int:
+        """Gives up all leases, for jobs that were being worked on when the
+        process stopped. Returns how many jobs were released"""
+        with self.lock, self.connection as con:
+            cur = con.execute("UPDATE jobs SET leased_until = NULL WHERE leased_until IS NOT NULL")
+            return cur.rowcount
+
+    def count_jobs(self) -> Tuple[int, int]:
+        """Returns the number of jobs in the work queue, and in the dead_jobs table"""
+        with self.lock:
+            (jobs,) = self.connection.execute("SELECT count(key) FROM jobs").fetchone()
+            (dead_jobs,) = self.connection.execute("SELECT count(key) FROM dead_jobs").fetchone()
+        return (jobs, dead_jobs)
 
     def dump_contents(self, verbose: bool = False):
-        connection = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
-        with connection:
+        with self.lock:
+            connection = self.connection
             print(" **** Table: twitter_names **** ")
             cursor = connection.execute("SELECT * FROM twitter_names;")
             for (id, person) in cursor:
@@ -113,21 +307,90 @@ class Database:
                 cursor = connection.execute("SELECT count(tweet_id) FROM tweets;")
                 result = cursor.fetchone()[0]
                 print(f" **** Table tweets contains {result} tweets **** ")
-        connection.close()
 
     def clear_tweets(self):
-        connection = sqlite.connect(self.filename, detect_types=sqlite.PARSE_DECLTYPES)
-        with connection:
+        with self.lock, self.connection as connection:
             connection.execute("DROP TABLE tweets;")
             connection.execute(
                 "CREATE TABLE tweets(tweet_id INTEGER PRIMARY KEY, tweet_index INTEGER, reblog_id INTEGER, blogname STRING);"
             )
 
-        connection.close()
 
+class AsyncDatabase:
+    """Runs the queries of a Database on a dedicated database thread, so that
+    coroutines can await them without blocking the event loop"""
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def add_tweet(self, tweet_id: int, tweet_index: int, tumblr_id: int, blogname: str) -> None:
+        await self.run(self.database.add_tweet, tweet_id, tweet_index, tumblr_id, blogname)
+
+    async def get_tweet(self, tweet_id: int) -> Optional[Tuple[int, int, str]]:
+        return await self.run(self.database.get_tweet, tweet_id)
+
+    async def add_person(self, twitter_id: int, person: Person) -> None:
+        await self.run(self.database.add_person, twitter_id, person)
+
+    async def get_person(self, twitter_id: int) -> Optional[Person]:
+        # Cache hits are answered right away, without a trip to the database thread
+        person = self.database.people.get(twitter_id)
+        if person is not None:
+            return person
+
+        return await self.run(self.database.fetch_person, twitter_id)
+
+    async def preload_people(self) -> int:
+        return await self.run(self.database.preload_people)
+
+    async def cache_tweets(self, tweets: list[Tuple[int, dict[str, Any], dict[str, Any]]]) -> None:
+        await self.run(self.database.cache_tweets, tweets)
+
+    async def get_cached_tweet(self, tweet_id: int, max_age: float) -> Optional[Tuple[dict[str, Any], dict[str, Any]]]:
+        return await self.run(self.database.get_cached_tweet, tweet_id, max_age)
+
+    async def prune_tweet_cache(self, max_age: float, max_rows: Optional[int] = None) -> int:
+        return await self.run(self.database.prune_tweet_cache, max_age, max_rows)
+
+    async def set_state(self, key: str, value: str) -> None:
+        await self.run(self.database.set_state, key, value)
+
+    async def get_state(self, key: str) -> Optional[str]:
+        return await self.run(self.database.get_state, key)
+
+    async def enqueue_job(self, key: str, kind: str, payload: dict[str, Any]) -> bool:
+        return await self.run(self.database.enqueue_job, key, kind, payload)
+
+    async def lease_job(self, lease_time: float) -> Optional[Job]:
+        return await self.run(self.database.lease_job, lease_time)
+
+    async def ack_job(self, key: str) -> None:
+        await self.run(self.database.ack_job, key)
+
+    async def renew_jobs(self, keys: list[str], lease_time: float) -> None:
+        await self.run(self.database.renew_jobs, keys, lease_time)
+
+    async def retry_job(self, key: str, delay: float) -> None:
+        await self.run(self.database.retry_job, key, delay)
+
+    async def bury_job(self, key: str, error: str) -> None:
+        await self.run(self.database.bury_job, key, error)
+
+    async def release_jobs(self) -> int:
+        return await self.run(self.database.release_jobs)
+
+    async def count_jobs(self) -> Tuple[int, int]:
+        return await self.run(self.database.count_jobs)
 
-database = Database(FILENAME)
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.database.close()
 
 
 if __name__ == "__main__":
-    database.dump_contents()
+    Database(FILENAME).dump_contents()
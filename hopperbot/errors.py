@@ -41,3 +41,7 @@ class NoTweetError(TwitterError):
 
 class NoReferencedTweetError(TwitterError):
     pass
+
+
+class ConfigError(HopperbotError):
+    pass
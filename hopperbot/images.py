@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor
+from io import BytesIO
+from typing import Optional, Tuple
+
+from PIL import Image, ImageChops
+
+logger = logging.getLogger("Images")
+logger.setLevel(logging.DEBUG)
+
+# The formats images can be converted to, with their mime types
+FORMATS = {
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "JPEG": "image/jpeg",
+}
+
+
+# Stitched tiles stay below this height (in pixels) and size (in bytes), Tumblr
+# does not accept images over 10MB
+TILE_MAX_HEIGHT = 4000
+TILE_MAX_BYTES = 10_000_000
+
+# A stitched tile, with the indices of the images it contains
+Tile = Tuple[bytes, list[int]]
+
+
+def media_type(data: bytes) -> str:
+    """Guesses the mime type of an image from its first bytes"""
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    elif data.startswith(b"GIF8"):
+        return "image/gif"
+    else:
+        return "image/png"
+
+
+def crop_whitespace(image: Image.Image, tolerance: int = 8) -> Image.Image:
+    """Crops the border around an image that has the same colour as its top
+    left pixel (give or take `tolerance`)"""
+    rgb = image.convert("RGB")
+    background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    difference = ImageChops.difference(rgb, background).convert("L").point(lambda p: 255 if p > tolerance else 0)
+    box = difference.getbbox()
+    return image.crop(box) if box else image
+
+
+def process_image(
+    data: bytes, format: str = "PNG", quality: int = 85, colors: Optional[int] = None, crop: bool = True
+) -> bytes:
+    """Makes a screenshot smaller before it is uploaded.
+
+    Parameters
+    ----------
+    data : bytes
+        The image, as rendered
+    format : str
+        One of "PNG", "WEBP" or "JPEG"
+    quality : int
+        The quality (0-100) for WEBP and JPEG images
+    colors : int, optional
+        If given, PNG images are quantized to this many colours
+    crop : bool
+        Whether to crop the whitespace around the image
+
+    Returns
+    -------
+    bytes
+        The processed image, or the original if processing did not make it smaller
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Image format should be one of {', '.join(FORMATS)}")
+
+    with Image.open(BytesIO(data)) as original:
+        image = crop_whitespace(original) if crop else original.copy()
+
+    output = BytesIO()
+    if format == "PNG":
+        if colors is not None:
+            image = image.convert("RGB").quantize(colors)
+        image.save(output, "PNG", optimize=True)
+    elif format == "WEBP":
+        image.save(output, "WEBP", quality=quality, method=4)
+    else:
+        image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    # Re-encoding a small or already optimized image can make it bigger, in any format
+    processed = output.getvalue()
+    if len(processed) >= len(data):
+        return data
+    return processed
+
+
+def encode_tile(images: list[Image.Image]) -> bytes:
+    width = max(image.width for image in images)
+    tile = Image.new("RGB", (width, sum(image.height for image in images)), "white")
+    top = 0
+    for image in images:
+        tile.paste(image, (0, top))
+        top += image.height
+
+    output = BytesIO()
+    tile.save(output, "PNG", optimize=True)
+    return output.getvalue()
+
+
+def stitch_images(images: list[bytes], max_height: int = TILE_MAX_HEIGHT, max_bytes: int = TILE_MAX_BYTES) -> list[Tile]:
+    """Stacks consecutive images on top of each other into as few tiles as
+    possible, where every tile is at most `max_height` pixels high and at most
+    `max_bytes` big. An image that is too big by itself gets a tile of its own.
+
+    Returns the tiles as PNG images, with the indices of the images in them
+    """
+    opened = [Image.open(BytesIO(data)) for data in images]
+
+    groups: list[list[int]] = []
+    height = 0
+    for (index, image) in enumerate(opened):
+        if groups and height + image.height <= max_height:
+            groups[-1].append(index)
+            height += image.height
+        else:
+            groups.append([index])
+            height = image.height
+
+    tiles: list[Tile] = []
+    while groups:
+        group = groups.pop(0)
+        if len(group) == 1:
+            tiles.append((images[group[0]], group))
+            continue
+
+        tile = encode_tile([opened[index] for index in group])
+        if len(tile) <= max_bytes:
+            tiles.append((tile, group))
+        else:
+            # Too big, so try again with both halves
+            middle = len(group) // 2
+            groups[0:0] = [group[:middle], group[middle:]]
+
+    for image in opened:
+        image.close()
+
+    return tiles
+
+
+class ImageProcessor:
+    """Processes the rendered images of a post before they are uploaded, on a
+    process pool if `processes` is given, otherwise on the default thread pool.
+
+    If `stitch` is set, images that may be combined (like the tweets of a
+    thread) are first stitched into tiles, so there are fewer images to upload.
+    """
+
+    def __init__(
+        self,
+        format: str = "PNG",
+        quality: int = 85,
+        colors: Optional[int] = None,
+        crop: bool = True,
+        processes: Optional[int] = None,
+        stitch: bool = False,
+        tile_height: int = TILE_MAX_HEIGHT,
+        tile_bytes: int = TILE_MAX_BYTES,
+    ) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Image format should be one of {', '.join(FORMATS)}")
+
+        self.format = format
+        self.quality = quality
+        self.colors = colors
+        self.crop = crop
+        self.stitch = stitch
+        self.tile_height = tile_height
+        self.tile_bytes = tile_bytes
+        self.executor: Optional[Executor] = ProcessPoolExecutor(processes) if processes else None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def process(self, media_sources: dict[str, bytes]) -> dict[str, bytes]:
+        loop = asyncio.get_running_loop()
+        processed = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self.executor, process_image, data, self.format, self.quality, self.colors, self.crop
+                )
+                for data in media_sources.values()
+            )
+        )
+
+        before = sum(len(data) for data in media_sources.values())
+        after = sum(len(data) for data in processed)
+        self.bytes_in += before
+        self.bytes_out += after
+        if media_sources:
+            logger.debug(f"Processed {len(media_sources)} images from {before} to {after} bytes")
+
+        return dict(zip(media_sources, processed))
+
+    async def stitch_images(self, images: list[bytes]) -> list[Tile]:
+        loop = asyncio.get_running_loop()
+        tiles = await loop.run_in_executor(self.executor, stitch_images, images, self.tile_height, self.tile_bytes)
+        logger.debug(f"Stitched {len(images)} images into {len(tiles)} tiles")
+        return tiles
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
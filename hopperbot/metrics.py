@@ -0,0 +1,281 @@
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from time import perf_counter
+from typing import Awaitable, Callable, Iterator, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger("Metrics")
+logger.setLevel(logging.DEBUG)
+
+# Upper bounds (in seconds) of the buckets of a histogram. Stages take from a
+# few milliseconds (a cached thread) to minutes (a slow upload)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Seconds from receiving a tweet until it is posted, which includes waiting in
+# the queue and can span restarts
+LATENCY_BUCKETS = (1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 21600.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    if value == inf:
+        return "+Inf"
+    if value == -inf:
+        return "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Labels) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for (name, value) in zip(names, values)) + "}"
+
+
+class Metric:
+    """The part of counters, gauges and histograms that deals with labels.
+
+    Values are kept per combination of label values, which are given as keyword
+    arguments, like `API_CALLS.inc(api="tumblr", endpoint="POST /v2/blog/:blog/posts", status="201")`.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def key(self, labels: dict[str, str]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} has labels {self.labels}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], Labels, float]]:
+        """The name, label names, label values and value of every sample"""
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for (name, label_names, label_values, value) in self.samples():
+            lines.append(f"{name}{format_labels(label_names, label_values)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A number that only goes up. A counter can also read its value from a
+    function, for things that already count themselves (like cache hits)"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+        self.functions: dict[Labels, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only go up")
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self.functions[self.key(labels)] = function
+
+    def get(self, **labels: str) -> float:
+        key = self.key(labels)
+        function = self.functions.get(key)
+        return function() if function is not None else self.values.get(key, 0)
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], Labels, float]]:
+        for (key, value) in self.values.items():
+            yield (self.name, self.labels, key, value)
+        for (key, function) in self.functions.items():
+            yield (self.name, self.labels, key, function())
+
+
+class Gauge(Counter):
+    """A number that goes up and down, like the length of a queue"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts observations (like how long something took) in buckets, and keeps
+    their sum, so that both averages and percentiles can be worked out"""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (inf,)
+        # For every combination of labels: the count per bucket, and the sum
+        self.counts: dict[Labels, list[int]] = {}
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes how many seconds the body of the with statement took,
+        also when it raised"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        return sum(self.counts.get(self.key(labels), []))
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], Labels, float]]:
+        bucket_labels = self.labels + ("le",)
+        for (key, counts) in self.counts.items():
+            total = 0
+            for (bound, count) in zip(self.buckets, counts):
+                total += count
+                yield (f"{self.name}_bucket", bucket_labels, key + (format_value(bound),), total)
+            yield (f"{self.name}_sum", self.labels, key, self.sums[key])
+            yield (f"{self.name}_count", self.labels, key, total)
+
+
+class Registry:
+    """All metrics that are exported, rendered in Prometheus' text format.
+
+    Some values are expensive or asynchronous to read (like the number of jobs
+    in the database), those are updated by refresh functions right before the
+    metrics are rendered, instead of every time they change.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.refreshers: list[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric named {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        counter = Counter(name, help, labels)
+        self.register(counter)
+        return counter
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        gauge = Gauge(name, help, labels)
+        self.register(gauge)
+        return gauge
+
+    def histogram(
+        self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        histogram = Histogram(name, help, labels, buckets)
+        self.register(histogram)
+        return histogram
+
+    def add_refresher(self, refresher: Callable[[], Awaitable[None]]) -> None:
+        self.refreshers.append(refresher)
+
+    async def refresh(self) -> None:
+        for refresher in self.refreshers:
+            try:
+                await refresher()
+            except Exception:
+                # Stale values are better than no metrics at all
+                logger.exception("Could not refresh metrics")
+
+    async def render(self) -> str:
+        await self.refresh()
+        return "".join(metric.render() for metric in self.metrics.values())
+
+
+# Every metric of hopperbot is registered here
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "hopperbot_stage_seconds", "Seconds spent in each stage of making a post", ("stage",)
+)
+UPDATE_LATENCY = registry.histogram(
+    "hopperbot_update_latency_seconds",
+    "Seconds from receiving an update until it reached a milestone",
+    ("milestone",),
+    LATENCY_BUCKETS,
+)
+UPDATES_RECEIVED = registry.counter("hopperbot_updates_received_total", "Updates put in the work queue", ("source",))
+POSTS = registry.counter("hopperbot_posts_total", "Posts the pipeline finished, by result", ("result",))
+API_CALLS = registry.counter(
+    "hopperbot_api_calls_total", "Calls made to the Twitter and Tumblr APIs, by status", ("api", "endpoint", "status")
+)
+API_ERRORS = registry.counter(
+    "hopperbot_api_errors_total", "Calls to the Twitter and Tumblr APIs that failed", ("api", "endpoint")
+)
+CACHE_HITS = registry.counter("hopperbot_cache_hits_total", "Lookups that were found in a cache", ("cache",))
+CACHE_MISSES = registry.counter("hopperbot_cache_misses_total", "Lookups that were not found in a cache", ("cache",))
+THREAD_REQUESTS_SAVED = registry.counter(
+    "hopperbot_thread_requests_saved_total", "Thread fetches the tweet cache answered instead of the Twitter API"
+)
+QUEUE_DEPTH = registry.gauge("hopperbot_queue_depth", "Posts waiting in the work queue", ("queue",))
+PIPELINE_PENDING = registry.gauge("hopperbot_pipeline_pending", "Posts taken from the queue but not yet posted")
+RENDERS = registry.counter("hopperbot_renders_total", "Renders the renderer pool has done")
+RENDER_WAIT_SECONDS = registry.counter(
+    "hopperbot_render_wait_seconds_total", "Seconds renderers spent waiting for pages to load"
+)
+RENDER_SAVED_SECONDS = registry.gauge(
+    "hopperbot_render_saved_seconds", "Seconds waiting on pages saved, compared to the fixed sleeps renderers used to do"
+)
+PIPELINE_WORKERS = registry.gauge("hopperbot_pipeline_workers", "Blogs that are being posted to right now")
+
+
+class MetricsServer:
+    """Serves the metrics on /metrics, for Prometheus to scrape"""
+
+    def __init__(self, registry: Registry = registry, host: str = "localhost", port: int = 9108) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        body = await self.registry.render()
+        return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def setup(self) -> None:
+        app = web.Application()
+        app.add_routes([web.get("/metrics", self.handle_metrics)])
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from asyncio import Queue, Semaphore, Task
+from collections import deque
+from time import time
+from typing import Any, Optional
+
+from hopperbot.config import RoutingIndex
+from hopperbot.images import ImageProcessor
+from hopperbot.metrics import POSTS
+from hopperbot.renderer import RendererPool
+from hopperbot.tracing import tracer
+from hopperbot.tumblr import TumblrApi, TumblrPost
+from hopperbot.work_queue import DurableQueue, WorkQueue
+
+logger = logging.getLogger("Pipeline")
+logger.setLevel(logging.DEBUG)
+
+
+def response_error(response: Any) -> Optional[str]:
+    """Describes what went wrong according to a Tumblr response, if anything"""
+    if not isinstance(response, dict):
+        return None
+    if response.get("errors"):
+        return f"Tumblr returned errors: {response['errors']}"
+    if "id" not in response:
+        return f"Tumblr returned no post id: {response.get('meta')}"
+    return None
+
+
+class PostPipeline:
+    """Takes posts from the work queue and posts them to Tumblr, with at most
+    `concurrency` posts being made at the same time.
+
+    Posts to the same blog are made one after the other, in the order they were
+    queued, so that reblog chains stay in order (except for posts the durable
+    queue retries, see `DurableQueue`). At most `max_pending` posts are
+    taken from the queue at once, after that the queue fills up and whoever
+    puts posts in it has to wait.
+
+    With a DurableQueue, whether a post succeeded is reported back to the queue,
+    so that failed posts are retried. Posts that are still queued when the
+    pipeline stops stay in the queue, instead of being drained.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        routes: RoutingIndex,
+        api: TumblrApi,
+        renderers: RendererPool,
+        images: Optional[ImageProcessor] = None,
+        concurrency: int = 4,
+        max_pending: int = 16,
+        drain_timeout: float = 60,
+    ) -> None:
+        self.queue = queue
+        self.routes = routes
+        self.api = api
+        self.renderers = renderers
+        self.images = images
+        self.drain_timeout = drain_timeout
+        self.slots = Semaphore(concurrency)
+        self.capacity = Semaphore(max_pending)
+        # Posts that were taken from the queue, but are not finished yet
+        self.taken = 0
+        self.pending: dict[str, deque[TumblrPost]] = {}
+        self.workers: dict[str, Task[None]] = {}
+
+    async def update_routes(self, routes: RoutingIndex) -> None:
+        """Swaps in the routes of a reloaded config, posts that were already
+        handed to a blog keep going there"""
+        self.routes = routes
+
+    def blogname(self, post: TumblrPost) -> Optional[str]:
+        blogname = self.routes.blogname(post.route_keys())
+        if blogname is None:
+            logger.error(f"No blogname found for {post.identifier}, and there is no fallback blog")
+        elif blogname == self.routes.fallback:
+            logger.warning(f"No blogname found for {post.identifier}, using the fallback blog")
+        return blogname
+
+    async def dispatch(self, post: TumblrPost) -> None:
+        """Hands the post to the worker of its blog, starting one if needed"""
+        blogname = self.blogname(post)
+        if blogname is None:
+            self.release()
+            POSTS.inc(result="unroutable")
+            await self.finish(post, f"No blog for {post.identifier}")
+            return
+
+        self.pending.setdefault(blogname, deque()).append(post)
+        if blogname not in self.workers:
+            self.workers[blogname] = asyncio.create_task(self.work(blogname))
+
+    def release(self) -> None:
+        self.taken -= 1
+        self.capacity.release()
+
+    async def finish(self, post: TumblrPost, error: Optional[str]) -> None:
+        if isinstance(self.queue, DurableQueue):
+            await self.queue.done(post, error)
+        else:
+            self.queue.task_done()
+
+    async def work(self, blogname: str) -> None:
+        pending = self.pending[blogname]
+        try:
+            while pending:
+                post = pending.popleft()
+                try:
+                    # Posts that are not about an update have no trace of their own
+                    trace_id = getattr(post, "trace_id", None)
+                    with tracer.span("post", trace_id, blog=blogname, identifier=post.identifier) as span:
+                        received_at = getattr(post, "received_at", None)
+                        if span is not None and received_at is not None:
+                            span.set(queued_for=time() - received_at)
+                        async with self.slots:
+                            response = await post.post(blogname, self.api, self.renderers, self.images)
+                        error = response_error(response)
+                        if span is not None:
+                            span.set(error=error)
+                except Exception as e:
+                    logger.exception(f"Something went wrong posting to {blogname}")
+                    error = repr(e)
+                finally:
+                    self.release()
+                    if isinstance(self.queue, Queue):
+                        self.queue.task_done()
+
+                # A cancelled post never gets here, its job stays leased until the next start
+                POSTS.inc(result="failed" if error is not None else "posted")
+                if isinstance(self.queue, DurableQueue):
+                    await self.queue.done(post, error)
+        finally:
+            del self.pending[blogname]
+            del self.workers[blogname]
+
+    async def run(self) -> None:
+        # Posts can wait long for the rate limiter, their jobs should not be leased again meanwhile
+        renewer = asyncio.create_task(self.queue.renew_leases()) if isinstance(self.queue, DurableQueue) else None
+        try:
+            while True:
+                await self.capacity.acquire()
+                try:
+                    post = await self.queue.get()
+                except BaseException:
+                    self.capacity.release()
+                    raise
+                self.taken += 1
+                await self.dispatch(post)
+        finally:
+            await self.drain()
+            if renewer is not None:
+                renewer.cancel()
+
+    async def drain(self) -> None:
+        """Posts whatever is still in the queue or already taken from it, giving
+        up after `drain_timeout` seconds"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        if isinstance(self.queue, Queue):
+            # Drained posts take capacity like any other, which their workers give back
+            try:
+                async with asyncio.timeout_at(deadline):
+                    while not self.queue.empty():
+                        await self.capacity.acquire()
+                        self.taken += 1
+                        await self.dispatch(self.queue.get_nowait())
+            except TimeoutError:
+                logger.warning(f"{self.queue.qsize()} posts were still queued when draining timed out")
+
+        if not self.workers:
+            return
+
+        logger.info(f"Draining posts for {len(self.workers)} blogs")
+        (_, unfinished) = await asyncio.wait(list(self.workers.values()), timeout=max(0, deadline - loop.time()))
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            logger.warning(f"Posts for {len(unfinished)} blogs did not finish while draining")
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+from typing import Any, Callable, Iterator, Mapping, Optional, Tuple
+
+from tweepy import HTTPException, TooManyRequests
+from tweepy.asynchronous import AsyncClient, AsyncStreamingClient
+
+from hopperbot.metrics import API_CALLS, API_ERRORS
+from hopperbot.tracing import tracer
+
+logger = logging.getLogger("RateLimit")
+logger.setLevel(logging.DEBUG)
+
+# Priorities, calls with a lower number go first
+LIVE = 0
+BACKFILL = 1
+
+# The priority of API calls made by the current task, so that code several calls
+# deep (like tweepy) does not need to pass it along
+priority: ContextVar[int] = ContextVar("priority", default=LIVE)
+
+# Requests per window (in seconds), for the endpoints hopperbot uses. Twitter
+# limits are per app, per 15 minutes; Tumblr allows 1000 requests per hour
+# and 250 posts per day
+DEFAULT_LIMIT = (300, 900.0)
+LIMITS = {
+    "GET /2/tweets": (300, 900.0),
+    "GET /2/tweets/search/recent": (450, 900.0),
+    "GET /2/tweets/search/stream/rules": (450, 900.0),
+    "POST /2/tweets/search/stream/rules": (450, 900.0),
+    "GET /2/users/by": (300, 900.0),
+    "GET /2/users/:id/tweets": (1500, 900.0),
+    "tumblr:api": (1000, 3600.0),
+    "tumblr:post": (250, 86400.0),
+}
+
+
+class TokenBucket:
+    """Holds at most `capacity` tokens, which refill evenly over `window`
+    seconds. Once the API has told us how many calls remain until the window
+    resets, the bucket follows that instead until the reset time."""
+
+    def __init__(self, capacity: int, window: float, clock: Callable[[], float] = time) -> None:
+        self.capacity = capacity
+        self.window = window
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.reset_at: Optional[float] = None
+
+    def refill(self) -> None:
+        now = self.clock()
+        if self.reset_at is None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.window)
+        elif now >= self.reset_at:
+            self.tokens = float(self.capacity)
+            self.reset_at = None
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        elif self.reset_at is not None:
+            return self.reset_at - self.updated
+        else:
+            return (1 - self.tokens) * self.window / self.capacity
+
+    def take(self) -> None:
+        self.refill()
+        self.tokens -= 1
+
+    def update(self, limit: int, remaining: int, reset_at: float) -> None:
+        """Synchronises the bucket with the limits the API reported"""
+        self.refill()
+        self.capacity = limit
+        self.tokens = min(self.tokens, float(remaining))
+        self.reset_at = reset_at
+
+
+def parse_twitter_headers(headers: Mapping[str, str]) -> Optional[Tuple[int, int, float]]:
+    """Gets the (limit, remaining, reset time) from Twitter's rate limit headers"""
+    try:
+        return (
+            int(headers["x-rate-limit-limit"]),
+            int(headers["x-rate-limit-remaining"]),
+            float(headers["x-rate-limit-reset"]),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_tumblr_headers(headers: Mapping[str, str], now: float) -> Optional[Tuple[int, int, float]]:
+    """Gets the (limit, remaining, reset time) of the hourly limit from Tumblr's
+    rate limit headers, Tumblr reports the seconds until the reset"""
+    try:
+        remaining = int(headers["X-Ratelimit-Perhour-Remaining"])
+        reset_at = now + float(headers["X-Ratelimit-Perhour-Reset"])
+        limit = int(headers.get("X-Ratelimit-Perhour-Limit", LIMITS["tumblr:api"][0]))
+    except (KeyError, ValueError):
+        return None
+    return (limit, remaining, reset_at)
+
+
+class RateLimiter:
+    """Schedules API calls, so that every endpoint gets called as often as its
+    rate limit allows, but not more often.
+
+    Callers `await limiter.acquire(endpoint)` before every call, which waits
+    for a token of that endpoint. Waiting calls are let through in order of
+    priority, and in order of arrival within a priority, so live posting goes
+    before backfill lookups.
+    """
+
+    def __init__(self, limits: Mapping[str, Tuple[int, float]] = LIMITS, clock: Callable[[], float] = time) -> None:
+        self.limits = limits
+        self.clock = clock
+        self.buckets: dict[str, TokenBucket] = {}
+        self.waiters: dict[str, list[Tuple[int, int]]] = {}
+        self.conditions: dict[str, asyncio.Condition] = {}
+        self.counter = count()
+        self.waited = 0.0
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self.buckets:
+            (capacity, window) = self.limits.get(endpoint, DEFAULT_LIMIT)
+            self.buckets[endpoint] = TokenBucket(capacity, window, self.clock)
+        return self.buckets[endpoint]
+
+    async def acquire(self, endpoint: str, call_priority: Optional[int] = None) -> None:
+        bucket = self.bucket(endpoint)
+        waiters = self.waiters.setdefault(endpoint, [])
+        condition = self.conditions.setdefault(endpoint, asyncio.Condition())
+        entry = (priority.get() if call_priority is None else call_priority, next(self.counter))
+        started = self.clock()
+
+        async with condition:
+            heappush(waiters, entry)
+            # Whoever is first in line might have to step aside now
+            condition.notify_all()
+            try:
+                while True:
+                    if waiters[0] != entry:
+                        await condition.wait()
+                        continue
+
+                    delay = bucket.delay()
+                    if delay <= 0:
+                        break
+
+                    logger.debug(f"Waiting {delay:.1f}s for the rate limit of {endpoint}")
+                    try:
+                        await asyncio.wait_for(condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                waiters.remove(entry)
+                heapify(waiters)
+                condition.notify_all()
+                raise
+
+            heappop(waiters)
+            bucket.take()
+            condition.notify_all()
+
+        self.waited += self.clock() - started
+
+    def update(self, endpoint: str, limit: int, remaining: int, reset_at: float) -> None:
+        self.bucket(endpoint).update(limit, remaining, reset_at)
+        if remaining == 0:
+            logger.warning(f"Rate limit of {endpoint} reached, it resets in {reset_at - self.clock():.0f}s")
+
+
+@contextmanager
+def backfill() -> Iterator[None]:
+    """API calls made inside this context wait for live calls to go first"""
+    token = priority.set(BACKFILL)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+def twitter_endpoint(method: str, route: str) -> str:
+    """Replaces ids in the route, so calls for different tweets share a limit,
+    ids are at least two digits long, unlike the API version"""
+    return f"{method} {re.sub('/[0-9]{2,}', '/:id', route)}"
+
+
+class RateLimitedMixin:
+    """Makes a tweepy client wait for the rate limiter before every request,
+    and feeds the rate limit headers of every response back to it"""
+
+    limiter: RateLimiter
+
+    async def request(
+        self, method: str, route: str, params: Optional[dict[str, Any]] = None, json: Any = None, user_auth: bool = False
+    ) -> Any:
+        endpoint = twitter_endpoint(method, route)
+        with tracer.span(f"twitter {endpoint}") as span:
+            started = time()
+            await self.limiter.acquire(endpoint)
+            if span is not None:
+                span.set(waited=time() - started)
+
+            try:
+                response = await super().request(method, route, params, json, user_auth)  # type: ignore[misc]
+            except Exception as e:
+                status = str(e.response.status) if isinstance(e, HTTPException) else "error"
+                API_CALLS.inc(api="twitter", endpoint=endpoint, status=status)
+                API_ERRORS.inc(api="twitter", endpoint=endpoint)
+                if isinstance(e, TooManyRequests):
+                    parsed = parse_twitter_headers(e.response.headers)
+                    if parsed is not None:
+                        self.limiter.update(endpoint, *parsed)
+                raise
+
+            API_CALLS.inc(api="twitter", endpoint=endpoint, status=str(response.status))
+            if span is not None:
+                span.set(status=response.status)
+            parsed = parse_twitter_headers(response.headers)
+            if parsed is not None:
+                self.limiter.update(endpoint, *parsed)
+            return response
+
+
+class RateLimitedClient(RateLimitedMixin, AsyncClient):
+    def __init__(self, limiter: RateLimiter, *args: Any, **kwargs: Any) -> None:
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+
+class RateLimitedStreamingClient(RateLimitedMixin, AsyncStreamingClient):
+    def __init__(self, limiter: RateLimiter, *args: Any, **kwargs: Any) -> None:
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+
+# Shared by everything that calls the Twitter and Tumblr APIs
+limiter = RateLimiter()
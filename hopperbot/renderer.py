@@ -1,18 +1,64 @@
+import asyncio
 import logging
-from time import sleep
-from typing import Optional
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Empty, Queue
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterator, Optional, Tuple, Union, cast
 
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver import Chrome
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.remote_connection import LOGGER as selenium_logger
+from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support.wait import WebDriverWait
+
+from hopperbot.template import CARD_SELECTOR
 
 selenium_logger.setLevel(logging.INFO)
 logger = logging.getLogger("Renderer")
 logger.setLevel(logging.DEBUG)
 
+# Resolves true once no element has been added to or removed from the
+# conversation for arguments[0] milliseconds, used to know when React is done
+# loading (part of) it. Only the conversation is watched, and only for new
+# elements, so animations elsewhere on the page don't keep it from settling.
+# Resolves false if that did not happen within arguments[1] milliseconds
+QUIET_SCRIPT = """
+const [quietTime, maxTime, done] = [arguments[0], arguments[1], arguments[arguments.length - 1]];
+const conversation = document.querySelector("main section") || document.body;
+let timer;
+const finish = (settled) => { clearTimeout(timer); clearTimeout(cap); observer.disconnect(); done(settled); };
+const observer = new MutationObserver(() => restart());
+const restart = () => {
+    clearTimeout(timer);
+    timer = setTimeout(() => finish(true), quietTime);
+};
+const cap = setTimeout(() => finish(false), maxTime);
+observer.observe(conversation, {childList: true, subtree: true});
+restart();
+"""
+
+# True if every image inside arguments[0] has finished loading
+IMAGES_LOADED_SCRIPT = """
+return Array.from(arguments[0].querySelectorAll("img")).every(img => img.complete && img.naturalWidth > 0);
+"""
+
+# True if every image on the page has either loaded or failed to load
+IMAGES_SETTLED_SCRIPT = """
+return Array.from(document.images).every(img => img.complete);
+"""
+
 
 class Renderer(Chrome):
 
@@ -20,6 +66,15 @@ class Renderer(Chrome):
     FOOTER_HEIGHT = 225
     HEADER_HEIGHT = 53
     TWEET_XPATH = "/html/body/div[1]/div/div/div[2]/main/div/div/div/div[1]/div/section/div/div/div[{}]/div/div/div[1]/article"
+    # The tweet a status page is about is the only one that can't be tabbed to
+    FOCAL_TWEET_XPATH = "//section//article[@tabindex='-1']"
+
+    # Waiting variables, the timeout is in seconds, the quiet times in
+    # milliseconds. A wait for quiet gives up after QUIET_MAX_TIME, so a page
+    # that keeps changing costs a few seconds instead of the whole timeout
+    READY_TIMEOUT = 10
+    QUIET_TIME = 300
+    QUIET_MAX_TIME = 3000
 
     def __init__(self) -> None:
         options = Options()
@@ -27,31 +82,91 @@ class Renderer(Chrome):
         super().__init__(options=options)
         self.set_window_position(0, 0)
         self.set_window_size(2000, 2000)
+        self.set_script_timeout(self.READY_TIMEOUT)
+        self.renders = 0
+        # Seconds spent waiting on the page during the last render, and how
+        # much shorter that was than the fixed sleeps the renderer used to do
+        self.wait_time = 0.0
+        self.time_saved = 0.0
+
+    def is_healthy(self) -> bool:
+        """Checks whether the browser behind this renderer still responds"""
+        try:
+            self.execute_script("return 1")
+            return True
+        except WebDriverException:
+            return False
+
+    def wait_for_quiet(self) -> float:
+        """Waits until the page has not changed for `QUIET_TIME` milliseconds,
+        and returns how long that took in seconds"""
+        started = perf_counter()
+        try:
+            if not self.execute_async_script(QUIET_SCRIPT, self.QUIET_TIME, self.QUIET_MAX_TIME):
+                logger.debug(f"Conversation was still changing after {self.QUIET_MAX_TIME}ms, rendering it anyway")
+        except TimeoutException:
+            logger.warning(f"Page did not settle within {self.READY_TIMEOUT} seconds")
+        return perf_counter() - started
+
+    def wait_for_tweet(self, index: int) -> Tuple[WebElement, float]:
+        """Waits until the tweet element at `index` exists and all its images
+        have loaded. Returns the element and how long the wait took in seconds
+
+        Raises a NoSuchElementException if the tweet does not show up in time
+        """
+        return self.wait_for_element(self.TWEET_XPATH.format(index))
+
+    def wait_for_element(self, xpath: str) -> Tuple[WebElement, float]:
+        """Same as `wait_for_tweet`, but for the tweet element at `xpath`"""
+
+        def tweet_ready(driver: Chrome) -> Union[WebElement, bool]:
+            # The element is looked up again every time, because React might
+            # replace it while it loads the rest of the conversation
+            element = driver.find_element(By.XPATH, xpath)
+            return element if driver.execute_script(IMAGES_LOADED_SCRIPT, element) else False
+
+        started = perf_counter()
+        wait = WebDriverWait(
+            self,
+            self.READY_TIMEOUT,
+            poll_frequency=0.1,
+            ignored_exceptions=(NoSuchElementException, StaleElementReferenceException),
+        )
+        try:
+            element = cast(WebElement, wait.until(tweet_ready))
+        except TimeoutException:
+            raise NoSuchElementException(f"Tweet at {xpath} did not load within {self.READY_TIMEOUT} seconds")
+
+        return (element, perf_counter() - started)
+
+    def record_wait(self, url: str, waited: float, fixed_sleeps: float) -> None:
+        """Keeps track of how much time waiting on the page saved, compared to
+        the fixed sleeps the renderer used to do"""
+        self.wait_time = waited
+        self.time_saved = fixed_sleeps - waited
+        logger.debug(f"Waited {waited:.2f}s while rendering {url}, saving {self.time_saved:.2f}s")
 
-    def render_tweets(self, url: str, filename_prefix: str, thread_range: Optional[range]) -> list[str]:
+    def render_tweets(self, url: str, thread_range: Optional[range]) -> list[bytes]:
         """Renders a tweet, and the tweets it was responding to
 
         Parameters
         ----------
         url : str
             The url of the tweet to be rendered
-        filename_prefix : str
-            The n'th tweet will be saved to "filename_prefix-n.png"
         tweet_index : int
             The range of tweets to be rendered, with the first tweet in the thread having index 0.
 
         Returns
         -------
-        List[str]
-            A list of filenames, where the rendered tweets are stored
+        List[bytes]
+            A list of PNG images of the rendered tweets, in the order of the range
         """
         if thread_range is None:
             self.get(url)
-            sleep(2)
-            tweet_element = self.find_element(By.XPATH, self.TWEET_XPATH.format(1))
-            filename = filename_prefix + "1.png"
-            tweet_element.screenshot(filename)
-            return [filename]
+            (tweet_element, waited) = self.wait_for_tweet(1)
+            screenshot = tweet_element.screenshot_as_png
+            self.record_wait(url, waited, 2)
+            return [screenshot]
 
         elif thread_range.start < 0:
             raise ValueError("Thread range should have positive start")
@@ -69,23 +184,23 @@ class Renderer(Chrome):
 
         body_element.send_keys(Keys.CONTROL + Keys.HOME)
 
-        for i in range((thread_range.stop // 10) + 1):
+        passes = (thread_range.stop // 10) + 1
+        waited = 0.0
+        for i in range(passes):
             # React doesn't load all the tweets in at first, so when we scroll
             # to "home", new tweets might appear above it, the number 10 seems
             # to be this border where it needs to fetch more tweets, (why the
             # extra '+ 1' is nesesary I also don't know, but it is)
-            sleep(1)
+            waited += self.wait_for_quiet()
             body_element.send_keys(Keys.CONTROL + Keys.HOME)
 
-        # Again we sleep make sure all elements (images etc) are loaded
-        sleep(1)
-
-        filenames = []
+        screenshots = []
 
         for i in thread_range:
 
             # The first elment in the div is the header, so we need to incrment i by one
-            tweet_element = self.find_element(By.XPATH, self.TWEET_XPATH.format(i + 1))
+            (tweet_element, tweet_waited) = self.wait_for_tweet(i + 1)
+            waited += tweet_waited
 
             tweet_top = tweet_element.rect["y"]
             tweet_bottom = tweet_top + tweet_element.rect["height"]
@@ -99,15 +214,228 @@ class Renderer(Chrome):
                 logger.debug(f"Scrolled by {to_scroll} while rendering {url}")
 
                 # Because we scrolled we now need to relocate the tweet
-                tweet_element = self.find_element(By.XPATH, self.TWEET_XPATH.format(i + 1))
+                (tweet_element, tweet_waited) = self.wait_for_tweet(i + 1)
+                waited += tweet_waited
+
+            screenshots.append(tweet_element.screenshot_as_png)
+
+            logger.debug(f"Created screenshot of tweet {i} of {url}")
+
+        # Before, every pass slept a second and one more second was slept before the screenshots
+        self.record_wait(url, waited, passes + 1)
+
+        return screenshots
+
+    def render_statuses(self, urls: list[str]) -> list[bytes]:
+        """Renders the tweets at `urls` one by one, from their own status pages
+
+        Twitter scrolls a status page to the tweet it is about, so unlike
+        `render_tweets`, this does not depend on how deep into the thread the
+        tweets are, only on how many of them are rendered.
+
+        Returns
+        -------
+        List[bytes]
+            A list of PNG images of the rendered tweets, in the order of the urls
+        """
+        screenshots = []
+        waited = 0.0
+
+        for url in urls:
+            self.get(url)
+            (tweet_element, tweet_waited) = self.wait_for_element(self.FOCAL_TWEET_XPATH)
+            waited += tweet_waited
+            screenshots.append(tweet_element.screenshot_as_png)
+
+            logger.debug(f"Created screenshot of {url}")
+
+        # A single tweet used to take two seconds of sleeping
+        self.record_wait(", ".join(urls), waited, 2 * len(urls))
+
+        return screenshots
+
+    def render_html(self, page: str) -> list[bytes]:
+        """Renders every tweet card of a page made by `hopperbot.template`
+
+        Returns
+        -------
+        List[bytes]
+            A list of PNG images of the cards, in the order they appear in the page
+        """
+        self.get("data:text/html;charset=utf-8;base64," + b64encode(page.encode()).decode())
+
+        started = perf_counter()
+        wait = WebDriverWait(self, self.READY_TIMEOUT, poll_frequency=0.05)
+        try:
+            wait.until(lambda driver: driver.execute_script(IMAGES_SETTLED_SCRIPT))
+        except TimeoutException:
+            logger.warning(f"Images of the template did not load within {self.READY_TIMEOUT} seconds")
+        waited = perf_counter() - started
+
+        screenshots = [card.screenshot_as_png for card in self.find_elements(By.CSS_SELECTOR, CARD_SELECTOR)]
+
+        # Loading the same tweets from twitter.com used to sleep a second every ten tweets, and one more
+        self.record_wait("template", waited, (len(screenshots) // 10) + 2)
+
+        return screenshots
+
+
+class RendererPool:
+    """A pool of warm headless Chrome renderers, so that rendering a post does
+    not have to wait for a browser to start up.
+
+    Renderers are checked out with `with pool.renderer() as renderer: ...` and
+    are returned to the pool afterwards. A renderer is recycled (quit and
+    replaced by a fresh one) once it has rendered `max_renders` times, or when
+    it stopped responding after an error.
+
+    Selenium is blocking, so coroutines should use the `_async` versions of the
+    render methods, which render on one of the pool's worker threads and
+    leave the event loop free.
+    """
+
+    def __init__(self, size: int = 2, max_renders: int = 50, factory: Callable[[], Renderer] = Renderer) -> None:
+        if size < 1:
+            raise ValueError("Renderer pool should have at least one renderer")
+
+        self.size = size
+        self.max_renders = max_renders
+        self.factory = factory
+        self.idle: Queue[Renderer] = Queue()
+        self.lock = Lock()
+        self.launched = 0
+        self.closed = False
+        # Totals over every render the pool has done
+        self.renders = 0
+        self.wait_time = 0.0
+        self.time_saved = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="renderer")
+
+    def reserve(self) -> bool:
+        """Reserves a place in the pool for a new renderer, if there is one"""
+        with self.lock:
+            if self.closed or self.launched >= self.size:
+                return False
+            self.launched += 1
+            return True
+
+    def launch(self) -> Renderer:
+        """Launches a renderer for a place that has already been reserved"""
+        try:
+            renderer = self.factory()
+        except Exception:
+            with self.lock:
+                self.launched -= 1
+            raise
+        logger.debug("Launched a new renderer")
+        return renderer
+
+    def discard(self, renderer: Renderer) -> None:
+        with self.lock:
+            self.launched -= 1
+        try:
+            renderer.quit()
+        except WebDriverException as e:
+            logger.warning(f"Could not quit renderer cleanly: {e}")
+
+    def start(self) -> None:
+        """Launches renderers until the pool is full"""
+        while self.reserve():
+            self.idle.put(self.launch())
+
+    def checkout(self, timeout: Optional[float] = None) -> Renderer:
+        """Takes a healthy renderer from the pool, launching one if the pool is
+        not full yet. Blocks until a renderer is returned otherwise."""
+        if self.closed:
+            raise RuntimeError("Renderer pool is closed")
+
+        try:
+            renderer = self.idle.get_nowait()
+        except Empty:
+            renderer = self.launch() if self.reserve() else self.idle.get(timeout=timeout)
+
+        if not renderer.is_healthy():
+            logger.warning("Renderer from the pool did not respond, replacing it")
+            self.discard(renderer)
+            if not self.reserve():
+                raise RuntimeError("Renderer pool is closed")
+            renderer = self.launch()
+
+        return renderer
+
+    def checkin(self, renderer: Renderer, failed: bool = False) -> None:
+        """Returns a renderer to the pool, recycling it if it has been used too
+        often or if it crashed"""
+        renderer.renders += 1
+        with self.lock:
+            self.renders += 1
+            self.wait_time += renderer.wait_time
+            self.time_saved += renderer.time_saved
+        renderer.wait_time = 0.0
+        renderer.time_saved = 0.0
+
+        if self.closed:
+            self.discard(renderer)
+        elif renderer.renders >= self.max_renders or (failed and not renderer.is_healthy()):
+            logger.debug(f"Recycling renderer after {renderer.renders} renders")
+            self.discard(renderer)
+            if self.reserve():
+                self.idle.put(self.launch())
+        else:
+            self.idle.put(renderer)
+
+    @contextmanager
+    def renderer(self, timeout: Optional[float] = None) -> Iterator[Renderer]:
+        renderer = self.checkout(timeout)
+        failed = False
+        try:
+            yield renderer
+        except WebDriverException:
+            failed = True
+            raise
+        finally:
+            self.checkin(renderer, failed)
+
+    def render_tweets(self, url: str, thread_range: Optional[range]) -> list[bytes]:
+        with self.renderer() as renderer:
+            return renderer.render_tweets(url, thread_range)
+
+    async def render_tweets_async(self, url: str, thread_range: Optional[range]) -> list[bytes]:
+        """Same as `Renderer.render_tweets`, but runs on a worker thread of the
+        pool, so other coroutines keep running while the browser works"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.render_tweets, url, thread_range)
 
-            filename = f"{filename_prefix}-{i}.png"
-            tweet_element.screenshot(filename)
-            filenames.append(filename)
+    def render_statuses(self, urls: list[str]) -> list[bytes]:
+        with self.renderer() as renderer:
+            return renderer.render_statuses(urls)
 
-            logger.debug(f"Created screenshot {filename}")
+    async def render_statuses_async(self, urls: list[str]) -> list[bytes]:
+        """Same as `Renderer.render_statuses`, but runs on a worker thread of the pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.render_statuses, urls)
 
-        return filenames
+    def render_html(self, page: str) -> list[bytes]:
+        with self.renderer() as renderer:
+            return renderer.render_html(page)
 
+    async def render_html_async(self, page: str) -> list[bytes]:
+        """Same as `Renderer.render_html`, but runs on a worker thread of the pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.render_html, page)
 
-RENDERER = Renderer()
+    def close(self) -> None:
+        """Quits all idle renderers, renderers that are checked out are quit
+        when they are returned"""
+        self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        logger.info(
+            f"Rendered {self.renders} times, waiting {self.wait_time:.1f}s on pages, "
+            f"{self.time_saved:.1f}s less than fixed sleeps would have"
+        )
+        while True:
+            try:
+                renderer = self.idle.get_nowait()
+            except Empty:
+                return
+            self.discard(renderer)
@@ -0,0 +1,165 @@
+from typing import Optional, Tuple
+
+from tweepy import StreamRule
+
+# The most rules a stream can have, and the most characters a rule can have,
+# for every level of access to the Twitter API
+ACCESS_LEVELS = {
+    "essential": (5, 512),
+    "elevated": (25, 512),
+    "academic": (1000, 1024),
+}
+(MAX_RULES, MAX_RULE_LEN) = ACCESS_LEVELS["essential"]
+
+# The levels of access that can ask the stream for backfill after a disconnect
+BACKFILL_ACCESS_LEVELS = {"academic"}
+
+RULE_PREFIX = "from:"
+RULE_SEPARATOR = " OR "
+RULE_TAG = "hopperbot"
+
+
+def rule_value(usernames: list[str]) -> str:
+    return RULE_SEPARATOR.join(RULE_PREFIX + username for username in usernames)
+
+
+def rule_usernames(value: str) -> Optional[set[str]]:
+    """The (lowercase) usernames a rule matches, or None if the rule is not
+    only made of "from:" clauses, like the rules hopperbot makes"""
+    usernames = set()
+    for clause in value.split(RULE_SEPARATOR):
+        if not clause.startswith(RULE_PREFIX) or len(clause) == len(RULE_PREFIX) or " " in clause:
+            return None
+        usernames.add(clause[len(RULE_PREFIX) :].lower())
+    return usernames
+
+
+def clause_cost(username: str) -> int:
+    """The characters a username takes up in a rule, every clause but the
+    first also needs a separator, which is counted as part of the rule length"""
+    return len(RULE_PREFIX) + len(username) + len(RULE_SEPARATOR)
+
+
+def first_fit_decreasing(usernames: list[str], max_rules: int, max_len: int) -> Optional[list[list[str]]]:
+    """Packs all usernames into at most `max_rules` rules, longest first, each
+    into the first rule it fits in. Returns None if they don't all fit"""
+    capacity = max_len + len(RULE_SEPARATOR)
+    rules: list[list[str]] = []
+    space: list[int] = []
+    for username in sorted(usernames, key=lambda username: (-len(username), username.lower())):
+        cost = clause_cost(username)
+        index = next((index for (index, left) in enumerate(space) if left >= cost), None)
+        if index is None:
+            if len(rules) >= max_rules or cost > capacity:
+                return None
+            rules.append([])
+            space.append(capacity)
+            index = len(rules) - 1
+        rules[index].append(username)
+        space[index] -= cost
+    return rules
+
+
+def pack_usernames(usernames: list[str], max_rules: int, max_len: int) -> Tuple[list[str], list[str]]:
+    """Packs as many usernames as possible into at most `max_rules` rules of at
+    most `max_len` characters. Returns the rules, and the usernames that did
+    not fit.
+
+    Short usernames take up less room, so the most usernames fit when the
+    shortest ones are picked. The longest prefix (by length) of usernames that
+    first fit decreasing can pack is searched for, the rest do not fit.
+    """
+    ordered = sorted(usernames, key=lambda username: (len(username), username.lower()))
+    (low, high) = (0, len(ordered))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first_fit_decreasing(ordered[:middle], max_rules, max_len) is None:
+            high = middle - 1
+        else:
+            low = middle
+
+    rules = first_fit_decreasing(ordered[:low], max_rules, max_len) or []
+    return ([rule_value(sorted(rule, key=str.lower)) for rule in rules], ordered[low:])
+
+
+def headroom(rules: list[str], max_rules: int, max_len: int) -> int:
+    """The number of characters that are still free in the rules, counting
+    rules that could still be added"""
+    return sum(max_len - len(rule) for rule in rules) + max(0, max_rules - len(rules)) * max_len
+
+
+class RuleDiff:
+    """The changes needed to go from the rules a stream has to rules that match
+    exactly the wanted usernames.
+
+    Rules can't be changed, only added and deleted, so rules that only match
+    wanted usernames are kept as they are. The wanted usernames that are not
+    matched by a kept rule are packed into new rules.
+    """
+
+    def __init__(
+        self,
+        add: list[str],
+        delete: list[StreamRule],
+        keep: list[StreamRule],
+        overflow: list[str],
+        headroom: int = 0,
+    ) -> None:
+        self.add = add
+        self.delete = delete
+        self.keep = keep
+        self.overflow = overflow
+        # Characters left for more usernames after the changes
+        self.headroom = headroom
+
+    def __bool__(self) -> bool:
+        return bool(self.add or self.delete)
+
+    def __str__(self) -> str:
+        return (
+            f"RuleDiff(add: {len(self.add)}, delete: {len(self.delete)}, keep: {len(self.keep)}, "
+            f"overflow: {len(self.overflow)}, headroom: {self.headroom})"
+        )
+
+
+def diff_rules(
+    existing: list[StreamRule], usernames: list[str], max_rules: int = MAX_RULES, max_len: int = MAX_RULE_LEN
+) -> RuleDiff:
+    wanted = {username.lower() for username in usernames}
+    covered: set[str] = set()
+    keep = []
+    delete = []
+
+    for rule in existing:
+        matched = rule_usernames(rule.value)
+        # Rules that match someone who is no longer wanted, rules that
+        # hopperbot did not make, and duplicate rules are all deleted
+        if matched is None or not matched <= wanted or matched <= covered:
+            delete.append(rule)
+        else:
+            keep.append(rule)
+            covered |= matched
+
+    # Usernames are not case sensitive, so every username is only added once
+    unique = list({username.lower(): username for username in usernames}.values())
+    missing = [username for username in unique if username.lower() not in covered]
+    (add, overflow) = pack_usernames(missing, max_rules - len(keep), max_len)
+
+    # Keeping rules saves changes, but can leave room unused. If packing all
+    # usernames from scratch fits more of them, that is done instead
+    if overflow:
+        (repacked, repacked_overflow) = pack_usernames(unique, max_rules, max_len)
+        if len(repacked_overflow) < len(overflow):
+            kept_values = set()
+            (keep, delete) = ([], [])
+            for rule in existing:
+                if rule.value in repacked and rule.value not in kept_values:
+                    keep.append(rule)
+                    kept_values.add(rule.value)
+                else:
+                    delete.append(rule)
+            add = [value for value in repacked if value not in kept_values]
+            overflow = repacked_overflow
+
+    values = [rule.value for rule in keep] + add
+    return RuleDiff(add, delete, keep, overflow, headroom(values, max_rules, max_len))
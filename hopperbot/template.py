@@ -0,0 +1,86 @@
+import re
+from datetime import datetime
+from html import escape, unescape
+from typing import Optional, Tuple
+
+from tweepy import Media, Tweet, User
+
+# A tweet with everything needed to draw it: its author and attached media
+Card = Tuple[Tweet, User, list[Media]]
+
+# Every card in the page is an element matching this selector, in thread order
+CARD_SELECTOR = "article.tweet"
+
+# Twitter adds a link to the attached media at the end of the text of a tweet
+MEDIA_LINK = re.compile(r"\s*https://t\.co/\w+$")
+
+STYLE = """
+body { margin: 0; padding: 8px; background: #ffffff; font-family: -apple-system, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; }
+article.tweet { box-sizing: border-box; width: 598px; padding: 12px 16px; margin-bottom: 8px; background: #ffffff; color: #0f1419; }
+.header { display: flex; align-items: center; margin-bottom: 8px; }
+.avatar { width: 48px; height: 48px; border-radius: 50%; margin-right: 12px; background: #cfd9de; }
+.names { display: flex; flex-direction: column; line-height: 20px; font-size: 15px; }
+.name { font-weight: 700; }
+.verified { color: #1d9bf0; margin-left: 2px; }
+.username, .date { color: #536471; }
+.text { font-size: 17px; line-height: 24px; white-space: pre-wrap; overflow-wrap: break-word; }
+.media { display: grid; grid-template-columns: repeat(var(--columns), 1fr); gap: 2px; margin-top: 12px; border-radius: 16px; overflow: hidden; }
+.media img { width: 100%; height: 100%; max-height: 510px; object-fit: cover; display: block; }
+.date { margin-top: 12px; font-size: 15px; }
+"""
+
+
+def media_url(media: Media) -> Optional[str]:
+    """Photos have a url, videos and gifs only a preview image"""
+    return media.url or media.preview_image_url
+
+
+def tweet_text(tweet: Tweet, media: list[Media]) -> str:
+    # The API returns the text with &, < and > already escaped
+    text = unescape(tweet.text)
+    if media:
+        text = MEDIA_LINK.sub("", text)
+    return escape(text)
+
+
+def format_date(created_at: Optional[datetime]) -> str:
+    if created_at is None:
+        return ""
+    return f"{created_at:%H:%M} · {created_at:%b} {created_at.day}, {created_at.year}"
+
+
+def render_card(tweet: Tweet, author: User, media: list[Media]) -> str:
+    """Builds the html of a single tweet card"""
+    avatar = f'<img class="avatar" src="{escape(author.profile_image_url)}">' if author.profile_image_url else ""
+    verified = '<span class="verified">&#10004;</span>' if author.verified else ""
+
+    images = [
+        f'<img src="{escape(url)}" alt="{escape(item.alt_text or "")}">'
+        for item in media
+        if (url := media_url(item)) is not None
+    ]
+    gallery = f'<div class="media" style="--columns: {min(len(images), 2)}">{"".join(images)}</div>' if images else ""
+
+    date = format_date(tweet.created_at)
+    footer = f'<div class="date">{date}</div>' if date else ""
+
+    return (
+        f'<article class="tweet" data-id="{tweet.id}">'
+        f'<div class="header">{avatar}<div class="names">'
+        f'<span class="name">{escape(author.name)}{verified}</span>'
+        f'<span class="username">@{escape(author.username)}</span>'
+        f"</div></div>"
+        f'<div class="text">{tweet_text(tweet, media)}</div>'
+        f"{gallery}{footer}"
+        f"</article>"
+    )
+
+
+def render_page(cards: list[Card]) -> str:
+    """Builds a page with a card for every tweet, in the order they are given"""
+    body = "".join(render_card(tweet, author, media) for (tweet, author, media) in cards)
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        f"<style>{STYLE}</style>"
+        f"</head><body>{body}</body></html>"
+    )
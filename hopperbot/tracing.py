@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter, time
+from typing import IO, Any, Iterator, Optional
+
+logger = logging.getLogger("Tracing")
+logger.setLevel(logging.DEBUG)
+
+
+def new_trace_id() -> str:
+    # The same sizes as OpenTelemetry ids, so traces can be converted to OTLP later
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+class Span:
+    """A timed stage of handling an update, or a call it made. Spans of the
+    same update share a trace id, and point to the span they were started in"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict[str, Any]) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start_time = time()
+        self.start = perf_counter()
+        self.duration = 0.0
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_record(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+# The span that is being worked in right now, asyncio copies it into every task
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Writes the finished spans of every update to a JSON lines file, one
+    span per line, so that slow stages can be found offline.
+
+    Tracing is off until a file is opened, until then spans cost (almost)
+    nothing. A span is started with a trace id for the first stage of an
+    update, later spans, including the API calls made while handling the
+    update, are part of the trace of the span they were started in.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.file: Optional[IO[str]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def open(self, filename: str) -> None:
+        self.close()
+        logger.info(f"Writing traces to {filename}")
+        self.file = open(filename, "a", encoding="utf-8", buffering=1)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def write(self, span: Span) -> None:
+        line = json.dumps(span.to_record(), default=str)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + "\n")
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Times the body of the with statement. Without a trace id, the span
+        is part of the current trace, or starts a new one if there is none"""
+        if self.file is None:
+            yield None
+            return
+
+        parent = current_span.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent is not None else new_trace_id()
+        parent_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+
+        span = Span(name, trace_id, parent_id, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = perf_counter() - span.start
+            current_span.reset(token)
+            self.write(span)
+
+
+# Shared by the whole bot, `main` opens the trace file at startup
+tracer = Tracer()
+
+
+def load_spans(filename: str) -> list[dict[str, Any]]:
+    with open(filename, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(spans: list[dict[str, Any]]) -> str:
+    """How long every kind of span took, slowest (at the 99th percentile) first"""
+    durations: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    for span in spans:
+        durations.setdefault(span["name"], []).append(span["duration"])
+        if span["error"] is not None:
+            errors[span["name"]] = errors.get(span["name"], 0) + 1
+
+    lines = [f"{'span':<40} {'count':>7} {'errors':>7} {'p50':>9} {'p99':>9} {'max':>9}"]
+    for (name, values) in sorted(durations.items(), key=lambda item: -percentile(item[1], 0.99)):
+        lines.append(
+            f"{name:<40} {len(values):>7} {errors.get(name, 0):>7} "
+            f"{percentile(values, 0.5):>9.3f} {percentile(values, 0.99):>9.3f} {max(values):>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def format_trace(spans: list[dict[str, Any]], trace_id: str) -> str:
+    """The spans of one trace as a tree, in the order they started"""
+    trace = sorted((span for span in spans if span["trace_id"] == trace_id), key=lambda span: span["start_time"])
+    if not trace:
+        return f"No spans found for trace {trace_id}"
+
+    ids = {span["span_id"] for span in trace}
+    children: dict[Optional[str], list[dict[str, Any]]] = {}
+    for span in trace:
+        # Spans whose parent is in another trace are shown at the top level
+        parent_id = span["parent_id"] if span["parent_id"] in ids else None
+        children.setdefault(parent_id, []).append(span)
+
+    start = trace[0]["start_time"]
+    lines = []
+
+    def add(parent_id: Optional[str], depth: int) -> None:
+        for span in children.get(parent_id, []):
+            error = f" ERROR {span['error']}" if span["error"] else ""
+            lines.append(
+                f"{span['start_time'] - start:>8.3f}s {span['duration']:>8.3f}s {'  ' * depth}{span['name']} "
+                f"{json.dumps(span['attributes'], default=str)}{error}"
+            )
+            add(span["span_id"], depth + 1)
+
+    add(None, 0)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python -m hopperbot.tracing <trace file> [trace id]
+    spans = load_spans(sys.argv[1])
+    print(format_trace(spans, sys.argv[2]) if len(sys.argv) > 2 else summarize(spans))
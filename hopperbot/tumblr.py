@@ -1,51 +1,86 @@
+import asyncio
 import logging
-import os
 import re
 from abc import ABC, abstractclassmethod
-from typing import Any, Optional, Tuple, TypeAlias, Union
+from time import time
+from typing import Any, Optional, Tuple, TypeAlias, Union, cast
 
-from pytumblr2 import TumblrRestClient as TumblrApi
-
-from hopperbot.renderer import Renderer
+from hopperbot.images import ImageProcessor, Tile, media_type
+from hopperbot.metrics import STAGE_SECONDS, UPDATE_LATENCY
+from hopperbot.ratelimit import limiter
+from hopperbot.renderer import RendererPool
+from hopperbot.tracing import new_trace_id, tracer
+from hopperbot.tumblr_client import TumblrApi
 
 ContentBlock: TypeAlias = dict[str, Union[str, dict[str, str], list[dict[str, Union[str, int]]]]]
 
 
-urllib_logger = logging.getLogger("urllib3")
-urllib_logger.setLevel(logging.INFO)
-
 oauth_logger = logging.getLogger("oauthlib")
 oauth_logger.setLevel(logging.INFO)
 
-requests_logger = logging.getLogger("requests_oauthlib")
-requests_logger.setLevel(logging.INFO)
-
 logger = logging.getLogger("Tumblr")
 logger.setLevel(logging.DEBUG)
 
 
+def image_identifier(block: ContentBlock) -> Optional[str]:
+    """The identifier of the uploaded image of an image block, if it has one"""
+    media = block.get("media")
+    if block.get("type") != "image" or not isinstance(media, list) or not media:
+        return None
+    identifier = media[0].get("identifier")
+    return identifier if isinstance(identifier, str) else None
+
+
 class Renderable(ABC):
     @abstractclassmethod
-    def render(self, renderer: Renderer) -> dict[str, str]:
+    async def render(self, renderers: RendererPool) -> dict[str, bytes]:
         return {}
 
 
+async def traced_render(renderable: Renderable, renderers: RendererPool) -> dict[str, bytes]:
+    with tracer.span(type(renderable).__name__):
+        return await renderable.render(renderers)
+
+
 class TumblrPost:
     def __init__(
         self,
         identifier: Optional[str] = None,
-        content: list[ContentBlock] = [],
-        renderables: list[Renderable] = [],
-        media_sources: dict[str, str] = {},
-        tags: list[str] = [],
+        content: Optional[list[ContentBlock]] = None,
+        renderables: Optional[list[Renderable]] = None,
+        media_sources: Optional[dict[str, bytes]] = None,
+        tags: Optional[list[str]] = None,
         reblog: Optional[Tuple[int, str]] = None,
+        stitch_groups: Optional[list[list[str]]] = None,
     ) -> None:
+        # Default arguments are shared between calls, so the mutable ones are
+        # created here, otherwise every post would append to the same lists
         self.identifier = identifier
-        self.content = content
-        self.renderables = renderables
-        self.media_sources = media_sources
-        self.tags = tags
+        self.content = content if content is not None else []
+        self.renderables = renderables if renderables is not None else []
+        self.media_sources = media_sources if media_sources is not None else {}
+        self.tags = tags if tags is not None else []
         self.reblog = reblog
+        # Groups of consecutive images (by identifier) that may be stitched together
+        self.stitch_groups = stitch_groups if stitch_groups is not None else []
+        # When the update this post is about was received (as a unix timestamp), if known
+        self.received_at: Optional[float] = None
+        # Ties together the spans of everything that is done for this post
+        self.trace_id = new_trace_id()
+
+    def route_keys(self) -> list[str]:
+        """The keys to look up the blog of this post with, most specific first"""
+        return [self.identifier] if self.identifier is not None else []
+
+    def to_job(self) -> Tuple[str, str, dict[str, Any]]:
+        """The key, kind and payload to store this post in the durable work
+        queue with. Posts with the same key are only queued once"""
+        raise NotImplementedError(f"{type(self).__name__} can not be stored in the work queue")
+
+    def reached(self, milestone: str) -> None:
+        """Records how long after it was received the update reached a milestone"""
+        if self.received_at is not None:
+            UPDATE_LATENCY.observe(max(0.0, time() - self.received_at), milestone=milestone)
 
     def add_text_block(self, text: str) -> None:
         self.content.append({
@@ -118,44 +153,105 @@ class TumblrPost:
     def add_tag(self, tag: str) -> None:
         self.tags.append("tag")
 
-    async def post(self, blogname: str, api: TumblrApi) -> dict[str, Any]:
-        # Render the images
-        renderer = Renderer()
-        for renderable in self.renderables:
-            media_sources = renderable.render(renderer)
+    def add_stitch_group(self, identifiers: list[str]) -> None:
+        """Marks consecutive image blocks as images that may be stitched into
+        one image, if the image processor stitches"""
+        if len(identifiers) > 1:
+            self.stitch_groups.append(identifiers)
+
+    def replace_with_tiles(self, identifiers: list[str], tiles: list[Tile]) -> None:
+        """Replaces the image blocks of a stitch group by blocks for the tiles,
+        with the alt texts of the images combined, and the attribution of the
+        last image in every tile"""
+        positions = [index for (index, block) in enumerate(self.content) if image_identifier(block) in identifiers]
+        if not positions or positions != list(range(positions[0], positions[0] + len(identifiers))):
+            logger.warning(f"Images {identifiers} are not consecutive, so they were not stitched")
+            return
+
+        blocks = self.content[positions[0] : positions[-1] + 1]
+        tile_blocks = []
+        for (tile, members) in tiles:
+            identifier = identifiers[members[0]]
+            block: ContentBlock = {
+                "type": "image",
+                "media": [{"type": media_type(tile), "identifier": identifier}],
+            }
+            alt_texts = [cast(str, blocks[member]["alt_text"]) for member in members if "alt_text" in blocks[member]]
+            if alt_texts:
+                block["alt_text"] = "\n\n".join(alt_texts)
+            if "attribution" in blocks[members[-1]]:
+                block["attribution"] = blocks[members[-1]]["attribution"]
+            tile_blocks.append(block)
+
+            for member in members:
+                del self.media_sources[identifiers[member]]
+            self.media_sources[identifier] = tile
+
+        self.content[positions[0] : positions[-1] + 1] = tile_blocks
+
+    async def stitch_images(self, images: ImageProcessor) -> None:
+        for identifiers in self.stitch_groups:
+            if all(identifier in self.media_sources for identifier in identifiers):
+                tiles = await images.stitch_images([self.media_sources[identifier] for identifier in identifiers])
+                self.replace_with_tiles(identifiers, tiles)
+
+    def set_media_types(self) -> None:
+        """Makes the type of every uploaded image match the actual image"""
+        for block in self.content:
+            identifier = image_identifier(block)
+            if identifier is not None and identifier in self.media_sources:
+                cast(list[dict[str, str]], block["media"])[0]["type"] = media_type(self.media_sources[identifier])
+
+    async def post(
+        self, blogname: str, api: TumblrApi, renderers: RendererPool, images: Optional[ImageProcessor] = None
+    ) -> dict[str, Any]:
+        # Render the images, the renderables are rendered concurrently on the
+        # worker threads of the renderer pool
+        with STAGE_SECONDS.time(stage="render"), tracer.span("render", renderables=len(self.renderables)):
+            rendered = await asyncio.gather(*(traced_render(renderable, renderers) for renderable in self.renderables))
+        for media_sources in rendered:
             self.media_sources = self.media_sources | media_sources
+        self.reached("rendered")
 
-        # Post the post. We need to copy the media_sources because the api consumes the dictionary
-        # and these structures are internaly mutable
-        kwargs = {
-            "blogname": blogname,
-            "content": self.content,
-            "tags": self.tags,
-            "media_sources": self.media_sources.copy(),
-        }
+        # Make the images smaller (and fewer) before uploading them
+        if images is not None and self.media_sources:
+            with STAGE_SECONDS.time(stage="images"), tracer.span("images", images=len(self.media_sources)):
+                if images.stitch:
+                    await self.stitch_images(images)
+                self.media_sources = await images.process(self.media_sources)
+            self.set_media_types()
 
-        if self.reblog is None:
-            response = api.create_post(**kwargs)
-        else:
-            kwargs["id"] = str(self.reblog[0])
-            kwargs["parent_blogname"] = self.reblog[1]
-            response = api.reblog_post(**kwargs)
+        # Post the post. The media_sources are copied so that the api can not change
+        # the dictionary of this post
+        media_sources = self.media_sources.copy()
+
+        # Reblogs count towards the post limit as well
+        await limiter.acquire("tumblr:post")
+
+        with STAGE_SECONDS.time(stage="upload"), tracer.span("upload", reblog=self.reblog is not None):
+            if self.reblog is None:
+                response = await api.create_post(
+                    blogname=blogname, content=self.content, tags=self.tags, media_sources=media_sources
+                )
+            else:
+                response = await api.reblog_post(
+                    blogname=blogname,
+                    parent_blogname=self.reblog[1],
+                    id=str(self.reblog[0]),
+                    content=self.content,
+                    tags=self.tags,
+                    media_sources=media_sources,
+                )
 
         # Log posting success
         if response.get("state") == "published":
             logger.info(f"Sucessfully posted to {blogname}")
-
-        # Clean up the rendered images
-        for filename in self.media_sources.values():
-            if os.path.exists(filename):
-                os.remove(filename)
-            else:
-                logger.warning(f"The following filename could not be deleted: {filename}")
+            self.reached("posted")
 
         return response
 
     def __str__(self) -> str:
         return f"""Content: {self.content}
-Media Sources: {self.media_sources}
+Media Sources: {list(self.media_sources)}
 Tags: {self.tags}
         """
@@ -0,0 +1,200 @@
+import json
+import logging
+import re
+from typing import Any, Optional, Tuple, Union
+
+import aiohttp
+from oauthlib.oauth1 import Client as OAuthClient
+from yarl import URL
+
+from hopperbot.images import media_type
+from hopperbot.metrics import API_CALLS, API_ERRORS
+from hopperbot.ratelimit import RateLimiter, limiter, parse_tumblr_headers
+from hopperbot.tracing import tracer
+
+logger = logging.getLogger("Tumblr")
+logger.setLevel(logging.DEBUG)
+
+
+def blog_hostname(blogname: str) -> str:
+    """Turns "blog" into "blog.tumblr.com", but leaves custom domains alone"""
+    return blogname if "." in blogname else f"{blogname}.tumblr.com"
+
+
+def tumblr_endpoint(method: str, path: str) -> str:
+    """Replaces the blog in the path, so calls for different blogs are counted together"""
+    return f"{method.upper()} {re.sub('/blog/[^/]+', '/blog/:blog', path)}"
+
+
+class TumblrApi:
+    """An asynchronous Tumblr client, supporting the part of pytumblr2's
+    TumblrRestClient that hopperbot uses (NPF posts and reblogs, with media).
+
+    Requests are signed with OAuth 1 and share one aiohttp session, so the
+    connections to Tumblr are kept alive between posts. Every request waits for
+    the rate limiter, which is kept up to date with Tumblr's rate limit headers.
+    """
+
+    HOST = "https://api.tumblr.com"
+
+    def __init__(
+        self,
+        consumer_key: str,
+        consumer_secret: str = "",
+        oauth_token: str = "",
+        oauth_secret: str = "",
+        host: str = HOST,
+        limiter: RateLimiter = limiter,
+        connections: int = 8,
+    ) -> None:
+        self.oauth = OAuthClient(
+            consumer_key,
+            client_secret=consumer_secret,
+            resource_owner_key=oauth_token,
+            resource_owner_secret=oauth_secret,
+        )
+        self.host = host
+        self.limiter = limiter
+        self.connections = connections
+        self.session: Optional[aiohttp.ClientSession] = None
+        # Reblogging needs the uuid of the parent blog and the reblog key of
+        # the parent post, which are kept for every post that was seen
+        self.reblog_requirements: dict[Tuple[str, int], Tuple[str, str]] = {}
+
+    def open(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": "hopperbot"})
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    def sign(self, method: str, url: str) -> Tuple[str, dict[str, str]]:
+        # Only url encoded form bodies are part of the signature, json and
+        # multipart bodies are not, so only the url needs to be signed
+        (signed_url, headers, _) = self.oauth.sign(url, http_method=method)
+        return (signed_url, headers)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict[str, Any]] = None,
+        body: Optional[dict[str, Any]] = None,
+        media_sources: Optional[dict[str, bytes]] = None,
+    ) -> dict[str, Any]:
+        """Makes a request and returns the "response" part of Tumblr's answer
+        on success, or the whole answer (with "meta" and "errors") otherwise"""
+        url = str(URL(self.host + path).with_query(params or {}))
+        (signed_url, headers) = self.sign(method.upper(), url)
+
+        data: Optional[aiohttp.FormData] = None
+        if media_sources:
+            data = aiohttp.FormData()
+            data.add_field("json", json.dumps(body or {}), content_type="application/json")
+            for (index, (identifier, contents)) in enumerate(media_sources.items()):
+                data.add_field(identifier, contents, filename=str(index), content_type=media_type(contents))
+            body = None
+
+        endpoint = tumblr_endpoint(method, path)
+        with tracer.span(f"tumblr {endpoint}") as span:
+            started = self.limiter.clock()
+            await self.limiter.acquire("tumblr:api")
+            if span is not None:
+                span.set(waited=self.limiter.clock() - started, media=len(media_sources or {}))
+
+            session = self.open()
+            try:
+                async with session.request(
+                    method, URL(signed_url, encoded=True), headers=headers, json=body, data=data, allow_redirects=False
+                ) as resp:
+                    parsed = parse_tumblr_headers(resp.headers, self.limiter.clock())
+                    if parsed is not None:
+                        self.limiter.update("tumblr:api", *parsed)
+
+                    try:
+                        result = await resp.json(content_type=None)
+                    except ValueError:
+                        result = None
+
+                    if not isinstance(result, dict) or "meta" not in result:
+                        result = {
+                            "meta": {"status": resp.status, "msg": resp.reason},
+                            "response": {"error": "API response could not be JSON parsed"},
+                        }
+            except Exception:
+                API_CALLS.inc(api="tumblr", endpoint=endpoint, status="error")
+                API_ERRORS.inc(api="tumblr", endpoint=endpoint)
+                raise
+
+            API_CALLS.inc(api="tumblr", endpoint=endpoint, status=str(result["meta"]["status"]))
+            if span is not None:
+                span.set(status=result["meta"]["status"])
+
+        if 200 <= result["meta"]["status"] <= 399:
+            return result["response"]
+        else:
+            API_ERRORS.inc(api="tumblr", endpoint=endpoint)
+            logger.error(f"Tumblr returned {result['meta']} for {method.upper()} {path}")
+            return result
+
+    def remember_posts(self, response: dict[str, Any]) -> None:
+        for post in response.get("posts", []):
+            key = (post["blog"]["name"], int(post["id"]))
+            self.reblog_requirements[key] = (post["blog"]["uuid"], post["reblog_key"])
+
+    async def get_single_post(self, blogname: str, id: int) -> dict[str, Any]:
+        response = await self.request(
+            "get",
+            f"/v2/blog/{blog_hostname(blogname)}/posts",
+            params={"id": id, "npf": "true", "api_key": self.oauth.client_key},
+        )
+        self.remember_posts(response)
+        posts = response.get("posts")
+        return posts[0] if posts else response
+
+    async def create_post(
+        self,
+        blogname: str,
+        content: list[Any],
+        tags: Optional[list[str]] = None,
+        media_sources: Optional[dict[str, bytes]] = None,
+        **params: Any,
+    ) -> dict[str, Any]:
+        body = {"content": content, **params}
+        if tags:
+            body["tags"] = ",".join(tags)
+
+        return await self.request("post", f"/v2/blog/{blog_hostname(blogname)}/posts", body=body, media_sources=media_sources)
+
+    async def reblog_post(
+        self,
+        blogname: str,
+        parent_blogname: str,
+        id: Union[int, str],
+        content: Optional[list[Any]] = None,
+        tags: Optional[list[str]] = None,
+        media_sources: Optional[dict[str, bytes]] = None,
+        **params: Any,
+    ) -> dict[str, Any]:
+        key = (parent_blogname, int(id))
+        if key not in self.reblog_requirements:
+            await self.get_single_post(parent_blogname, int(id))
+        if key not in self.reblog_requirements:
+            logger.error(f"Could not find post {id} on {parent_blogname} to reblog")
+            return {"meta": {"status": 404, "msg": "Not Found"}, "errors": [f"Post {id} was not found"]}
+
+        (parent_uuid, reblog_key) = self.reblog_requirements[key]
+        body = {
+            "content": content or [],
+            "parent_tumblelog_uuid": parent_uuid,
+            "parent_post_id": str(id),
+            "reblog_key": reblog_key,
+            **params,
+        }
+        if tags:
+            body["tags"] = ",".join(tags)
+
+        return await self.request("post", f"/v2/blog/{blog_hostname(blogname)}/posts", body=body, media_sources=media_sources)
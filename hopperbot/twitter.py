@@ -1,12 +1,21 @@
 import logging
 import asyncio
+import math
+from time import time
 
-from typing import Optional, Any
-from tweepy import Response, StreamRule, Tweet, TweepyException
-from tweepy.asynchronous import AsyncStreamingClient
+from typing import Awaitable, Optional, Any
+from tweepy import Media, Response, StreamRule, Tweet, TweepyException, User
 
-from hopperbot.tumblr import TumblrPost
+from hopperbot.cache import LRUCache
+from hopperbot.capture import recorder
+from hopperbot.context import app
+from hopperbot.metrics import UPDATES_RECEIVED
+from hopperbot.ratelimit import RateLimitedClient, RateLimitedStreamingClient, backfill, limiter
+from hopperbot.rules import MAX_RULE_LEN, MAX_RULES, RULE_TAG, diff_rules
+from hopperbot.tracing import tracer
+from hopperbot.twitter_thread import EXPANSIONS, AuthoredTweet, MEDIA_FIELDS, TWEET_FIELDS, USER_FIELDS
 from hopperbot.twitter_update import TwitterUpdate
+from hopperbot.work_queue import WorkQueue
 
 tweepy_logger = logging.getLogger("tweepy")
 tweepy_logger.setLevel(logging.INFO)
@@ -14,17 +23,136 @@ tweepy_logger.setLevel(logging.INFO)
 logger = logging.getLogger("Twitter")
 logger.setLevel(logging.DEBUG)
 
-TWITTER_RULE_MAX_LEN = 512
+# Twitter backfills at most five minutes of tweets missed while the stream was
+# disconnected, and only for some access levels (see BACKFILL_ACCESS_LEVELS)
+BACKFILL_MAX_MINUTES = 5
 
+# The keys of the watermark in the state table, and how often (in seconds) the
+# time the stream was last seen alive is stored while only keep-alives come in
+WATERMARK_TWEET_ID = "stream_last_tweet_id"
+WATERMARK_SEEN_AT = "stream_last_seen_at"
+WATERMARK_INTERVAL = 60
 
-class TwitterListener(AsyncStreamingClient):
-    def __init__(self, queue: asyncio.Queue[TumblrPost], bearer_token: str) -> None:
+# How many recent tweet ids are remembered to drop tweets delivered twice
+SEEN_TWEETS_SIZE = 1024
+
+# Seconds between polls of the timelines of accounts that don't fit in the
+# stream rules, and how many users can be looked up at once
+POLL_INTERVAL = 60
+USERS_MAX_IDS = 100
+
+
+def included_media(tweet: Tweet, includes: dict[str, Any]) -> list[Media]:
+    """The media attached to a tweet, from the includes of a response"""
+    media_keys = (tweet.attachments or {}).get("media_keys", [])
+    return [item for item in includes.get("media", []) if isinstance(item, Media) and item.media_key in media_keys]
+
+
+def included_tweets(tweet: Tweet, includes: dict[str, Any]) -> list[AuthoredTweet]:
+    """The tweets `tweet` referenced (like the one it replied to), from the
+    includes of a response, if their authors were included as well"""
+    referenced_ids = {reference.id for reference in tweet.referenced_tweets or []}
+    users = {user.id: user for user in includes.get("users", []) if isinstance(user, User)}
+    return [
+        (included, users[included.author_id])
+        for included in includes.get("tweets", [])
+        if isinstance(included, Tweet) and included.id in referenced_ids and included.author_id in users
+    ]
+
+
+def referenced_media(tweet: Tweet, includes: dict[str, Any]) -> list[Media]:
+    """The media attached to the tweets `tweet` referenced, from the includes of a response"""
+    media: list[Media] = []
+    for (included, _) in included_tweets(tweet, includes):
+        media += included_media(included, includes)
+    return media
+
+
+def backfill_minutes(last_seen_at: Optional[float], now: float) -> Optional[int]:
+    """The minutes of backfill needed to get every tweet since `last_seen_at`"""
+    if last_seen_at is None:
+        return None
+    minutes = math.ceil((now - last_seen_at) / 60)
+    return max(1, min(minutes, BACKFILL_MAX_MINUTES))
+
+
+class TwitterListener(RateLimitedStreamingClient):
+    """Puts the tweets of the stream in the work queue.
+
+    How far the stream got is kept as a watermark: the newest tweet id, and
+    when the stream was last seen alive. With `backfill` (only allowed at the
+    academic access level), the tweets missed since then are asked for when
+    the stream (re)connects. Tweets newer than the watermark are new for sure,
+    older ones (from backfill) are checked against what was delivered before.
+    """
+
+    def __init__(self, queue: WorkQueue, bearer_token: str, backfill: bool = False) -> None:
         self.queue = queue
-        super().__init__(bearer_token)
+        self.backfill = backfill
+        # The parameters the stream connects with, tweepy uses the same
+        # dictionary when it reconnects, so backfill can be added to it
+        self.params: Optional[dict[str, Any]] = None
+        self.last_tweet_id: Optional[int] = None
+        self.last_seen_at: Optional[float] = None
+        self.stored_at = 0.0
+        self.seen: LRUCache[int, bool] = LRUCache(SEEN_TWEETS_SIZE)
+        self.rules_lock = asyncio.Lock()
+        super().__init__(limiter, bearer_token)
+
+    async def load_watermark(self) -> None:
+        """Reads how far the stream got before the last restart"""
+        last_tweet_id = await app.database.get_state(WATERMARK_TWEET_ID)
+        last_seen_at = await app.database.get_state(WATERMARK_SEEN_AT)
+        self.last_tweet_id = int(last_tweet_id) if last_tweet_id is not None else None
+        self.last_seen_at = float(last_seen_at) if last_seen_at is not None else None
+
+    async def store_watermark(self, tweet_id: Optional[int] = None) -> None:
+        now = time()
+        self.last_seen_at = now
+        if tweet_id is not None:
+            self.last_tweet_id = tweet_id if self.last_tweet_id is None else max(self.last_tweet_id, tweet_id)
+        elif now - self.stored_at < WATERMARK_INTERVAL:
+            return
+
+        self.stored_at = now
+        await app.database.set_state(WATERMARK_SEEN_AT, str(now))
+        if self.last_tweet_id is not None:
+            await app.database.set_state(WATERMARK_TWEET_ID, str(self.last_tweet_id))
+
+    async def delivered_before(self, tweet_id: int) -> bool:
+        """Whether a tweet was seen or even posted already, which can only be
+        the case for tweets that are not newer than the watermark"""
+        if self.last_tweet_id is None or tweet_id > self.last_tweet_id:
+            return False
+        return bool(self.seen.get(tweet_id)) or await app.database.get_tweet(tweet_id) is not None
+
+    def request_backfill(self) -> None:
+        """Asks for the tweets since the stream was last seen alive, the next
+        time it connects"""
+        minutes = backfill_minutes(self.last_seen_at, time())
+        if not self.backfill or self.params is None or minutes is None:
+            return
+        self.params["backfill_minutes"] = minutes
+        logger.info(f"Asking for {minutes} minutes of backfill when reconnecting")
 
     async def on_connect(self) -> None:
         logger.info("Twitter Listener is connected")
 
+    async def on_keep_alive(self) -> None:
+        await self.store_watermark()
+
+    async def on_closed(self, resp: Any) -> None:
+        logger.error("Stream connection closed by Twitter")
+        self.request_backfill()
+
+    async def on_connection_error(self) -> None:
+        logger.error("Stream connection has errored or timed out")
+        self.request_backfill()
+
+    async def on_request_error(self, status_code: int) -> None:
+        logger.error(f"Stream encountered HTTP error: {status_code}")
+        self.request_backfill()
+
     def filter(self, tg: Optional[asyncio.TaskGroup] = None, **params: Any) -> asyncio.Task[None]:
         # This one is copied excactly from AsyncStreamingClient, except that this one
         # allows this to be connected to a task group
@@ -43,6 +171,13 @@ class TwitterListener(AsyncStreamingClient):
             )
         )
 
+        # Catch up on whatever was missed since the last time the stream ran
+        minutes = backfill_minutes(self.last_seen_at, time())
+        if self.backfill and minutes is not None and "backfill_minutes" not in params:
+            params["backfill_minutes"] = minutes
+            logger.info(f"Asking for {minutes} minutes of backfill, last tweet seen was {self.last_tweet_id}")
+        self.params = params
+
         if tg is None:
             self.task = asyncio.create_task(
                 self._connect("GET", endpoint, params=params)
@@ -54,33 +189,11 @@ class TwitterListener(AsyncStreamingClient):
         # Use name parameter when support for Python 3.7 is dropped
         return self.task
 
-    async def reset_rules(self) -> None:
-        get_response = await self.get_rules()
-        if not isinstance(get_response, Response):
-            logger.error("Trying to get rules did not return a Response somehow")
-            return
-
-        data: list[StreamRule]
-        (data, _, errors, _) = get_response
-        if errors:
-            for error in errors:
-                logger.error(f'Trying to get rules returned an error: "{error}"')
-            return
-        if data is None:
-            logger.error('Trying to get rules returned "None" as data')
-            return
-
-        delete_response = await self.delete_rules(data)
-        if not isinstance(delete_response, Response):
-            logger.error("Trying to delete rules did not return a Response somehow")
-            return
-        if errors:
-            for error in errors:
-                logger.error(f'Trying to delete rules returned an error: "{error}"')
-            return
-
-        for rule in data:
-            logger.debug(f'Deleted rule: "{rule.value}"')
+    async def on_data(self, raw_data: Any) -> None:
+        # The line is recorded before tweepy parses it, so that a replay goes
+        # through exactly the same parsing
+        recorder.record_stream(raw_data)
+        await super().on_data(raw_data)
 
     async def on_response(self, response: Response) -> None:
         tweet: Tweet
@@ -102,45 +215,186 @@ class TwitterListener(AsyncStreamingClient):
             logger.error("Got send a response, but first included user did not have a username")
             return
 
-        update = TwitterUpdate(username, tweet)
+        if await self.delivered_before(tweet.id):
+            logger.debug(f"Dropped tweet {tweet.id}, it was delivered before")
+            return
+        self.seen.put(tweet.id, True)
 
-        await self.queue.put(update)
+        # The author and media are needed to render the tweet from a template
+        author = next((user for user in users if isinstance(user, User) and user.id == tweet.author_id), None)
+        update = TwitterUpdate(
+            username,
+            tweet,
+            author,
+            included_media(tweet, includes),
+            included_tweets(tweet, includes),
+            referenced_media(tweet, includes),
+        )
+
+        # A tweet older than the watermark that was not delivered before was missed, and comes from backfill
+        update.backfilled = self.last_tweet_id is not None and tweet.id <= self.last_tweet_id
+        with tracer.span("receive", update.trace_id, tweet_id=tweet.id, username=username, source="stream"):
+            await self.queue.put(update)
+            UPDATES_RECEIVED.inc(source="stream")
+            await self.store_watermark(tweet.id)
         logger.info(f'Produced update: "{str(update)}: {tweet.text}"')
 
-    async def add_usernames(self, usernames: list[str]) -> None:
-        if len(usernames) <= 21:
-            rule = StreamRule(" OR ".join(map(lambda x: "from:" + x, usernames)), "rule0")
-            response = await self.add_rules(rule)
-            if isinstance(response, Response):
-                for added_rule in response.data:
-                    logger.debug(f'Added rule: "{added_rule.value}"')
-            else:
-                logger.error("Adding rules did not return a Response somehow")
-        else:
-            next = usernames.pop()
+    async def sync_rules(
+        self, usernames: list[str], max_rules: int = MAX_RULES, max_len: int = MAX_RULE_LEN
+    ) -> list[str]:
+        """Changes the rules of the stream so that they match exactly the tweets
+        of `usernames`, with as few changes as possible. Can be called while
+        the stream is connected, rules take effect without reconnecting.
+
+        New rules are added before old ones are deleted, so that no tweets are
+        missed in between. If the new rules are not accepted, nothing changes.
+
+        Returns the usernames that did not fit in the rules of the stream
+        """
+        async with self.rules_lock:
+            get_response = await self.get_rules()
+            if not isinstance(get_response, Response):
+                logger.error("Trying to get rules did not return a Response somehow")
+                return []
+
+            (data, _, errors, _) = get_response
+            if errors:
+                for error in errors:
+                    logger.error(f'Trying to get rules returned an error: "{error}"')
+                return []
+
+            diff = diff_rules(data or [], usernames, max_rules, max_len)
+            if diff.overflow:
+                logger.warning(f"{len(diff.overflow)} usernames did not fit in the stream rules: {diff.overflow}")
+            logger.info(f"Stream rules have room for {diff.headroom} more characters")
+            if not diff:
+                logger.info(f"Stream rules are up to date ({len(diff.keep)} rules)")
+                return diff.overflow
 
-            # Generate at most 5 rules with as many usernames as possible per rule
-            for i in range(5):
-                rule = "from:" + next
-                next = usernames.pop()
+            rules = [StreamRule(value, RULE_TAG) for value in diff.add]
+            if rules and not await self.change_rules(self.add_rules(rules, dry_run=True), "validate new rules"):
+                return diff.overflow
 
-                while next is not None and len(rule) + 9 + len(next) <= TWITTER_RULE_MAX_LEN:
-                    rule += " OR from:" + next
-                    next = usernames.pop()
+            # Only as many old rules are deleted first as needed to make room for the new ones
+            room = max(0, len(diff.keep) + len(diff.delete) + len(rules) - max_rules)
+            (delete_first, delete_after) = (diff.delete[:room], diff.delete[room:])
 
-                streamrule = StreamRule(rule, f"rule{i}")
+            if delete_first and not await self.change_rules(self.delete_rules(delete_first), "delete rules"):
+                return diff.overflow
+            if rules and not await self.change_rules(self.add_rules(rules), "add rules"):
+                return diff.overflow
+            if delete_after and not await self.change_rules(self.delete_rules(delete_after), "delete rules"):
+                return diff.overflow
+
+            for rule in delete_first + delete_after:
+                logger.debug(f'Deleted rule: "{rule.value}"')
+            for rule in rules:
+                logger.debug(f'Added rule: "{rule.value}"')
+            logger.info(f"Synchronised stream rules: {diff}")
+            return diff.overflow
+
+    async def change_rules(self, request: Awaitable[Any], action: str) -> bool:
+        """Awaits a request changing the rules, returns whether it succeeded"""
+        response = await request
+        if not isinstance(response, Response):
+            logger.error(f"Trying to {action} did not return a Response somehow")
+            return False
+
+        errors = response.errors
+        for error in errors:
+            logger.error(f'Trying to {action} returned an error: "{error}"')
+        return not errors
+
+
+class TimelinePoller:
+    """Polls the timelines of accounts that did not fit in the stream rules, so
+    that they are still tracked, if a little later. The polling is done at
+    backfill priority, so that it never holds up live updates.
+
+    The newest tweet seen of every account is kept in the state table, so that
+    after a restart polling picks up where it left off.
+    """
+
+    def __init__(self, queue: WorkQueue, api: RateLimitedClient, interval: float = POLL_INTERVAL) -> None:
+        self.queue = queue
+        self.api = api
+        self.interval = interval
+        self.usernames: list[str] = []
+        # Users by lowercase username, looked up once
+        self.users: dict[str, User] = {}
+
+    def track(self, usernames: list[str]) -> None:
+        if usernames:
+            logger.info(f"Polling the timelines of {len(usernames)} accounts")
+        self.usernames = list(usernames)
+
+    async def lookup_users(self) -> None:
+        missing = [username for username in self.usernames if username.lower() not in self.users]
+        for start in range(0, len(missing), USERS_MAX_IDS):
+            usernames = missing[start : start + USERS_MAX_IDS]
+            response = await self.api.get_users(usernames=usernames, user_fields=USER_FIELDS)
+            if not isinstance(response, Response):
+                logger.error("Looking up users did not return a Response somehow")
+                continue
+
+            for error in response.errors:
+                logger.error(f'Looking up users returned an error: "{error}"')
+            for user in response.data or []:
+                self.users[user.username.lower()] = user
+
+    async def poll(self, user: User) -> None:
+        key = f"timeline_since_{user.id}"
+        since_id = await app.database.get_state(key)
+        response = await self.api.get_users_tweets(
+            user.id,
+            since_id=since_id,
+            # The first poll only finds out where the timeline is now
+            max_results=100 if since_id is not None else 5,
+            expansions=EXPANSIONS,
+            media_fields=MEDIA_FIELDS,
+            tweet_fields=TWEET_FIELDS,
+            user_fields=USER_FIELDS,
+        )
+        if not isinstance(response, Response):
+            logger.error(f"Polling the timeline of {user.username} did not return a Response somehow")
+            return
 
-                response = await self.add_rules(streamrule)
+        includes: dict[str, Any]
+        (data, includes, errors, _) = response
+        for error in errors:
+            logger.error(f'Polling the timeline of {user.username} returned an error: "{error}"')
 
-                if isinstance(response, Response):
-                    for added_rule in response.data:
-                        logger.debug(f'Added rule: "{added_rule.value}"')
-                else:
-                    logger.error("Adding rules did not return a Response somehow")
+        tweets: list[Tweet] = sorted(data or [], key=lambda tweet: tweet.id)
+        if since_id is not None:
+            for tweet in tweets:
+                if await app.database.get_tweet(tweet.id) is not None:
+                    continue
+                update = TwitterUpdate(
+                    user.username,
+                    tweet,
+                    user,
+                    included_media(tweet, includes),
+                    included_tweets(tweet, includes),
+                    referenced_media(tweet, includes),
+                )
+                update.backfilled = True
+                with tracer.span("receive", update.trace_id, tweet_id=tweet.id, username=user.username, source="timeline"):
+                    await self.queue.put(update)
+                UPDATES_RECEIVED.inc(source="timeline")
+                logger.info(f'Produced update from timeline: "{str(update)}: {tweet.text}"')
 
-                if next is None:
-                    # if there are no more users to add, stop generating rules
-                    break
+        if tweets:
+            await app.database.set_state(key, str(tweets[-1].id))
 
-            if len(usernames) > 0:
-                logger.error(f"{len(usernames)} usernames did not fit in a rule, so were not added")
+    async def run(self) -> None:
+        with backfill():
+            while True:
+                try:
+                    await self.lookup_users()
+                    for username in self.usernames:
+                        user = self.users.get(username.lower())
+                        if user is not None:
+                            await self.poll(user)
+                except TweepyException as e:
+                    logger.error(f"Something went wrong polling timelines: {e}")
+                await asyncio.sleep(self.interval)
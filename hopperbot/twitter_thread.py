@@ -0,0 +1,284 @@
+import logging
+from time import time
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar, cast
+
+import aiohttp
+from tweepy import Media, ReferencedTweet, Response, Tweet, User
+from tweepy.asynchronous import AsyncClient as TwitterApi
+
+from hopperbot.cache import TTLCache
+from hopperbot.capture import recorder
+from hopperbot.database import AsyncDatabase
+from hopperbot.errors import NoReferencedTweetError, NoTweetError, TwitterError
+
+logger = logging.getLogger("Twitter")
+logger.setLevel(logging.DEBUG)
+
+# Asking for the authors of the referenced tweets as well means every lookup
+# also returns the tweets that were replied to, and who wrote them. The media
+# and the extra user fields are there so tweets can be rendered from a template
+EXPANSIONS = [
+    "author_id",
+    "in_reply_to_user_id",
+    "attachments.media_keys",
+    "referenced_tweets.id",
+    "referenced_tweets.id.author_id",
+    "referenced_tweets.id.attachments.media_keys",
+]
+TWEET_FIELDS = ["attachments", "author_id", "conversation_id", "created_at", "in_reply_to_user_id", "referenced_tweets"]
+USER_FIELDS = ["name", "username", "profile_image_url", "verified"]
+MEDIA_FIELDS = ["alt_text", "type", "url", "preview_image_url"]
+
+# The tweet lookup endpoint takes at most 100 ids, recent search returns at most 100 tweets per page
+LOOKUP_MAX_IDS = 100
+SEARCH_MAX_RESULTS = 100
+SEARCH_MAX_PAGES = 3
+
+# How many tweets are kept in memory, and for how many seconds fetched tweets are reused
+TWEET_CACHE_SIZE = 4096
+TWEET_CACHE_TTL = 3600
+
+# How many tweets are kept in the database at most, and how often (in seconds)
+# expired tweets and tweets beyond that are deleted from it
+TWEET_CACHE_ROWS = 50_000
+TWEET_CACHE_PRUNE_INTERVAL = 600
+
+T = TypeVar("T")
+
+AuthoredTweet = Tuple[Tweet, User]
+
+
+def get_replyee_id(tweet: Tweet) -> Optional[int]:
+    """Gets the id of the tweet the supplied tweet was replying to. Returns
+    None if the tweet didn't reply to anyone. If such a tweet should exist
+    but doesnt, the function throws a NoReferencedTweet exeption"""
+    if not tweet.in_reply_to_user_id:
+        return None
+
+    if not tweet.referenced_tweets:
+        logger.error(f"in_reply_to_user_id is set for tweet {tweet.id}, but no referenced_tweets exist")
+        raise NoReferencedTweetError
+
+    ref_tweet = next(filter(lambda t: t.type == "replied_to", tweet.referenced_tweets), None)
+    if ref_tweet is None:
+        logger.error(f"in_reply_to_user_id is set for tweet {tweet.id}, but no referenced_tweets exist")
+        raise NoReferencedTweetError
+
+    return cast(ReferencedTweet, ref_tweet).id
+
+
+class TweetCache:
+    """Keeps fetched tweets and their authors around, so that updates replying
+    in the same conversation don't fetch the same tweets again. Tweets are kept
+    in memory, and if a database is given, also stored in the tweet_cache table
+    so they survive a restart. Every `TWEET_CACHE_PRUNE_INTERVAL` seconds, a
+    put also deletes the tweets that expired from the database."""
+
+    def __init__(
+        self, maxsize: int = TWEET_CACHE_SIZE, ttl: float = TWEET_CACHE_TTL, database: Optional[AsyncDatabase] = None
+    ) -> None:
+        self.memory: TTLCache[int, AuthoredTweet] = TTLCache(maxsize, ttl)
+        # Media is only kept in memory, by media key
+        self.media: TTLCache[str, Media] = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.database = database
+        self.pruned_at = time()
+
+    async def get(self, tweet_id: int) -> Optional[AuthoredTweet]:
+        found = self.memory.get(tweet_id)
+        if found is not None or self.database is None:
+            return found
+
+        stored = await self.database.get_cached_tweet(tweet_id, self.ttl)
+        if stored is None:
+            return None
+
+        (tweet_data, author_data) = stored
+        found = (Tweet(tweet_data), User(author_data))
+        self.memory.put(tweet_id, found)
+        return found
+
+    async def put(self, tweets: dict[int, AuthoredTweet]) -> None:
+        for (tweet_id, found) in tweets.items():
+            self.memory.put(tweet_id, found)
+
+        if self.database is not None and tweets:
+            await self.database.cache_tweets(
+                [(tweet_id, tweet.data, author.data) for (tweet_id, (tweet, author)) in tweets.items()]
+            )
+            if time() - self.pruned_at >= TWEET_CACHE_PRUNE_INTERVAL:
+                self.pruned_at = time()
+                pruned = await self.database.prune_tweet_cache(self.ttl, TWEET_CACHE_ROWS)
+                logger.debug(f"Pruned {pruned} tweets from the tweet cache")
+
+    def put_media(self, media: list[Media]) -> None:
+        for item in media:
+            self.media.put(item.media_key, item)
+
+    def tweet_media(self, tweet: Tweet) -> Optional[list[Media]]:
+        """Gets the media attached to a tweet, or None if some of it is not known"""
+        keys = (tweet.attachments or {}).get("media_keys", [])
+        media = [self.media.get(key) for key in keys]
+        if any(item is None for item in media):
+            return None
+        return cast(list[Media], media)
+
+
+class ThreadResolver:
+    """Finds the tweets a tweet was (indirectly) replying to.
+
+    The tweets that came with the tweet (like the one it replied to, which the
+    stream includes) are used first. When the tweet that is missing is the
+    start of the conversation, it is looked up by itself, otherwise the thread
+    is deeper than that and the whole conversation is searched at once. Every
+    lookup also returns the tweet that was replied to, so a lookup resolves
+    two steps of the thread. The client session is kept open between requests.
+
+    Before asking the API, the resolver looks in its tweet cache. `requests`
+    counts the requests made, `saved` how often the cache answered where a
+    request would have been made otherwise.
+    """
+
+    def __init__(self, api: TwitterApi, cache: Optional[TweetCache] = None) -> None:
+        self.api = api
+        self.cache = cache if cache is not None else TweetCache()
+        self.requests = 0
+        self.saved = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "requests": self.requests,
+            "requests_saved": self.saved,
+            "cache_hits": self.cache.memory.hits,
+            "cache_misses": self.cache.memory.misses,
+        }
+
+    def open(self) -> None:
+        # Tweepy only reuses a session if one is set on the client, otherwise
+        # every request opens (and closes) a session of its own
+        if self.api.session is None or self.api.session.closed:
+            self.api.session = aiohttp.ClientSession()
+
+    async def close(self) -> None:
+        if self.api.session is not None:
+            await self.api.session.close()
+
+    def collect(self, response: Any, context: str) -> dict[int, AuthoredTweet]:
+        """Maps the ids of all tweets in a response (including the referenced
+        ones) to the tweet and its author"""
+        if not isinstance(response, Response):
+            logger.error(f"API did not return a Response while {context}")
+            raise TwitterError
+
+        includes: dict[str, Any]
+        (data, includes, errors, _) = response
+        for error in errors:
+            # Deleted or protected tweets show up as errors, but the other tweets are still fine
+            logger.warning(f"Error while {context}: {error}")
+
+        tweets = cast(list[Tweet], (data or []) + includes.get("tweets", []))
+        users = {user.id: user for user in cast(list[User], includes.get("users", []))}
+        self.cache.put_media(cast(list[Media], includes.get("media", [])))
+
+        found: dict[int, AuthoredTweet] = {}
+        for tweet in tweets:
+            author = users.get(tweet.author_id)
+            if author is None:
+                logger.warning(f"API did not return the author of tweet {tweet.id} while {context}")
+            else:
+                found[tweet.id] = (tweet, author)
+        return found
+
+    async def lookup(self, tweet_ids: list[int]) -> dict[int, AuthoredTweet]:
+        self.open()
+        found: dict[int, AuthoredTweet] = {}
+        for start in range(0, len(tweet_ids), LOOKUP_MAX_IDS):
+            ids = tweet_ids[start : start + LOOKUP_MAX_IDS]
+            self.requests += 1
+            response = await self.api.get_tweets(
+                ids=ids,
+                expansions=EXPANSIONS,
+                media_fields=MEDIA_FIELDS,
+                tweet_fields=TWEET_FIELDS,
+                user_fields=USER_FIELDS,
+            )
+            recorder.record_response("lookup", response)
+            found |= self.collect(response, f"looking up tweets {ids}")
+        await self.cache.put(found)
+        return found
+
+    async def search_conversation(self, conversation_id: int) -> dict[int, AuthoredTweet]:
+        """Finds the tweets of a conversation from the last seven days"""
+        self.open()
+        found: dict[int, AuthoredTweet] = {}
+        next_token: Optional[str] = None
+        for _ in range(SEARCH_MAX_PAGES):
+            self.requests += 1
+            response = await self.api.search_recent_tweets(
+                query=f"conversation_id:{conversation_id}",
+                max_results=SEARCH_MAX_RESULTS,
+                next_token=next_token,
+                expansions=EXPANSIONS,
+                media_fields=MEDIA_FIELDS,
+                tweet_fields=TWEET_FIELDS,
+                user_fields=USER_FIELDS,
+            )
+            recorder.record_response("search", response)
+            found |= self.collect(response, f"searching conversation {conversation_id}")
+
+            next_token = cast(Response, response).meta.get("next_token")
+            if next_token is None:
+                break
+        await self.cache.put(found)
+        return found
+
+    async def resolve(
+        self,
+        tweet: Tweet,
+        find_posted: Callable[[int], Awaitable[Optional[T]]],
+        included: Optional[list[AuthoredTweet]] = None,
+    ) -> Tuple[list[AuthoredTweet], Optional[T]]:
+        """Follows the replies up from `tweet`, until either the start of the
+        thread, or a tweet for which `find_posted` returns something. The
+        `included` tweets (that came with `tweet`) are not fetched again.
+
+        Returns the tweets that were replied to, newest first, and whatever
+        `find_posted` returned (None if it never returned anything). Raises a
+        TwitterError if the thread could not be fetched
+        """
+        known = {included_tweet.id: (included_tweet, author) for (included_tweet, author) in included or []}
+        if known:
+            await self.cache.put(known)
+        chain: list[AuthoredTweet] = []
+        searched = False
+
+        replyee_id = get_replyee_id(tweet)
+        while replyee_id is not None:
+            posted = await find_posted(replyee_id)
+            if posted is not None:
+                return (chain, posted)
+
+            if replyee_id not in known:
+                cached = await self.cache.get(replyee_id)
+                if cached is not None:
+                    known[replyee_id] = cached
+                    self.saved += 1
+
+            # The start of the conversation is looked up by itself, a search
+            # only pays off when the thread goes deeper than that
+            deep = tweet.conversation_id is not None and replyee_id != tweet.conversation_id
+            if replyee_id not in known and not searched and deep:
+                searched = True
+                known |= await self.search_conversation(tweet.conversation_id)
+
+            if replyee_id not in known:
+                known |= await self.lookup([replyee_id])
+
+            if replyee_id not in known:
+                logger.error(f"Tweet {replyee_id} in the thread of tweet {tweet.id} could not be fetched")
+                raise NoTweetError
+
+            chain.append(known[replyee_id])
+            replyee_id = get_replyee_id(known[replyee_id][0])
+
+        return (chain, None)
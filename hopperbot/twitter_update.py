@@ -1,21 +1,31 @@
 import logging
-from typing import Optional, cast, Any
+from contextlib import nullcontext
+from time import time
+from typing import Optional, Any, Tuple
 
-from tweepy import ReferencedTweet, Response, Tweet, User
-from tweepy.asynchronous import AsyncClient as TwitterApi
+from tweepy import Media, Tweet, User
 
-from hopperbot.database import database as db
-from hopperbot.renderer import Renderer
-from hopperbot.secrets import twitter_keys
+from hopperbot.context import app
+from hopperbot.renderer import RendererPool
 from hopperbot.tumblr import TumblrPost, Renderable, TumblrApi
-from hopperbot.errors import TwitterError, NoReferencedTweetError
+from hopperbot.errors import TwitterError
+from hopperbot.images import ImageProcessor
+from hopperbot.metrics import STAGE_SECONDS
+from hopperbot.ratelimit import backfill
+from hopperbot.template import Card, render_page
+from hopperbot.tracing import tracer
+from hopperbot.twitter_thread import AuthoredTweet, get_replyee_id
 
 logger = logging.getLogger("Twitter")
 logger.setLevel(logging.DEBUG)
 
+# Whether tweets are rendered from a local template when all their data is
+# known, instead of loading the conversation from twitter.com
+RENDER_FROM_TEMPLATE = True
+
 
 class TwitterRenderable(Renderable):
-    def __init__(self, url: str, ids: list[str], filename_prefix: str, thread: Optional[range] = None) -> None:
+    def __init__(self, url: str, ids: list[str], thread: Optional[range] = None) -> None:
         if thread is None:
             if not len(ids) == 1:
                 raise ValueError("Thread range and number of ids should be equal")
@@ -25,31 +35,131 @@ class TwitterRenderable(Renderable):
         self.url = url
         self.thread = thread
         self.ids = ids
-        self.filename_prefix = filename_prefix
 
-    def render(self, renderer: Renderer) -> dict[str, str]:
-        filenames = renderer.render_tweets(self.url, self.filename_prefix, self.thread)
-        return {id : filename for (id, filename) in zip(self.ids, filenames)}
+    async def render(self, renderers: RendererPool) -> dict[str, bytes]:
+        screenshots = await renderers.render_tweets_async(self.url, self.thread)
+        return {id: screenshot for (id, screenshot) in zip(self.ids, screenshots)}
+
+    def __str__(self) -> str:
+        return f"TwitterRenderable(url: {self.url}, ids: {self.ids}, thread: {self.thread}"
+
+
+class StatusRenderable(Renderable):
+    """Renders tweets from their own status pages, one page load per tweet"""
+
+    def __init__(self, urls: list[str], ids: list[str]) -> None:
+        if not len(urls) == len(ids):
+            raise ValueError("Number of urls and number of ids should be equal")
+
+        self.urls = urls
+        self.ids = ids
+
+    async def render(self, renderers: RendererPool) -> dict[str, bytes]:
+        screenshots = await renderers.render_statuses_async(self.urls)
+        return {id: screenshot for (id, screenshot) in zip(self.ids, screenshots)}
+
+    def __str__(self) -> str:
+        return f"StatusRenderable(urls: {self.urls}, ids: {self.ids})"
+
+
+class TemplateRenderable(Renderable):
+    """Renders tweets from data that was already fetched, all in one page load"""
+
+    def __init__(self, cards: list[Card], ids: list[str]) -> None:
+        if not len(cards) == len(ids):
+            raise ValueError("Number of tweets and number of ids should be equal")
+
+        self.cards = cards
+        self.ids = ids
+
+    async def render(self, renderers: RendererPool) -> dict[str, bytes]:
+        screenshots = await renderers.render_html_async(render_page(self.cards))
+        if not len(screenshots) == len(self.ids):
+            logger.error(f"Rendered {len(screenshots)} cards, but expected {len(self.ids)}")
+        return {id: screenshot for (id, screenshot) in zip(self.ids, screenshots)}
 
     def __str__(self) -> str:
-        return f"TwitterRenderable(url: {self.url}, ids: {self.ids}, filename_prefix: {self.filename_prefix}, thread: {self.thread}"
+        return f"TemplateRenderable(tweets: {[tweet.id for (tweet, _, _) in self.cards]}, ids: {self.ids})"
 
 
 class TwitterUpdate(TumblrPost):
 
     thread: range = range(0, 1)
     alt_texts: list[str]
-    conversation: set[int] = set()
-
-    def __init__(self, username: str, tweet: Tweet) -> None:
+    conversation: set[int]
+    cards: Optional[list[Card]]
+
+    def __init__(
+        self,
+        username: str,
+        tweet: Tweet,
+        author: Optional[User] = None,
+        media: Optional[list[Media]] = None,
+        referenced: Optional[list[AuthoredTweet]] = None,
+        referenced_media: Optional[list[Media]] = None,
+    ) -> None:
         self.tweet = tweet
+        self.author = author
+        self.media = media or []
+        # The tweets that came with this one (like the one it replied to), so they are not fetched again
+        self.referenced = referenced or []
+        self.referenced_media = referenced_media or []
+        # Whether the tweet was caught up on (from a timeline or stream backfill),
+        # its thread is then fetched after the API calls of live tweets
+        self.backfilled = False
+        self.conversation = set()
+        # The data to render the thread from a template, None if some of it is missing
+        self.cards = [(tweet, author, self.media)] if author is not None else None
         self.alt_texts = [f'Tweet by @{username}: {tweet.text}']
         self.url = f"https://twitter.com/{username}/status/{tweet.id}"
+        # The status page of every tweet in the thread, in the same order as the alt texts
+        self.statuses = [self.url]
         super().__init__(username)
+        self.received_at = time()
+
+    def route_keys(self) -> list[str]:
+        # Usernames can change, user ids can't
+        return [str(self.tweet.author_id)] + super().route_keys() if self.tweet.author_id else super().route_keys()
+
+    def to_job(self) -> Tuple[str, str, dict[str, Any]]:
+        payload = {
+            "username": self.identifier,
+            "tweet": self.tweet.data,
+            "author": self.author.data if self.author is not None else None,
+            "media": [item.data for item in self.media],
+            "referenced": [[tweet.data, author.data] for (tweet, author) in self.referenced],
+            "referenced_media": [item.data for item in self.referenced_media],
+            "backfilled": self.backfilled,
+            "received_at": self.received_at,
+            "trace_id": self.trace_id,
+        }
+        return (f"tweet:{self.tweet.id}", "tweet", payload)
+
+    @classmethod
+    def from_job(cls, payload: dict[str, Any]) -> "TwitterUpdate":
+        author = User(payload["author"]) if payload["author"] is not None else None
+        media = [Media(item) for item in payload["media"]]
+        referenced = [(Tweet(tweet), User(author)) for (tweet, author) in payload.get("referenced", [])]
+        referenced_media = [Media(item) for item in payload.get("referenced_media", [])]
+        update = cls(payload["username"], Tweet(payload["tweet"]), author, media, referenced, referenced_media)
+        # Latency is measured from when the tweet first came in, also when it was queued before a restart
+        update.received_at = payload.get("received_at", update.received_at)
+        update.trace_id = payload.get("trace_id", update.trace_id)
+        update.backfilled = payload.get("backfilled", False)
+        return update
+
+    def renderable(self, image_ids: list[str], thread: Optional[range] = None) -> Renderable:
+        if RENDER_FROM_TEMPLATE and self.cards is not None:
+            return TemplateRenderable(self.cards, image_ids)
+        elif thread is not None and thread.start > 0:
+            # Only the tweets after the ones that were posted before are
+            # rendered, so scrolling past those on the conversation page is skipped
+            return StatusRenderable(self.statuses, image_ids)
+        return TwitterRenderable(self.url, image_ids, thread)
 
     def add_tweet(self) -> None:
         image_id = f"image{len(self.content)}"
-        renderable = TwitterRenderable(self.url, [image_id], f"tweet-{len(self.content)}-")
+        renderable = self.renderable([image_id])
 
         self.renderables.append(renderable)
         self.add_image_block(image_id, self.alt_texts[0], self.url)
@@ -63,8 +173,9 @@ class TwitterUpdate(TumblrPost):
         image_ids = [f"image{index}" for index in range(start, start + len(self.thread))]
         # Here we need to copy image_ids because these lists are internaly mutable, calling image_ids.pop()
         # also removes an elment from the list that the renderable uses
-        renderable = TwitterRenderable(self.url, image_ids.copy(), f"tweet-{str(start)}", self.thread)
+        renderable = self.renderable(image_ids.copy(), self.thread)
         self.renderables.append(renderable)
+        self.add_stitch_group(image_ids.copy())
 
         last_image_id = image_ids.pop()
         last_alt_text = self.alt_texts.pop()
@@ -74,15 +185,15 @@ class TwitterUpdate(TumblrPost):
 
         self.add_image_block(last_image_id, last_alt_text, self.url)
 
-    def add_header(self) -> None:
-        person = db.get_person(self.tweet.author_id)
+    async def add_header(self) -> None:
+        person = await app.database.get_person(self.tweet.author_id)
         if person is None:
             logger.error(f"Author id {self.tweet.author_id} was not found in twitter data")
             self.add_text_block("Something went wrong with the bot and no header text could be generated :(")
             return
 
         if self.conversation:
-            possible_people = [db.get_person(id) for id in self.conversation]
+            possible_people = [await app.database.get_person(id) for id in self.conversation]
             # Note that people is using {} not [], so it is a set, meaning every name can only appear once
             people = {person.name for person in possible_people if person is not None}
 
@@ -103,99 +214,72 @@ class TwitterUpdate(TumblrPost):
         else:
             self.add_text_block(f"{person.name} posted on Twitter!")
 
-    def get_replyee_id(self, tweet: Tweet) -> Optional[int]:
-        """Gets the id of the tweet the supplied tweet was replying to. Returns
-        None if the tweet didn't reply to anyone. If such a tweet should exist
-        but doesnt, the function throws a NoReferencedTweet exeption"""
-        if not tweet.in_reply_to_user_id:
-            return None
-
-        if not tweet.referenced_tweets:
-            logger.error(f"in_reply_to_user_id is set for tweet {tweet.id}, but no referenced_tweets exist")
-            raise NoReferencedTweetError
-
-        ref_tweet = next(filter(lambda t: t.type == "replied_to", tweet.referenced_tweets))
-        ref_tweet = cast(ReferencedTweet, ref_tweet)
-        if ref_tweet is None:
-            logger.error(f"in_reply_to_user_id is set for tweet {tweet.id}, but no referenced_tweets exist")
-            raise NoReferencedTweetError
-
-        return ref_tweet.id
-
-    async def fetch_and_process_tweet(self, tweet_id: int) -> Tweet:
-        """Gets and returns the tweet in question and updates the conversation and alt texts
-        Raises a TwitterException if anything goes wrong
-        """
-        # Fetch tweet:
-        api = TwitterApi(**twitter_keys)
-        expansions = ["author_id", "in_reply_to_user_id", "referenced_tweets.id"]
-        response = await api.get_tweet(id=tweet_id, expansions=expansions)
-
-        # Error handling:
-        if not isinstance(response, Response):
-            logger.error(f"API did not return a Response while fetching tweet {tweet_id}")
-            raise TwitterError
-
-        includes: dict[str, Any]
-        tweet: Tweet
-        (tweet, includes, errors, _) = response
-        if errors:
-            for error in errors:
-                logger.error(f"Error while fetching tweet {tweet_id}: {error}")
-            raise TwitterError
-
-        users = includes.get("users")
-        if not users:
-            # This condition filters both for None and an empty list
-            logger.error(f"API did not return users while fetching tweet {tweet_id}")
-            raise TwitterError
-        users = cast(list[User], users)
-
-        author = users[0]
-
-        # Process the data that is not contained in the Tweet class:
+    def process_tweet(self, tweet: Tweet, author: User) -> None:
+        """Updates the conversation and alt texts with a tweet from the thread"""
         self.alt_texts.append(f'Tweet by @{author.username}: {tweet.text}')
+        self.statuses.append(f"https://twitter.com/{author.username}/status/{tweet.id}")
         self.conversation.add(author.id)
         self.thread = range(self.thread.start, self.thread.stop + 1)
 
-        return tweet
+        if self.cards is not None:
+            media = app.resolver.cache.tweet_media(tweet)
+            self.cards = self.cards + [(tweet, author, media)] if media is not None else None
 
     async def fetch_thread(self) -> None:
         try:
-            replyee_id = self.get_replyee_id(self.tweet)
-            if replyee_id is None:
-                self.add_header()
+            if get_replyee_id(self.tweet) is None:
+                await self.add_header()
                 self.add_tweet()
                 return
 
-            while replyee_id is not None:
-                potential_reblog = db.get_tweet(replyee_id)
-                if potential_reblog is None:
-                    replyee_tweet = await self.fetch_and_process_tweet(replyee_id)
-                    replyee_id = self.get_replyee_id(replyee_tweet)
-                else:
-                    (tweet_index, reblog_id, blogname) = potential_reblog
-                    self.thread = range(self.thread.start + tweet_index, self.thread.stop + tweet_index)
-                    self.reblog = (reblog_id, blogname)
-                    break
-
-            self.add_header()
+            app.resolver.cache.put_media(self.referenced_media)
+            with backfill() if self.backfilled else nullcontext():
+                (replyees, potential_reblog) = await app.resolver.resolve(
+                    self.tweet, app.database.get_tweet, self.referenced
+                )
+
+            for (replyee_tweet, author) in replyees:
+                self.process_tweet(replyee_tweet, author)
+
+            if potential_reblog is not None:
+                (tweet_index, reblog_id, blogname) = potential_reblog
+                self.thread = range(self.thread.start + tweet_index, self.thread.stop + tweet_index)
+                self.reblog = (reblog_id, blogname)
+
+            await self.add_header()
             self.alt_texts.reverse()
+            self.statuses.reverse()
+            if self.cards is not None:
+                self.cards.reverse()
             self.add_tweets()
         except TwitterError as e:
             logger.error(f"Something went wrong fetching the thread: {e}")
 
-    async def post(self, blogname: str, api: TumblrApi) -> dict[str, Any]:
-        await self.fetch_thread()
-
-        response = await super().post(blogname, api)
+    async def post(
+        self, blogname: str, api: TumblrApi, renderers: RendererPool, images: Optional[ImageProcessor] = None
+    ) -> dict[str, Any]:
+        # A post that failed after all, or a tweet that was delivered twice, might be
+        # posted again, but a tweet that is in the tweets table was already posted
+        posted = await app.database.get_tweet(self.tweet.id)
+        if posted is not None:
+            (_, reblog_id, posted_blogname) = posted
+            logger.info(f"Tweet {self.tweet.id} was already posted to {posted_blogname}, skipping it")
+            return {"id": reblog_id}
+
+        with STAGE_SECONDS.time(stage="fetch_thread"), tracer.span("fetch_thread") as span:
+            await self.fetch_thread()
+            if span is not None:
+                span.set(tweets=len(self.thread), reblog=self.reblog is not None)
+        self.reached("thread_fetched")
+
+        response = await super().post(blogname, api, renderers, images)
 
         errors = response.get("errors")
         post_id = response.get("id")
         if errors:
             logger.error(f"Tumblr response contained errors: {errors}")
         elif post_id:
-            db.add_tweet(self.tweet.id, self.thread.stop, post_id, blogname)
+            await app.database.add_tweet(self.tweet.id, self.thread.stop, post_id, blogname)
         else:
             logger.error("Tumblr response contained no errors, but also no post id")
 
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from typing import Any, Callable, Optional, Tuple, Union
+
+from hopperbot.database import AsyncDatabase
+from hopperbot.tumblr import TumblrPost
+
+logger = logging.getLogger("Queue")
+logger.setLevel(logging.DEBUG)
+
+# How often a job is tried before it is moved to the dead_jobs table
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry of a failed job, every next retry waits twice as long
+RETRY_BACKOFF = 30
+RETRY_MAX_BACKOFF = 3600
+
+# Seconds a job may be worked on before someone else may lease it, unless its
+# lease is renewed. Leases of posts that are still being worked on (which can
+# take long, when they wait for the rate limiter) are renewed this many times
+# per lease time
+LEASE_TIME = 600
+LEASE_RENEWALS = 3
+
+# Seconds between looking for jobs that became available again, when waiting
+POLL_INTERVAL = 1.0
+
+Decoder = Callable[[dict[str, Any]], TumblrPost]
+
+
+def retry_delay(attempts: int, backoff: float = RETRY_BACKOFF, max_backoff: float = RETRY_MAX_BACKOFF) -> float:
+    """Exponential backoff, `attempts` is how often the job was tried so far"""
+    return min(backoff * 2 ** (attempts - 1), max_backoff)
+
+
+class DurableQueue:
+    """A work queue of posts that is kept in the database, so that queued posts
+    survive restarts and crashes.
+
+    Posts are stored as jobs using `TumblrPost.to_job`, and turned back into
+    posts by the decoder for their kind. `get` leases a job, which is then
+    finished with `done`: a job that succeeded is removed, a job that failed is
+    retried with exponential backoff, until it has been tried `max_attempts`
+    times and is moved to the dead_jobs table.
+
+    Jobs are keyed by what they post (for tweets, the tweet id), so the same
+    post is never queued twice. While `renew_leases` runs, the leases of posts
+    that are still being worked on are kept from expiring.
+
+    A job that is retried goes back in line after its backoff, so it is
+    posted after the posts to the same blog that were queued behind it. A
+    reply in a thread whose earlier post is being retried is then posted with
+    the whole thread instead of as a reblog of that post.
+    """
+
+    def __init__(
+        self,
+        database: AsyncDatabase,
+        decoders: dict[str, Decoder],
+        max_attempts: int = MAX_ATTEMPTS,
+        backoff: float = RETRY_BACKOFF,
+        max_backoff: float = RETRY_MAX_BACKOFF,
+        lease_time: float = LEASE_TIME,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        self.database = database
+        self.decoders = decoders
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+        self.added = asyncio.Event()
+        # The key and number of attempts of every post that is leased right now
+        self.leased: dict[TumblrPost, Tuple[str, int]] = {}
+
+    async def recover(self) -> int:
+        """Makes the jobs that were leased when the process stopped available
+        again, should be called once at startup"""
+        released = await self.database.release_jobs()
+        (jobs, dead_jobs) = await self.database.count_jobs()
+        logger.info(f"Resuming {jobs} queued jobs, {released} of which were interrupted ({dead_jobs} dead jobs)")
+        return released
+
+    async def put(self, post: TumblrPost) -> bool:
+        """Stores a post in the queue, returns False if it already was queued"""
+        (key, kind, payload) = post.to_job()
+        added = await self.database.enqueue_job(key, kind, payload)
+        if added:
+            self.added.set()
+        else:
+            logger.debug(f"Job {key} was already queued")
+        return added
+
+    async def get(self) -> TumblrPost:
+        """Leases the oldest available job, waiting for one if there is none"""
+        while True:
+            self.added.clear()
+            job = await self.database.lease_job(self.lease_time)
+            if job is not None:
+                (key, kind, payload, attempts) = job
+                decoder = self.decoders.get(kind)
+                if decoder is None:
+                    logger.error(f"No decoder for job {key} of kind {kind}")
+                    await self.database.bury_job(key, f"Unknown kind: {kind}")
+                    continue
+
+                try:
+                    post = decoder(payload)
+                except Exception as e:
+                    logger.exception(f"Could not decode job {key}")
+                    await self.database.bury_job(key, repr(e))
+                    continue
+
+                self.leased[post] = (key, attempts)
+                return post
+
+            # Failed jobs become available again after their backoff, so the
+            # database is checked every now and then even if nothing was added
+            try:
+                await asyncio.wait_for(self.added.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+
+    async def renew_leases(self) -> None:
+        """Renews the leases of the posts that are leased right now, every so
+        often, until cancelled"""
+        while True:
+            await asyncio.sleep(self.lease_time / LEASE_RENEWALS)
+            keys = [key for (key, _) in self.leased.values()]
+            if keys:
+                await self.database.renew_jobs(keys, self.lease_time)
+
+    async def done(self, post: TumblrPost, error: Optional[str] = None) -> None:
+        """Finishes the job of a post that was leased, `error` describes what
+        went wrong if posting failed"""
+        leased = self.leased.pop(post, None)
+        if leased is None:
+            logger.error(f"Post {post} was finished, but was not leased from the queue")
+            return
+
+        (key, attempts) = leased
+        if error is None:
+            await self.database.ack_job(key)
+        elif attempts >= self.max_attempts:
+            logger.error(f"Job {key} failed {attempts} times, giving up: {error}")
+            await self.database.bury_job(key, error)
+        else:
+            delay = retry_delay(attempts, self.backoff, self.max_backoff)
+            logger.warning(f"Job {key} failed (attempt {attempts}), retrying in {delay:.0f} seconds: {error}")
+            await self.database.retry_job(key, delay)
+
+
+# Either a queue that only lives in memory, or one that survives restarts
+WorkQueue = Union[asyncio.Queue[TumblrPost], DurableQueue]
@@ -2,83 +2,181 @@ import asyncio
 import logging
 import sys
 from asyncio import Queue, Task
-from typing import Union, cast
-
-import tomllib
-
+from typing import Optional
+
+from hopperbot.capture import recorder
+from hopperbot.config import ConfigWatcher, RoutingIndex
+from hopperbot.context import app
+from hopperbot.images import ImageProcessor
+from hopperbot.metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    PIPELINE_PENDING,
+    PIPELINE_WORKERS,
+    QUEUE_DEPTH,
+    RENDERS,
+    RENDER_SAVED_SECONDS,
+    RENDER_WAIT_SECONDS,
+    THREAD_REQUESTS_SAVED,
+    MetricsServer,
+    registry,
+)
+from hopperbot.pipeline import PostPipeline
+from hopperbot.ratelimit import RateLimitedClient, limiter
+from hopperbot.rules import ACCESS_LEVELS, BACKFILL_ACCESS_LEVELS
 from hopperbot.secrets import tumblr_keys, twitter_keys
-from hopperbot.tumblr import TumblrApi, TumblrPost
-from hopperbot.twitter import TwitterListener
+from hopperbot.tracing import tracer
+from hopperbot.tumblr import TumblrApi
+from hopperbot.twitter import TimelinePoller, TwitterListener
+from hopperbot.twitter_update import TwitterUpdate
+from hopperbot.work_queue import DurableQueue, WorkQueue
 
 CONFIG_FILENAME = "config.toml"
-CONFIG_CHANGED = True
+
+# Seconds between checks whether the config file changed
+CONFIG_POLL_INTERVAL = 5.0
+
+# The access level of the Twitter API keys, which decides how many accounts fit
+# in the stream rules (see hopperbot.rules.ACCESS_LEVELS), and whether tweets
+# missed while disconnected can be backfilled
+TWITTER_ACCESS_LEVEL = "essential"
+
+# Number of warm Chrome instances, and how many renders one does before it is
+# replaced by a fresh one
+RENDERER_POOL_SIZE = 2
+RENDERER_MAX_RENDERS = 50
+
+# How many posts are made at the same time, how many posts can be taken from
+# the queue before it starts filling up, and how many posts fit in the queue
+POST_CONCURRENCY = 4
+POST_MAX_PENDING = 16
+QUEUE_MAX_SIZE = 100
+
+# Whether the work queue is kept in the database, so that queued posts survive
+# restarts (the size limit above only applies to the queue in memory)
+QUEUE_DURABLE = True
+
+# How screenshots are shrunk before they are uploaded: the format ("PNG",
+# "WEBP" or "JPEG"), the quality of WEBP and JPEG images, the number of colours
+# to quantize PNG images to (None keeps them lossless), and how many processes
+# to use (None processes the images on threads)
+IMAGE_FORMAT = "PNG"
+IMAGE_QUALITY = 85
+IMAGE_COLORS = None
+IMAGE_PROCESSES = None
+
+# Whether the screenshots of a thread are stitched into a few tall images
+IMAGE_STITCH = False
+
+# Whether to load all known people into memory at startup
+PRELOAD_PEOPLE = True
+
+# Where the metrics are served for Prometheus to scrape (on /metrics), a port
+# of None turns the metrics server off
+METRICS_HOST = "localhost"
+METRICS_PORT: Optional[int] = 9108
+
+# Where the timed spans of every update are written, for example "trace.jsonl",
+# read it with "python -m hopperbot.tracing trace.jsonl [trace id]". The file
+# is appended to and never rotated, so tracing is off (None) unless needed
+TRACE_FILENAME: Optional[str] = None
+
+# Where what the stream sends and the threads fetched for it are recorded, for
+# example "capture.jsonl.gz", replay it with "python -m benchmarks.replay
+# capture.jsonl.gz". Like the trace file it is never rotated, so it is off
+# (None) unless traffic is being captured for load testing
+CAPTURE_FILENAME: Optional[str] = None
 
 logger = logging.getLogger("Main")
 logger.setLevel(logging.DEBUG)
 
 
-def initialise_identifiers(filename: str) -> dict[str, str]:
-    with open(filename, "rb") as f:
-        data: dict[str, list[dict[str, Union[str, list[dict[str, str]]]]]] = tomllib.load(f)
-
-    if data is None:
-        raise Exception("Reading config returned None")
-    else:
-        twitter_blognames = {
-            k: v
-            for d in [
-                {
-                    cast(str, twitter_update.get("username")).lower(): cast(str, update.get("blogname"))
-                    for twitter_update in cast(list[dict[str, str]], update.get("Twitter", []))
-                }
-                for update in data.get("Update", [])
-            ]
-            for k, v in d.items()
-        }
-        logging.debug(f"Initalized twitter_blognames: {twitter_blognames}")
+async def setup_twitter(queue: WorkQueue, config: ConfigWatcher, tg: asyncio.TaskGroup) -> Task[None]:
 
-        return twitter_blognames
+    backfill = TWITTER_ACCESS_LEVEL in BACKFILL_ACCESS_LEVELS
+    twitter_client = TwitterListener(queue, **twitter_keys, backfill=backfill)
+    await twitter_client.load_watermark()
 
+    poller = TimelinePoller(queue, RateLimitedClient(limiter, **twitter_keys))
 
-async def setup_twitter(queue: Queue[TumblrPost], usernames: list[str], tg: asyncio.TaskGroup) -> Task[None]:
+    # Only the rules that changed since the last run are added or deleted, the
+    # accounts that don't fit in the rules have their timelines polled instead
+    async def sync_rules(index: RoutingIndex) -> None:
+        (max_rules, max_len) = ACCESS_LEVELS[TWITTER_ACCESS_LEVEL]
+        overflow = await twitter_client.sync_rules(index.twitter_usernames, max_rules, max_len)
+        poller.track(overflow)
 
-    twitter_client = TwitterListener(queue, **twitter_keys)
-
-    if CONFIG_CHANGED and usernames:
-        await twitter_client.reset_rules()
-        await twitter_client.add_usernames(usernames)
+    await sync_rules(config.index)
+    config.subscribe(sync_rules)
+    tg.create_task(poller.run())
 
+    # The tweet that was replied to is included with its author and media, so
+    # the thread of a direct reply doesn't have to be fetched
     expansions = [
         "author_id",
         "in_reply_to_user_id",
         "attachments.media_keys",
         "referenced_tweets.id",
+        "referenced_tweets.id.author_id",
+        "referenced_tweets.id.attachments.media_keys",
     ]
 
-    media_fields = ["alt_text", "type", "url"]
+    media_fields = ["alt_text", "type", "url", "preview_image_url"]
+
+    # The conversation id lets the thread of a reply be fetched in one search,
+    # the attachments, creation date and user fields let tweets be rendered from a template
+    tweet_fields = ["attachments", "author_id", "conversation_id", "created_at", "in_reply_to_user_id", "referenced_tweets"]
+
+    user_fields = ["name", "username", "profile_image_url", "verified"]
 
     # AsyncStreamingClient.filter() returns a task, that is why the return type
     # is "Task[None]" and not "None"
-    return twitter_client.filter(tg=tg, expansions=expansions, media_fields=media_fields)
+    return twitter_client.filter(
+        tg=tg, expansions=expansions, media_fields=media_fields, tweet_fields=tweet_fields, user_fields=user_fields
+    )
 
 
-async def setup_tumblr(queue: Queue[TumblrPost], identifiers: dict[str, str]) -> None:
+async def setup_tumblr(queue: WorkQueue, config: ConfigWatcher) -> None:
     tumblr_api = TumblrApi(**tumblr_keys)
-
-    while True:
-        update_post = await queue.get()
-        if update_post.identifier is None:
-            logger.error("Update post had no identifier?")
-            blogname = "test37"
-        else:
-            blogname = identifiers.get(update_post.identifier, "test37")
-
-        if blogname is None:
-            logger.error("No blogname found?")
-            blogname = "test37"
-
-        await update_post.post(blogname, tumblr_api)
-        queue.task_done()
+    renderers = app.renderers
+    images = ImageProcessor(IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_COLORS, processes=IMAGE_PROCESSES, stitch=IMAGE_STITCH)
+    pipeline = PostPipeline(queue, config.index, tumblr_api, renderers, images, POST_CONCURRENCY, POST_MAX_PENDING)
+    config.subscribe(pipeline.update_routes)
+    PIPELINE_PENDING.set_function(lambda: pipeline.taken)
+    PIPELINE_WORKERS.set_function(lambda: len(pipeline.workers))
+    try:
+        await asyncio.to_thread(renderers.start)
+        await pipeline.run()
+    finally:
+        await asyncio.to_thread(images.close)
+        await tumblr_api.close()
+
+
+def setup_metrics(queue: WorkQueue) -> None:
+    # The caches count their own hits and misses
+    CACHE_HITS.set_function(lambda: app.resolver.cache.memory.hits, cache="tweets")
+    CACHE_MISSES.set_function(lambda: app.resolver.cache.memory.misses, cache="tweets")
+    THREAD_REQUESTS_SAVED.set_function(lambda: app.resolver.saved)
+    CACHE_HITS.set_function(lambda: app.database.database.people.hits, cache="people")
+    CACHE_MISSES.set_function(lambda: app.database.database.people.misses, cache="people")
+
+    # So does the renderer pool, over all its renderers
+    RENDERS.set_function(lambda: app.renderers.renders)
+    RENDER_WAIT_SECONDS.set_function(lambda: app.renderers.wait_time)
+    RENDER_SAVED_SECONDS.set_function(lambda: app.renderers.time_saved)
+
+    if isinstance(queue, DurableQueue):
+        durable_queue = queue
+
+        # Counting the jobs needs the database, so that is only done when the metrics are scraped
+        async def count_jobs() -> None:
+            (jobs, dead_jobs) = await durable_queue.database.count_jobs()
+            QUEUE_DEPTH.set(jobs, queue="work")
+            QUEUE_DEPTH.set(dead_jobs, queue="dead")
+
+        registry.add_refresher(count_jobs)
+    else:
+        QUEUE_DEPTH.set_function(queue.qsize, queue="work")
 
 
 def init_logging() -> None:
@@ -102,14 +200,49 @@ async def main() -> None:
 
     init_logging()
 
+    app.configure(renderer_pool_size=RENDERER_POOL_SIZE, renderer_max_renders=RENDERER_MAX_RENDERS)
+    if TRACE_FILENAME is not None:
+        tracer.open(TRACE_FILENAME)
+    if CAPTURE_FILENAME is not None:
+        recorder.open(CAPTURE_FILENAME)
+    try:
+        await run()
+    finally:
+        await app.close()
+        tracer.close()
+        recorder.close()
+
+
+async def run() -> None:
+
     # The work queue, things to update on are put in the queue, and when nothing
     # else is to be done, tumblr posts whatever is in the queue to tumblr
-    queue: Queue[TumblrPost] = Queue()
-    identifiers = initialise_identifiers(CONFIG_FILENAME)
-
-    async with asyncio.TaskGroup() as tg:
-        tg.create_task(setup_tumblr(queue, identifiers))
-        await setup_twitter(queue, list(identifiers.keys()), tg)
+    queue: WorkQueue
+    if QUEUE_DURABLE:
+        queue = DurableQueue(app.database, {"tweet": TwitterUpdate.from_job})
+        await queue.recover()
+    else:
+        queue = Queue(QUEUE_MAX_SIZE)
+
+    # Changes to the config are picked up while running, without restarting
+    config = ConfigWatcher(CONFIG_FILENAME, CONFIG_POLL_INTERVAL)
+
+    if PRELOAD_PEOPLE:
+        await app.database.preload_people()
+
+    setup_metrics(queue)
+    metrics = MetricsServer(registry, METRICS_HOST, METRICS_PORT) if METRICS_PORT is not None else None
+    if metrics is not None:
+        await metrics.setup()
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(setup_tumblr(queue, config))
+            await setup_twitter(queue, config, tg)
+            tg.create_task(config.run())
+    finally:
+        if metrics is not None:
+            await metrics.close()
 
 
 if __name__ == "__main__":
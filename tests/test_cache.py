@@ -0,0 +1,62 @@
+from hopperbot.cache import LRUCache, TTLCache
+
+
+def test_get_put():
+    cache = LRUCache(2)
+    cache.put(1, "one")
+
+    assert cache.get(1) == "one"
+    assert cache.get(2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(2)
+    cache.put(1, "one")
+    cache.put(2, "two")
+    cache.get(1)
+    cache.put(3, "three")
+
+    assert cache.get(2) is None
+    assert cache.get(1) == "one"
+    assert cache.get(3) == "three"
+    assert len(cache) == 2
+
+
+def test_invalidate():
+    cache = LRUCache(2)
+    cache.put(1, "one")
+    cache.invalidate(1)
+    cache.invalidate(2)
+
+    assert cache.get(1) is None
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_ttl_entries_expire():
+    clock = FakeClock()
+    cache = TTLCache(2, ttl=10, clock=clock)
+    cache.put(1, "one")
+    clock.now = 5
+    assert cache.get(1) == "one"
+
+    clock.now = 10
+    assert cache.get(1) is None
+    assert len(cache) == 0
+    assert cache.expires == {}
+
+
+def test_ttl_eviction_forgets_expiry():
+    cache = TTLCache(1, ttl=10)
+    cache.put(1, "one")
+    cache.put(2, "two")
+
+    assert cache.get(1) is None
+    assert list(cache.expires) == [2]
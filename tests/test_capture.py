@@ -0,0 +1,57 @@
+import gzip
+import json
+
+from tweepy import Media, Response, Tweet, User
+
+from hopperbot.capture import RESPONSE, STREAM, Recorder, read_capture, response_from_json, response_to_json
+
+TWEET = {"id": "2", "text": "A reply", "author_id": "10", "edit_history_tweet_ids": ["2"]}
+PARENT = {"id": "1", "text": "A tweet", "author_id": "10", "edit_history_tweet_ids": ["1"]}
+USER = {"id": "10", "name": "Someone", "username": "someone"}
+MEDIA = {"media_key": "3_1", "type": "photo", "url": "https://pbs.twimg.com/media/1.jpg"}
+
+
+def test_disabled_recorder_records_nothing():
+    recorder = Recorder()
+    recorder.record_stream(b'{"data": {}}')
+    recorder.record_response("lookup", Response(None, {}, [], {}))
+    assert not recorder.enabled
+
+
+def test_response_round_trip():
+    response = Response(
+        [Tweet(TWEET)], {"tweets": [Tweet(PARENT)], "users": [User(USER)], "media": [Media(MEDIA)]}, [], {"result_count": 1}
+    )
+    raw = response_to_json(response)
+    assert raw["data"] == [TWEET]
+    assert raw["includes"]["users"] == [USER]
+
+    (data, includes, errors, meta) = response_from_json(json.loads(json.dumps(raw)))
+    assert data == [Tweet(TWEET)]
+    assert includes["tweets"] == [Tweet(PARENT)]
+    assert includes["users"][0].username == "someone"
+    assert includes["media"][0].media_key == "3_1"
+    assert errors == [] and meta == {"result_count": 1}
+
+
+def test_record_and_read(tmp_path):
+    filename = str(tmp_path / "capture.jsonl.gz")
+    recorder = Recorder()
+    recorder.open(filename)
+    line = json.dumps({"data": TWEET, "includes": {"tweets": [PARENT], "users": [USER]}})
+    recorder.record_stream(line.encode())
+    recorder.record_response("lookup", Response(Tweet(PARENT), {"users": [User(USER)]}, [], {}))
+    # Not a response of the API, so there is nothing to record
+    recorder.record_response("search", None)
+    recorder.close()
+
+    records = list(read_capture(filename))
+    assert [record["kind"] for record in records] == [STREAM, RESPONSE]
+    assert records[0]["data"] == line
+    assert records[1]["request"] == "lookup"
+    assert records[1]["response"]["data"] == PARENT
+
+    # A capture cut off in the middle of a record is read up to where it ends
+    with gzip.open(filename, "at", encoding="utf-8") as file:
+        file.write('{"at": 1, "kind": "str')
+    assert len(list(read_capture(filename))) == 2
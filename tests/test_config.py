@@ -1,4 +1,10 @@
-from hopperbot.config import init_twitter_blognames
+import asyncio
+import shutil
+
+import pytest
+
+from hopperbot.config import ConfigWatcher, init_twitter_blognames, parse_config
+from hopperbot.errors import ConfigError
 
 
 def test_simple_good_config():
@@ -37,3 +43,78 @@ def test_no_twitter_config():
     correct_dict = {}
 
     assert genrated_dict == correct_dict
+
+
+def test_routing_index():
+    index = parse_config(
+        {
+            "fallback_blogname": "test37",
+            "Update": [
+                {
+                    "name": "Thomas",
+                    "blogname": "test38",
+                    "Twitter": [{"username": "Space_Stew", "id": 1478064563358740481}],
+                    "Youtube": [{"channel_id": "UCabcDEF"}],
+                }
+            ],
+        }
+    )
+
+    assert index.twitter_usernames == ["Space_Stew"]
+    assert index.blogname(["space_stew"]) == "test38"
+    assert index.blogname(["1478064563358740481", "renamed"]) == "test38"
+    assert index.blogname(["UCabcDEF"]) == "test38"
+    assert index.blogname(["someone_else"]) == "test37"
+
+
+def test_invalid_configs():
+    with pytest.raises(ConfigError):
+        parse_config({"Update": [{"name": "Thomas"}]})
+
+    with pytest.raises(ConfigError):
+        parse_config({"Update": [{"name": "Thomas", "blogname": "test37", "Twitter": [{"username": "not valid"}]}]})
+
+    with pytest.raises(ConfigError):
+        parse_config(
+            {
+                "Update": [
+                    {"name": "Thomas", "blogname": "test37", "Twitter": [{"username": "space_stew"}]},
+                    {"name": "Tommy", "blogname": "test38", "Twitter": [{"username": "Space_Stew"}]},
+                ]
+            }
+        )
+
+    # [Update.Twitter] instead of [[Update.Twitter]] makes a single table
+    with pytest.raises(ConfigError):
+        parse_config({"Update": [{"name": "Thomas", "blogname": "test37", "Twitter": {"username": "space_stew"}}]})
+
+    with pytest.raises(ConfigError):
+        parse_config({"Update": [{"name": "Thomas", "blogname": "test37", "Youtube": ["UC..."]}]})
+
+
+def test_watcher_reloads_changed_config(tmp_path):
+    path = tmp_path / "config.toml"
+    shutil.copy("tests/simple_good_config.toml", path)
+    watcher = ConfigWatcher(str(path))
+    reloaded = []
+
+    async def subscriber(index):
+        reloaded.append(index)
+
+    watcher.subscribe(subscriber)
+
+    assert not asyncio.run(watcher.check())
+
+    path.write_text(path.read_text().replace("test37", "test-38"))
+    assert asyncio.run(watcher.check())
+    assert reloaded[0].blogname(["space_stew"]) == "test-38"
+
+    # A broken config is ignored, the last good one stays
+    path.write_text("[[Update]\n")
+    assert not asyncio.run(watcher.check())
+    assert watcher.index is reloaded[0]
+
+    # So is a config that is valid TOML, but not shaped like a config
+    path.write_text('[[Update]]\nname = "Thomas"\nblogname = "test37"\n[Update.Twitter]\nusername = "space_stew"\n')
+    assert not asyncio.run(watcher.check())
+    assert watcher.index is reloaded[0]
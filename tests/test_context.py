@@ -0,0 +1,41 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hopperbot.context import AppContext
+
+
+def test_import_has_no_side_effects(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.run([sys.executable, "-c", "import hopperbot.twitter_update"], cwd=tmp_path, env=env, check=True)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_database_is_made_on_first_use(tmp_path):
+    filename = str(tmp_path / "context.db")
+    context = AppContext(database_filename=filename)
+
+    assert not os.path.exists(filename)
+    assert context.database is context.database
+    assert os.path.exists(filename)
+
+    asyncio.run(context.close())
+    assert context._database is None
+
+
+def test_configure_before_use(tmp_path):
+    context = AppContext()
+    context.configure(database_filename=str(tmp_path / "configured.db"), renderer_pool_size=3)
+
+    assert context.renderers.size == 3
+    with pytest.raises(RuntimeError):
+        context.configure(renderer_pool_size=1)
+    with pytest.raises(AttributeError):
+        AppContext().configure(renderer_size=1)
+
+    asyncio.run(context.close())
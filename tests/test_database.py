@@ -1,8 +1,9 @@
+import asyncio
 import os
 
 import pytest
 
-from hopperbot.database import Database
+from hopperbot.database import AsyncDatabase, Database
 from hopperbot.people import HE, THEY, Person
 
 
@@ -10,8 +11,10 @@ from hopperbot.people import HE, THEY, Person
 def database() -> Database:
     filename = "database.db"
     path = os.path.join("tests", filename)
-    if os.path.exists(path):
-        os.remove(path)
+    # Write ahead logging leaves two more files next to the database
+    for leftover in [path, path + "-wal", path + "-shm"]:
+        if os.path.exists(leftover):
+            os.remove(leftover)
     return Database(path)
 
 
@@ -50,3 +53,81 @@ def test_get_nonexistant_person(database: Database):
     result = database.get_person(not_twitter_id)
 
     assert result is None
+
+
+def test_database_uses_wal(database: Database):
+    (journal_mode,) = database.connection.execute("PRAGMA journal_mode").fetchone()
+
+    assert journal_mode == "wal"
+
+
+def test_async_database(database: Database):
+    async_database = AsyncDatabase(database)
+    person = Person("Thomas", [HE, THEY])
+    twitter_id = 1478064563358740481
+
+    async def add_and_get():
+        await async_database.add_person(twitter_id, person)
+        return await async_database.get_person(twitter_id)
+
+    result = asyncio.run(add_and_get())
+    async_database.close()
+
+    assert result == person
+
+
+def test_get_person_is_cached(database: Database):
+    person = Person("Thomas", [HE, THEY])
+    twitter_id = 1478064563358740481
+    database.add_person(twitter_id, person)
+
+    database.get_person(twitter_id)
+    result = database.get_person(twitter_id)
+
+    assert result == person
+    assert database.people.hits == 1
+
+
+def test_add_person_invalidates_cache(database: Database):
+    twitter_id = 1478064563358740481
+    database.people.put(twitter_id, Person("Tommy", [HE]))
+    person = Person("Thomas", [HE, THEY])
+
+    database.add_person(twitter_id, person)
+
+    assert database.get_person(twitter_id) == person
+
+
+def test_preload_people(database: Database):
+    database.add_person(1478064563358740481, Person("Thomas", [HE]))
+    database.add_person(1344189615134003201, Person("Ranboo", [HE, THEY]))
+
+    assert database.preload_people() == 2
+    assert database.get_person(1344189615134003201) == Person("Ranboo", [HE, THEY])
+    assert database.people.misses == 0
+
+
+def test_cache_get_tweet(database: Database):
+    tweet = {"id": "1587931744677744640", "text": "hello"}
+    author = {"id": "1478064563358740481", "username": "space_stew"}
+    database.cache_tweets([(1587931744677744640, tweet, author)])
+
+    assert database.get_cached_tweet(1587931744677744640, 60) == (tweet, author)
+    assert database.get_cached_tweet(1587931744677744640, 0) is None
+    assert database.prune_tweet_cache(0) == 1
+
+    # Beyond the row limit, the tweets fetched longest ago go first
+    for tweet_id in range(5):
+        database.cache_tweets([(tweet_id, tweet, author)])
+    assert database.prune_tweet_cache(60, max_rows=2) == 3
+    assert database.get_cached_tweet(4, 60) is not None
+    assert database.get_cached_tweet(2, 60) is None
+
+
+def test_state(database: Database):
+    assert database.get_state("stream_last_tweet_id") is None
+
+    database.set_state("stream_last_tweet_id", "1587931744677744640")
+    database.set_state("stream_last_tweet_id", "1588854790817165312")
+
+    assert database.get_state("stream_last_tweet_id") == "1588854790817165312"
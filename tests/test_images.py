@@ -0,0 +1,100 @@
+import asyncio
+import random
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+from hopperbot.images import ImageProcessor, crop_whitespace, media_type, process_image, stitch_images
+
+
+def screenshot(size=(400, 300), box=(100, 50, 200, 150), photo=False) -> bytes:
+    """A white image with a black box with a gradient in it, like a tweet with a
+    picture. A photo has noise in it, which PNG compresses worse than JPEG"""
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle(box, fill="black")
+    for x in range(box[0] + 10, box[2] - 10):
+        draw.line((x, box[1] + 10, x, box[3] - 10), fill=(x % 256, 100, 200))
+    if photo:
+        noise = random.Random(0)
+        for x in range(box[0] + 10, box[2] - 10):
+            for y in range(box[1] + 10, box[3] - 10, 2):
+                draw.point((x, y), fill=(x % 256, noise.randrange(256), 200))
+    output = BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+def open_image(data: bytes) -> Image.Image:
+    return Image.open(BytesIO(data))
+
+
+def test_media_type():
+    assert media_type(screenshot()) == "image/png"
+    assert media_type(b"\xff\xd8\xff\xe0") == "image/jpeg"
+    assert media_type(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+
+
+def test_crop_whitespace():
+    cropped = crop_whitespace(open_image(screenshot()))
+
+    assert cropped.size == (101, 101)
+
+
+@pytest.mark.parametrize("format", ["PNG", "WEBP", "JPEG"])
+def test_process_image_formats(format):
+    processed = process_image(screenshot(photo=True), format)
+
+    assert open_image(processed).format == format
+    assert open_image(processed).size == (101, 101)
+
+
+def test_process_image_quantizes():
+    processed = process_image(screenshot(), "PNG", colors=16)
+
+    assert open_image(processed).mode == "P"
+    assert len(processed) < len(screenshot())
+
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG"])
+def test_process_image_keeps_smaller_original(format):
+    output = BytesIO()
+    Image.new("RGB", (4, 4), "black").save(output, "PNG")
+    original = output.getvalue()
+
+    assert process_image(original, format) == original
+
+
+def test_process_image_unknown_format():
+    with pytest.raises(ValueError):
+        process_image(screenshot(), "BMP")
+
+
+def test_image_processor():
+    processor = ImageProcessor("WEBP")
+    media_sources = {"image0": screenshot(), "image1": screenshot((500, 500))}
+
+    processed = asyncio.run(processor.process(media_sources))
+
+    assert list(processed) == ["image0", "image1"]
+    assert all(media_type(data) == "image/webp" for data in processed.values())
+    assert processor.bytes_out < processor.bytes_in
+
+
+def test_stitch_images_by_height():
+    images = [screenshot((400, 300)) for _ in range(5)]
+
+    tiles = stitch_images(images, max_height=700)
+
+    assert [members for (_, members) in tiles] == [[0, 1], [2, 3], [4]]
+    assert open_image(tiles[0][0]).size == (400, 600)
+    assert tiles[2][0] == images[4]
+
+
+def test_stitch_images_by_size():
+    images = [screenshot((400, 300)) for _ in range(4)]
+
+    tiles = stitch_images(images, max_height=10000, max_bytes=len(images[0]) * 2)
+
+    assert [members for (_, members) in tiles] == [[0, 1], [2, 3]]
@@ -0,0 +1,105 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from hopperbot.metrics import Counter, Gauge, Histogram, MetricsServer, Registry, registry
+
+
+def test_counter():
+    counter = Counter("test_calls_total", "Calls", ("endpoint",))
+    counter.inc(endpoint="GET /a")
+    counter.inc(2, endpoint="GET /a")
+    counter.inc(endpoint="GET /b")
+
+    assert counter.get(endpoint="GET /a") == 3
+    assert counter.get(endpoint="GET /c") == 0
+    assert counter.render() == (
+        "# HELP test_calls_total Calls\n"
+        "# TYPE test_calls_total counter\n"
+        'test_calls_total{endpoint="GET /a"} 3\n'
+        'test_calls_total{endpoint="GET /b"} 1\n'
+    )
+
+    with pytest.raises(ValueError):
+        counter.inc(-1, endpoint="GET /a")
+    with pytest.raises(ValueError):
+        counter.inc(status="200")
+
+
+def test_gauge_function():
+    items = [1, 2, 3]
+    gauge = Gauge("test_items", "Items")
+    gauge.set_function(lambda: len(items))
+    assert "test_items 3\n" in gauge.render()
+
+    items.pop()
+    assert "test_items 2\n" in gauge.render()
+
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Seconds", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="render")
+    histogram.observe(0.5, stage="render")
+    histogram.observe(5, stage="render")
+
+    # Buckets are cumulative, and every observation ends up in +Inf
+    rendered = histogram.render()
+    assert 'test_seconds_bucket{stage="render",le="0.1"} 1\n' in rendered
+    assert 'test_seconds_bucket{stage="render",le="1"} 2\n' in rendered
+    assert 'test_seconds_bucket{stage="render",le="+Inf"} 3\n' in rendered
+    assert 'test_seconds_sum{stage="render"} 5.55\n' in rendered
+    assert 'test_seconds_count{stage="render"} 3\n' in rendered
+
+    with histogram.time(stage="upload"):
+        pass
+    assert histogram.count(stage="upload") == 1
+
+
+def test_label_escaping():
+    counter = Counter("test_total", "Test", ("value",))
+    counter.inc(value='say "hi"\\')
+    assert 'test_total{value="say \\"hi\\"\\\\"} 1' in counter.render()
+
+
+def test_registry():
+    test_registry = Registry()
+    gauge = test_registry.gauge("test_depth", "Depth")
+    test_registry.counter("test_total", "Total")
+
+    async def refresh():
+        gauge.set(7)
+
+    test_registry.add_refresher(refresh)
+    rendered = asyncio.run(test_registry.render())
+    assert "test_depth 7\n" in rendered
+    assert "# TYPE test_total counter\n" in rendered
+
+    with pytest.raises(ValueError):
+        test_registry.counter("test_total", "Total again")
+
+
+def test_hopperbot_metrics_are_registered():
+    assert "hopperbot_stage_seconds" in registry.metrics
+    assert "hopperbot_api_calls_total" in registry.metrics
+    assert "hopperbot_queue_depth" in registry.metrics
+
+
+def test_server():
+    test_registry = Registry()
+    test_registry.counter("test_total", "Total").inc()
+
+    async def scrape() -> tuple[str, str]:
+        server = MetricsServer(test_registry, "localhost", 0)
+        await server.setup()
+        try:
+            port = server.runner.addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://localhost:{port}/metrics") as resp:
+                    return (resp.headers["Content-Type"], await resp.text())
+        finally:
+            await server.close()
+
+    (content_type, body) = asyncio.run(scrape())
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "test_total 1\n" in body
@@ -0,0 +1,95 @@
+import asyncio
+
+from hopperbot.config import RoutingIndex
+from hopperbot.pipeline import PostPipeline
+
+
+class FakePost:
+    def __init__(self, identifier: str, name: str, log: list, delay: float = 0.01) -> None:
+        self.identifier = identifier
+        self.name = name
+        self.log = log
+        self.delay = delay
+
+    def route_keys(self):
+        return [self.identifier]
+
+    async def post(self, blogname, api, renderers, images=None):
+        self.log.append(("start", blogname, self.name))
+        await asyncio.sleep(self.delay)
+        self.log.append(("end", blogname, self.name))
+
+
+async def run_pipeline(posts, concurrency=4, fallback="test37") -> None:
+    queue = asyncio.Queue()
+    routes = RoutingIndex({"space_stew": "test37", "tapwaterthomas": "test38"}, fallback=fallback)
+    pipeline = PostPipeline(queue, routes, None, None, concurrency=concurrency)
+    for post in posts:
+        await queue.put(post)
+    task = asyncio.create_task(pipeline.run())
+    await queue.join()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_posts_to_same_blog_stay_in_order():
+    log = []
+    posts = [FakePost("space_stew", f"post{i}", log, delay=0.01 * (5 - i)) for i in range(5)]
+    asyncio.run(run_pipeline(posts))
+
+    ends = [name for (event, _, name) in log if event == "end"]
+    assert ends == [f"post{i}" for i in range(5)]
+
+
+def test_posts_to_different_blogs_overlap():
+    log = []
+    posts = [FakePost("space_stew", "a", log), FakePost("tapwaterthomas", "b", log)]
+    asyncio.run(run_pipeline(posts))
+
+    assert [event for (event, _, _) in log] == ["start", "start", "end", "end"]
+
+
+def test_concurrency_limit():
+    log = []
+    posts = [FakePost("space_stew", "a", log), FakePost("tapwaterthomas", "b", log)]
+    asyncio.run(run_pipeline(posts, concurrency=1))
+
+    assert [event for (event, _, _) in log] == ["start", "end", "start", "end"]
+
+
+def test_unknown_identifier_uses_fallback():
+    log = []
+    asyncio.run(run_pipeline([FakePost("someone_else", "a", log)]))
+
+    assert log[0] == ("start", "test37", "a")
+
+
+def test_unknown_identifier_without_fallback_is_dropped():
+    log = []
+    asyncio.run(run_pipeline([FakePost("someone_else", "a", log), FakePost("space_stew", "b", log)], fallback=None))
+
+    assert log == [("start", "test37", "b"), ("end", "test37", "b")]
+
+
+def test_drain_keeps_capacity_balanced():
+    log = []
+
+    async def drain() -> PostPipeline:
+        queue = asyncio.Queue()
+        routes = RoutingIndex({"space_stew": "test37"})
+        pipeline = PostPipeline(queue, routes, None, None, max_pending=2)
+        for i in range(5):
+            await queue.put(FakePost("space_stew", f"post{i}", log))
+        # Stopped once it took as many posts as it can, the rest is drained
+        task = asyncio.create_task(pipeline.run())
+        await asyncio.sleep(0)
+        assert pipeline.taken == 2
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return pipeline
+
+    pipeline = asyncio.run(drain())
+
+    assert [name for (event, _, name) in log if event == "end"] == [f"post{i}" for i in range(5)]
+    assert pipeline.taken == 0
+    assert pipeline.capacity._value == 2
@@ -0,0 +1,101 @@
+import asyncio
+
+from hopperbot.ratelimit import (
+    BACKFILL,
+    LIVE,
+    RateLimitedClient,
+    RateLimiter,
+    TokenBucket,
+    backfill,
+    parse_twitter_headers,
+    twitter_endpoint,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_bucket_refills_evenly():
+    clock = FakeClock()
+    bucket = TokenBucket(10, 100, clock)
+    for _ in range(10):
+        bucket.take()
+
+    assert bucket.delay() == 10
+    clock.now += 10
+    assert bucket.delay() == 0
+
+
+def test_bucket_follows_reported_limits():
+    clock = FakeClock()
+    bucket = TokenBucket(10, 100, clock)
+    bucket.update(300, 0, clock.now + 50)
+
+    assert bucket.delay() == 50
+    clock.now += 50
+    assert bucket.delay() == 0
+    assert bucket.tokens == 300
+
+
+def test_parse_twitter_headers():
+    headers = {"x-rate-limit-limit": "300", "x-rate-limit-remaining": "299", "x-rate-limit-reset": "1668000000"}
+
+    assert parse_twitter_headers(headers) == (300, 299, 1668000000.0)
+    assert parse_twitter_headers({}) is None
+
+
+def test_twitter_endpoint():
+    assert twitter_endpoint("GET", "/2/users/1478064563358740481/tweets") == "GET /2/users/:id/tweets"
+    assert twitter_endpoint("GET", "/2/tweets") == "GET /2/tweets"
+
+
+def test_live_calls_go_before_backfill():
+    limiter = RateLimiter({"test": (1, 0.05)})
+    order = []
+
+    async def call(name: str, call_priority: int) -> None:
+        await limiter.acquire("test", call_priority)
+        order.append(name)
+
+    async def run() -> None:
+        # Use up the only token, so the other calls have to queue
+        await limiter.acquire("test")
+        await asyncio.gather(call("backfill", BACKFILL), call("live", LIVE))
+
+    asyncio.run(run())
+
+    assert order == ["live", "backfill"]
+
+
+def test_backfill_context_sets_priority():
+    limiter = RateLimiter({"test": (1, 0.05)})
+    order = []
+
+    async def call(name: str) -> None:
+        await limiter.acquire("test")
+        order.append(name)
+
+    async def backfill_call() -> None:
+        with backfill():
+            await call("backfill")
+
+    async def run() -> None:
+        await limiter.acquire("test")
+        await asyncio.gather(backfill_call(), call("live"))
+
+    asyncio.run(run())
+
+    assert order == ["live", "backfill"]
+
+
+def test_rate_limited_client_keeps_limiter():
+    limiter = RateLimiter()
+    client = RateLimitedClient(limiter, bearer_token="token")
+
+    assert client.limiter is limiter
+    assert client.bearer_token == "token"
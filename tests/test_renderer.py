@@ -1,7 +1,14 @@
-from hopperbot.renderer import Renderer
+import asyncio
+import threading
+
+from hopperbot.renderer import Renderer, RendererPool
+from hopperbot.template import render_page
+from tweepy import Tweet, User
 from selenium.common.exceptions import NoSuchElementException
 import pytest
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 
 @pytest.fixture
 def renderer() -> Renderer:
@@ -10,67 +17,182 @@ def renderer() -> Renderer:
 
 def test_single_tweet(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1587931744677744640"
-    filename_prefix = "tests/test_single_tweet"
-    filenames = renderer.render_tweets(url, filename_prefix, range(0, 1))
+    screenshots = renderer.render_tweets(url, range(0, 1))
 
-    assert len(filenames) == 1
-    for filename in filenames:
-        print(f"Check manually if {filename} is rendered correctly")
+    assert len(screenshots) == 1
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
 
 
 def test_sinlge_reply(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1587931814156722178"
-    filename_prefix = "test/test_sinlge_reply"
-    filenames = renderer.render_tweets(url, filename_prefix, range(1, 2))
+    screenshots = renderer.render_tweets(url, range(1, 2))
 
-    assert len(filenames) == 1
-    for filename in filenames:
-        print(f"Check manually if {filename} is rendered correctly")
+    assert len(screenshots) == 1
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
 
 
 def test_two_tweets(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1587931814156722178"
-    filename_prefix = "tests/test_two_tweets"
-    filenames = renderer.render_tweets(url, filename_prefix, range(0, 2))
+    screenshots = renderer.render_tweets(url, range(0, 2))
 
-    assert len(filenames) == 2
-    for filename in filenames:
-        print(f"Check manually if {filename} is rendered correctly")
+    assert len(screenshots) == 2
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
 
 
 def test_long_thread(renderer: Renderer) -> None:
     url = "https://twitter.com/cuptoast/status/1551711157785751553"
-    filename_prefix = "tests/test_long_thread"
-    filenames = renderer.render_tweets(url, filename_prefix, range(0, 11))
+    screenshots = renderer.render_tweets(url, range(0, 11))
+
+    assert len(screenshots) == 11
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
+
+
+def test_statuses(renderer: Renderer) -> None:
+    urls = [
+        "https://twitter.com/space_stew/status/1587931744677744640",
+        "https://twitter.com/space_stew/status/1587931814156722178",
+    ]
+    screenshots = renderer.render_statuses(urls)
 
-    assert len(filenames) == 11
-    for filename in filenames:
-        print(f"Check manually if {filename} is rendered correctly")
+    assert len(screenshots) == 2
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
+
+
+def test_template_thread(renderer: Renderer) -> None:
+    author = User({"id": "1", "name": "Thomas", "username": "space_stew"})
+    tweets = [Tweet({"id": str(id), "text": f"tweet {id}", "edit_history_tweet_ids": [str(id)]}) for id in range(3)]
+    screenshots = renderer.render_html(render_page([(tweet, author, []) for tweet in tweets]))
+
+    assert len(screenshots) == 3
+    for screenshot in screenshots:
+        assert screenshot.startswith(PNG_SIGNATURE)
 
 
 def test_incorrect_range_start(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1588854790817165312"
-    filename_prefix = "tests/test_incorrect_range_start"
 
     with pytest.raises(ValueError) as e:
-        renderer.render_tweets(url, filename_prefix, range(-1, 1))
+        renderer.render_tweets(url, range(-1, 1))
 
     assert str(e.value) == "Thread range should have positive start"
 
 
 def test_incorrect_range_step(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1588854790817165312"
-    filename_prefix = "tests/test_incorrect_range_step"
 
     with pytest.raises(ValueError) as e:
-        renderer.render_tweets(url, filename_prefix, range(4, 0, -1))
+        renderer.render_tweets(url, range(4, 0, -1))
 
     assert str(e.value) == "Thread range should have positive step"
 
 
 def test_incorrect_range_stop(renderer: Renderer) -> None:
     url = "https://twitter.com/space_stew/status/1588854790817165312"
-    filename_prefix = "tests/test_incorrect_range_step"
 
     with pytest.raises(NoSuchElementException):
-        renderer.render_tweets(url, filename_prefix, range(1, 2))
+        renderer.render_tweets(url, range(1, 2))
+
+
+class FakeRenderer:
+    def __init__(self) -> None:
+        self.renders = 0
+        self.wait_time = 0.0
+        self.time_saved = 0.0
+        self.healthy = True
+        self.quit_called = False
+
+    def is_healthy(self) -> bool:
+        return self.healthy
+
+    def quit(self) -> None:
+        self.quit_called = True
+
+    def render_tweets(self, url, thread_range):
+        self.wait_time = 0.5
+        self.time_saved = 1.5
+        return [threading.current_thread().name]
+
+
+def test_pool_reuses_renderer() -> None:
+    pool = RendererPool(size=1, factory=FakeRenderer)
+    with pool.renderer() as first:
+        pass
+    with pool.renderer() as second:
+        pass
+
+    assert first is second
+    assert pool.launched == 1
+
+
+def test_pool_start_fills_pool() -> None:
+    pool = RendererPool(size=3, factory=FakeRenderer)
+    pool.start()
+
+    assert pool.launched == 3
+    assert pool.idle.qsize() == 3
+
+
+def test_pool_recycles_after_max_renders() -> None:
+    pool = RendererPool(size=1, max_renders=2, factory=FakeRenderer)
+    with pool.renderer() as first:
+        pass
+    with pool.renderer() as second:
+        pass
+    with pool.renderer() as third:
+        pass
+
+    assert first is second
+    assert third is not first
+    assert first.quit_called
+    assert pool.launched == 1
+
+
+def test_pool_replaces_unhealthy_renderer() -> None:
+    pool = RendererPool(size=1, factory=FakeRenderer)
+    with pool.renderer() as first:
+        first.healthy = False
+    with pool.renderer() as second:
+        pass
+
+    assert second is not first
+    assert first.quit_called
+    assert pool.launched == 1
+
+
+def test_pool_close_quits_idle_renderers() -> None:
+    pool = RendererPool(size=2, factory=FakeRenderer)
+    pool.start()
+    renderers = list(pool.idle.queue)
+    pool.close()
+
+    assert all(renderer.quit_called for renderer in renderers)
+    assert pool.launched == 0
+    with pytest.raises(RuntimeError):
+        pool.checkout()
+
+
+def test_pool_renders_off_event_loop() -> None:
+    pool = RendererPool(size=1, factory=FakeRenderer)
+    url = "https://twitter.com/space_stew/status/1587931744677744640"
+
+    thread_names = asyncio.run(pool.render_tweets_async(url, None))
+    pool.close()
+
+    assert thread_names[0] != threading.current_thread().name
+    assert thread_names[0].startswith("renderer")
+
+
+def test_pool_totals_wait_times() -> None:
+    pool = RendererPool(size=1, factory=FakeRenderer)
+    url = "https://twitter.com/space_stew/status/1587931744677744640"
+    pool.render_tweets(url, None)
+    pool.render_tweets(url, None)
+
+    assert pool.renders == 2
+    assert pool.wait_time == 1.0
+    assert pool.time_saved == 3.0
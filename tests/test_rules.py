@@ -0,0 +1,87 @@
+from tweepy import StreamRule
+
+from hopperbot.rules import diff_rules, pack_usernames, rule_usernames, rule_value
+
+
+def test_rule_usernames():
+    assert rule_usernames("from:space_stew OR from:TapWaterThomas") == {"space_stew", "tapwaterthomas"}
+    assert rule_usernames("from:space_stew") == {"space_stew"}
+    assert rule_usernames("cats OR from:space_stew") is None
+    assert rule_usernames("from:space_stew has:images") is None
+
+
+def test_pack_usernames():
+    (rules, overflow) = pack_usernames(["c", "a", "b"], 2, len("from:a OR from:b"))
+
+    assert rules == ["from:a OR from:b", "from:c"]
+    assert overflow == []
+
+    (rules, overflow) = pack_usernames(["c", "a", "b"], 1, len("from:a OR from:b"))
+
+    assert rules == ["from:a OR from:b"]
+    assert overflow == ["c"]
+
+
+def test_nothing_changed():
+    existing = [StreamRule(rule_value(["a", "b"]), "hopperbot", "1"), StreamRule(rule_value(["c"]), "hopperbot", "2")]
+    diff = diff_rules(existing, ["A", "b", "c"])
+
+    assert not diff
+    assert diff.keep == existing
+
+
+def test_only_changed_rules_are_replaced():
+    kept = StreamRule(rule_value(["a", "b"]), "hopperbot", "1")
+    removed = StreamRule(rule_value(["c", "d"]), "hopperbot", "2")
+    other = StreamRule("cats has:images", "someone", "3")
+    diff = diff_rules([kept, removed, other], ["a", "b", "c", "e"])
+
+    assert diff.keep == [kept]
+    assert diff.delete == [removed, other]
+    assert diff.add == [rule_value(["c", "e"])]
+
+
+def test_duplicate_rules_are_deleted():
+    first = StreamRule(rule_value(["a"]), "hopperbot", "1")
+    second = StreamRule(rule_value(["a"]), "hopperbot", "2")
+    diff = diff_rules([first, second], ["a"])
+
+    assert diff.keep == [first]
+    assert diff.delete == [second]
+    assert diff.add == []
+
+
+def test_packing_covers_the_most_usernames():
+    # Greedily packing in alphabetical order would put "bbbbbbbbbb" in the only rule
+    usernames = ["bbbbbbbbbb", "a", "c", "d"]
+    (rules, overflow) = pack_usernames(usernames, 1, len(rule_value(["a", "c", "d"])))
+
+    assert rules == [rule_value(["a", "c", "d"])]
+    assert overflow == ["bbbbbbbbbb"]
+
+
+def test_packing_fills_rules():
+    usernames = [f"user{index:0{index % 7 + 1}d}" for index in range(200)]
+    (rules, overflow) = pack_usernames(usernames, 5, 512)
+
+    assert all(len(rule) <= 512 for rule in rules)
+    assert len(rules) == 5
+    covered = set().union(*(rule_usernames(rule) for rule in rules))
+    assert len(covered) + len(overflow) == 200
+    assert max(len(username) for username in covered) <= min(len(username) for username in overflow)
+
+
+def test_headroom():
+    diff = diff_rules([], ["a", "b"], max_rules=2, max_len=100)
+
+    assert diff.add == [rule_value(["a", "b"])]
+    assert diff.headroom == (100 - len("from:a OR from:b")) + 100
+
+
+def test_repack_when_kept_rules_waste_room():
+    # Each of these rules has room for one more username, but none of them has room for "dd"
+    existing = [StreamRule(rule_value([name]), "hopperbot", str(index)) for (index, name) in enumerate(["a", "b"])]
+    diff = diff_rules(existing, ["a", "b", "c", "dd"], max_rules=2, max_len=len(rule_value(["a", "dd"])))
+
+    assert diff.overflow == []
+    assert len(diff.keep) + len(diff.add) == 2
@@ -0,0 +1,54 @@
+from tweepy import Media, Tweet, User
+
+from hopperbot.template import CARD_SELECTOR, render_card, render_page
+
+AUTHOR = User(
+    {
+        "id": "1",
+        "name": "Thomas <3",
+        "username": "space_stew",
+        "profile_image_url": "https://pbs.twimg.com/profile_images/1/thomas.jpg",
+        "verified": True,
+    }
+)
+
+
+def make_tweet(tweet_id: int, text: str, media_keys=None) -> Tweet:
+    data = {
+        "id": str(tweet_id),
+        "text": text,
+        "created_at": "2022-11-05T12:34:56.000Z",
+        "edit_history_tweet_ids": [str(tweet_id)],
+    }
+    if media_keys:
+        data["attachments"] = {"media_keys": media_keys}
+    return Tweet(data)
+
+
+def test_card_escapes_text():
+    card = render_card(make_tweet(1, "cats &amp; dogs <script>"), AUTHOR, [])
+
+    assert "cats &amp; dogs &lt;script&gt;" in card
+    assert "Thomas &lt;3" in card
+    assert "@space_stew" in card
+    assert "thomas.jpg" in card
+    assert "12:34 · Nov 5, 2022" in card
+
+
+def test_card_with_media():
+    photo = Media({"media_key": "3_1", "type": "photo", "url": "https://pbs.twimg.com/media/a.jpg", "alt_text": "a cat"})
+    video = Media({"media_key": "7_2", "type": "video", "preview_image_url": "https://pbs.twimg.com/media/b.jpg"})
+    card = render_card(make_tweet(1, "look https://t.co/abc123", ["3_1", "7_2"]), AUTHOR, [photo, video])
+
+    assert "t.co" not in card
+    assert 'src="https://pbs.twimg.com/media/a.jpg" alt="a cat"' in card
+    assert 'src="https://pbs.twimg.com/media/b.jpg"' in card
+
+
+def test_page_keeps_order():
+    tweets = [make_tweet(tweet_id, f"tweet {tweet_id}") for tweet_id in (3, 1, 2)]
+    page = render_page([(tweet, AUTHOR, []) for tweet in tweets])
+
+    assert page.count("<article") == 3
+    assert CARD_SELECTOR == "article.tweet"
+    assert page.index('data-id="3"') < page.index('data-id="1"') < page.index('data-id="2"')
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from hopperbot.tracing import Tracer, format_trace, load_spans, summarize
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    with tracer.span("post", "trace") as span:
+        assert span is None
+
+
+def test_spans(tmp_path):
+    filename = str(tmp_path / "trace.jsonl")
+    tracer = Tracer()
+    tracer.open(filename)
+
+    async def handle_update():
+        with tracer.span("post", "trace-1", blog="test37"):
+            with tracer.span("fetch_thread") as span:
+                span.set(tweets=3)
+            # Spans started in other tasks are part of the same trace
+            await asyncio.gather(render(), render())
+
+    async def render():
+        with tracer.span("render"):
+            await asyncio.sleep(0)
+
+    asyncio.run(handle_update())
+    with pytest.raises(ValueError):
+        with tracer.span("upload", "trace-2"):
+            raise ValueError("Tumblr is down")
+    tracer.close()
+
+    spans = load_spans(filename)
+    assert [span["name"] for span in spans] == ["fetch_thread", "render", "render", "post", "upload"]
+
+    post = spans[3]
+    assert post["trace_id"] == "trace-1"
+    assert post["parent_id"] is None
+    assert post["attributes"] == {"blog": "test37"}
+    for span in spans[:3]:
+        assert span["trace_id"] == "trace-1"
+        assert span["parent_id"] == post["span_id"]
+    assert spans[0]["attributes"] == {"tweets": 3}
+
+    upload = spans[4]
+    assert upload["trace_id"] == "trace-2"
+    assert upload["error"] == "ValueError('Tumblr is down')"
+
+    # The summary lists every kind of span, and a trace is shown as a tree
+    summary = summarize(spans)
+    assert "render" in summary and "upload" in summary
+    tree = format_trace(spans, "trace-1").splitlines()
+    assert len(tree) == 4
+    assert "post" in tree[0] and "  fetch_thread" in tree[1]
+
+
+def test_new_trace_without_parent(tmp_path):
+    tracer = Tracer()
+    tracer.open(str(tmp_path / "trace.jsonl"))
+    with tracer.span("twitter GET /2/tweets") as first:
+        pass
+    with tracer.span("twitter GET /2/tweets") as second:
+        pass
+    tracer.close()
+
+    assert first.trace_id != second.trace_id
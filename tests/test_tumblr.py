@@ -0,0 +1,56 @@
+import asyncio
+from io import BytesIO
+
+from PIL import Image
+
+from hopperbot.images import ImageProcessor
+from hopperbot.tumblr import TumblrPost, image_identifier
+
+
+def screenshot(color: str) -> bytes:
+    output = BytesIO()
+    Image.new("RGB", (400, 300), color).save(output, "PNG")
+    return output.getvalue()
+
+
+def thread_post() -> TumblrPost:
+    post = TumblrPost("space_stew")
+    post.add_text_block("Thomas posted on Twitter!")
+    for index in range(3):
+        post.add_image_block(f"image{index + 1}", f"Tweet {index}")
+        post.media_sources[f"image{index + 1}"] = screenshot(["red", "green", "blue"][index])
+    post.content[-1]["attribution"] = {"type": "link", "url": "https://twitter.com/space_stew/status/1"}
+    post.add_stitch_group(["image1", "image2", "image3"])
+    return post
+
+
+def test_posts_do_not_share_content():
+    first = TumblrPost("space_stew")
+    first.add_text_block("first")
+    second = TumblrPost("space_stew")
+
+    assert second.content == []
+
+
+def test_stitch_thread_into_one_tile():
+    post = thread_post()
+
+    asyncio.run(post.stitch_images(ImageProcessor(stitch=True)))
+
+    assert len(post.content) == 2
+    tile_block = post.content[1]
+    assert image_identifier(tile_block) == "image1"
+    assert tile_block["alt_text"] == "Tweet 0\n\nTweet 1\n\nTweet 2"
+    assert tile_block["attribution"]["url"] == "https://twitter.com/space_stew/status/1"
+    assert list(post.media_sources) == ["image1"]
+    assert Image.open(BytesIO(post.media_sources["image1"])).size == (400, 900)
+
+
+def test_stitch_thread_into_tiles():
+    post = thread_post()
+
+    asyncio.run(post.stitch_images(ImageProcessor(stitch=True, tile_height=600)))
+
+    assert [image_identifier(block) for block in post.content] == [None, "image1", "image3"]
+    assert "attribution" not in post.content[1]
+    assert post.content[2]["alt_text"] == "Tweet 2"
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+from hopperbot.ratelimit import RateLimiter
+from hopperbot.tumblr_client import TumblrApi, blog_hostname, tumblr_endpoint
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"0" * 16
+
+
+class FakeTumblr:
+    """A local stand in for the Tumblr API, that remembers what was posted"""
+
+    def __init__(self) -> None:
+        self.posts = []
+        self.authorizations = []
+
+    async def create(self, request: web.Request) -> web.Response:
+        self.authorizations.append(request.headers.get("Authorization", ""))
+        if request.content_type == "multipart/form-data":
+            parts = {}
+            async for part in await request.multipart():
+                parts[part.name] = (part.headers.get("Content-Type"), await part.read())
+            (_, body) = parts.pop("json")
+            self.posts.append((request.match_info["blog"], json.loads(body), parts))
+        else:
+            self.posts.append((request.match_info["blog"], await request.json(), {}))
+        response = {"meta": {"status": 201, "msg": "Created"}, "response": {"id": "1234", "state": "published"}}
+        return web.json_response(response, headers={"X-Ratelimit-Perhour-Remaining": "999", "X-Ratelimit-Perhour-Reset": "60"})
+
+    async def get(self, request: web.Request) -> web.Response:
+        post = {"id": request.query["id"], "reblog_key": "key", "blog": {"name": "test37", "uuid": "t:uuid"}}
+        return web.json_response({"meta": {"status": 200, "msg": "OK"}, "response": {"posts": [post]}})
+
+
+async def with_fake_tumblr(test) -> FakeTumblr:
+    fake = FakeTumblr()
+    app = web.Application()
+    app.add_routes([web.post("/v2/blog/{blog}/posts", fake.create), web.get("/v2/blog/{blog}/posts", fake.get)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "localhost", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    limiter = RateLimiter()
+    api = TumblrApi("consumer", "secret", "token", "token_secret", host=f"http://localhost:{port}", limiter=limiter)
+    try:
+        await test(api, limiter)
+    finally:
+        await api.close()
+        await runner.cleanup()
+    return fake
+
+
+def test_blog_hostname():
+    assert blog_hostname("test37") == "test37.tumblr.com"
+    assert blog_hostname("blog.example.com") == "blog.example.com"
+
+
+def test_create_post_with_media():
+    responses = []
+
+    async def test(api, limiter):
+        content = [{"type": "image", "media": [{"type": "image/png", "identifier": "image0"}]}]
+        responses.append(await api.create_post("test37", content, ["hopperbot"], {"image0": PNG}))
+        assert limiter.bucket("tumblr:api").tokens <= 999
+
+    fake = asyncio.run(with_fake_tumblr(test))
+
+    assert responses == [{"id": "1234", "state": "published"}]
+    (blog, body, parts) = fake.posts[0]
+    assert blog == "test37.tumblr.com"
+    assert body["tags"] == "hopperbot"
+    assert parts == {"image0": ("image/png", PNG)}
+    assert 'oauth_signature="' in fake.authorizations[0]
+
+
+def test_reblog_post_fetches_reblog_key():
+    async def test(api, limiter):
+        await api.reblog_post("test38", "test37", "699848368965533696", [{"type": "text", "text": "hi"}])
+
+    fake = asyncio.run(with_fake_tumblr(test))
+
+    (blog, body, _) = fake.posts[0]
+    assert blog == "test38.tumblr.com"
+    assert body["parent_tumblelog_uuid"] == "t:uuid"
+    assert body["parent_post_id"] == "699848368965533696"
+    assert body["reblog_key"] == "key"
+
+
+def test_tumblr_endpoint():
+    assert tumblr_endpoint("post", "/v2/blog/test37.tumblr.com/posts") == "POST /v2/blog/:blog/posts"
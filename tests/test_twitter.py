@@ -0,0 +1,73 @@
+import asyncio
+import json
+from typing import Iterator
+
+import pytest
+
+from hopperbot import twitter
+from hopperbot.context import AppContext
+from hopperbot.twitter import BACKFILL_MAX_MINUTES, TwitterListener, backfill_minutes
+
+USER = {"id": "1478064563358740481", "name": "Thomas", "username": "space_stew"}
+
+
+def payload(tweet_id: int) -> str:
+    tweet = {"id": str(tweet_id), "text": "hello", "author_id": USER["id"], "edit_history_tweet_ids": [str(tweet_id)]}
+    return json.dumps({"data": tweet, "includes": {"users": [USER]}})
+
+
+@pytest.fixture
+def context(tmp_path, monkeypatch) -> Iterator[AppContext]:
+    context = AppContext(database_filename=str(tmp_path / "twitter.db"))
+    monkeypatch.setattr(twitter, "app", context)
+    yield context
+    asyncio.run(context.close())
+
+
+def test_backfill_minutes():
+    assert backfill_minutes(None, 1000) is None
+    assert backfill_minutes(1000, 1010) == 1
+    assert backfill_minutes(1000, 1000 + 150) == 3
+    assert backfill_minutes(1000, 1000 + 3600) == BACKFILL_MAX_MINUTES
+
+
+def test_request_backfill():
+    listener = TwitterListener(asyncio.Queue(), "token", backfill=True)
+    listener.params = {}
+    listener.last_seen_at = None
+    listener.request_backfill()
+    assert "backfill_minutes" not in listener.params
+
+    listener.last_seen_at = 0
+    listener.request_backfill()
+    assert listener.params["backfill_minutes"] == BACKFILL_MAX_MINUTES
+
+    # Only some access levels can backfill, the others never ask for it
+    listener = TwitterListener(asyncio.Queue(), "token")
+    listener.params = {}
+    listener.last_seen_at = 0
+    listener.request_backfill()
+    assert "backfill_minutes" not in listener.params
+
+
+def test_duplicates_are_dropped(context):
+    queue = asyncio.Queue()
+    listener = TwitterListener(queue, "token")
+
+    async def deliver():
+        await listener.on_data(payload(2))
+        # Delivered twice, for example by backfill after a reconnect
+        await listener.on_data(payload(2))
+        # Posted before a restart, so only the database knows about it
+        await context.database.add_tweet(1, 1, 1234, "test37")
+        await listener.on_data(payload(1))
+        await listener.on_data(payload(4))
+        # Missed while disconnected, and delivered by backfill after a newer tweet
+        await listener.on_data(payload(3))
+
+    asyncio.run(deliver())
+
+    updates = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert [update.tweet.id for update in updates] == [2, 4, 3]
+    assert [update.backfilled for update in updates] == [False, False, True]
+    assert listener.last_tweet_id == 4
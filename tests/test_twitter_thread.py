@@ -0,0 +1,190 @@
+import asyncio
+
+import pytest
+from tweepy import Media, Response, Tweet, User
+
+from hopperbot.database import AsyncDatabase, Database
+from hopperbot.errors import NoTweetError
+from hopperbot.twitter_thread import ThreadResolver, TweetCache, get_replyee_id
+
+CONVERSATION_ID = 100
+AUTHOR = {"id": "1", "name": "Thomas", "username": "space_stew"}
+
+
+def make_tweet(tweet_id: int, replying_to=None) -> Tweet:
+    data = {
+        "id": str(tweet_id),
+        "text": f"tweet {tweet_id}",
+        "author_id": AUTHOR["id"],
+        "conversation_id": str(CONVERSATION_ID),
+        "edit_history_tweet_ids": [str(tweet_id)],
+    }
+    if replying_to is not None:
+        data["in_reply_to_user_id"] = AUTHOR["id"]
+        data["referenced_tweets"] = [{"type": "replied_to", "id": str(replying_to)}]
+    return Tweet(data)
+
+
+class FakeSession:
+    closed = False
+
+
+class FakeApi:
+    """Knows a thread where tweet n is a reply to tweet n - 1, starting at the conversation id"""
+
+    def __init__(self, length: int, searchable: bool = True) -> None:
+        self.session = FakeSession()
+        self.tweets = {
+            tweet_id: make_tweet(tweet_id, tweet_id - 1 if tweet_id > CONVERSATION_ID else None)
+            for tweet_id in range(CONVERSATION_ID, CONVERSATION_ID + length)
+        }
+        self.searchable = searchable
+        self.calls = []
+
+    def response(self, tweets) -> Response:
+        return Response(tweets, {"users": [User(AUTHOR)]}, [], {})
+
+    async def get_tweets(self, ids, **params):
+        self.calls.append(("lookup", ids))
+        return self.response([self.tweets[tweet_id] for tweet_id in ids if tweet_id in self.tweets])
+
+    async def search_recent_tweets(self, query, **params):
+        self.calls.append(("search", query))
+        # Like the real search, the conversation root itself is not returned
+        tweets = [tweet for tweet_id, tweet in self.tweets.items() if tweet_id != CONVERSATION_ID]
+        return self.response(tweets if self.searchable else None)
+
+
+async def never_posted(tweet_id: int):
+    return None
+
+
+def test_get_replyee_id():
+    assert get_replyee_id(make_tweet(101, 100)) == 100
+    assert get_replyee_id(make_tweet(100)) is None
+
+
+def test_resolve_long_thread_in_few_requests():
+    api = FakeApi(20)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 20, CONVERSATION_ID + 19)
+
+    (replyees, posted) = asyncio.run(resolver.resolve(tweet, never_posted))
+
+    assert [replyee.id for (replyee, _) in replyees] == list(range(CONVERSATION_ID + 19, CONVERSATION_ID - 1, -1))
+    assert posted is None
+    assert len(api.calls) == 2
+
+
+def test_resolve_stops_at_posted_tweet():
+    api = FakeApi(20)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 20, CONVERSATION_ID + 19)
+
+    async def find_posted(tweet_id: int):
+        return (5, 1234, "test37") if tweet_id == CONVERSATION_ID + 15 else None
+
+    (replyees, posted) = asyncio.run(resolver.resolve(tweet, find_posted))
+
+    assert [replyee.id for (replyee, _) in replyees] == [119, 118, 117, 116]
+    assert posted == (5, 1234, "test37")
+
+
+def test_resolve_without_search_results():
+    api = FakeApi(3, searchable=False)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 2, CONVERSATION_ID + 1)
+
+    (replyees, _) = asyncio.run(resolver.resolve(tweet, never_posted))
+
+    assert [replyee.id for (replyee, _) in replyees] == [101, 100]
+    assert [call for (call, _) in api.calls] == ["search", "lookup", "lookup"]
+
+
+def test_resolve_uses_included_tweets():
+    api = FakeApi(2)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 1, CONVERSATION_ID)
+
+    # The stream includes the tweet that was replied to
+    included = [(api.tweets[CONVERSATION_ID], User(AUTHOR))]
+    (replyees, _) = asyncio.run(resolver.resolve(tweet, never_posted, included))
+
+    assert [replyee.id for (replyee, _) in replyees] == [CONVERSATION_ID]
+    assert api.calls == []
+
+
+def test_resolve_reply_to_conversation_start_is_looked_up():
+    api = FakeApi(2)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 1, CONVERSATION_ID)
+
+    (replyees, _) = asyncio.run(resolver.resolve(tweet, never_posted))
+
+    assert [replyee.id for (replyee, _) in replyees] == [CONVERSATION_ID]
+    assert api.calls == [("lookup", [CONVERSATION_ID])]
+
+
+def test_resolve_missing_tweet():
+    api = FakeApi(1)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 5, CONVERSATION_ID + 4)
+
+    with pytest.raises(NoTweetError):
+        asyncio.run(resolver.resolve(tweet, never_posted))
+
+
+def test_second_resolve_uses_cache():
+    api = FakeApi(10)
+    resolver = ThreadResolver(api)
+    tweet = make_tweet(CONVERSATION_ID + 10, CONVERSATION_ID + 9)
+    other_reply = make_tweet(CONVERSATION_ID + 11, CONVERSATION_ID + 9)
+
+    asyncio.run(resolver.resolve(tweet, never_posted))
+    (replyees, _) = asyncio.run(resolver.resolve(other_reply, never_posted))
+
+    assert len(replyees) == 10
+    assert len(api.calls) == 2
+    assert resolver.stats()["requests_saved"] == 10
+
+
+def test_tweet_cache_is_persisted(tmp_path):
+    database = Database(str(tmp_path / "tweet_cache.db"))
+    tweet = make_tweet(CONVERSATION_ID)
+    author = User(AUTHOR)
+
+    async def store_and_reload():
+        await TweetCache(database=AsyncDatabase(database)).put({tweet.id: (tweet, author)})
+        return await TweetCache(database=AsyncDatabase(database)).get(tweet.id)
+
+    (cached_tweet, cached_author) = asyncio.run(store_and_reload())
+
+    assert cached_tweet == tweet
+    assert cached_tweet.text == tweet.text
+    assert cached_author.username == "space_stew"
+
+
+def test_tweet_cache_is_pruned(tmp_path):
+    database = Database(str(tmp_path / "tweet_cache.db"))
+    database.cache_tweets([(CONVERSATION_ID, make_tweet(CONVERSATION_ID).data, AUTHOR)])
+    cache = TweetCache(ttl=0, database=AsyncDatabase(database))
+    tweet = make_tweet(CONVERSATION_ID + 1)
+
+    # The first put after the prune interval deletes the expired tweets
+    cache.pruned_at = 0
+    asyncio.run(cache.put({tweet.id: (tweet, User(AUTHOR))}))
+
+    assert database.get_cached_tweet(CONVERSATION_ID, 60) is None
+    assert cache.pruned_at > 0
+
+
+def test_tweet_media_is_cached():
+    cache = TweetCache()
+    tweet = Tweet({"id": "1", "text": "", "edit_history_tweet_ids": ["1"], "attachments": {"media_keys": ["3_1"]}})
+
+    assert cache.tweet_media(make_tweet(CONVERSATION_ID)) == []
+    assert cache.tweet_media(tweet) is None
+
+    cache.put_media([Media({"media_key": "3_1", "type": "photo", "url": "https://pbs.twimg.com/media/a.jpg"})])
+
+    assert [item.media_key for item in cache.tweet_media(tweet)] == ["3_1"]
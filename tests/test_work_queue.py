@@ -0,0 +1,127 @@
+import asyncio
+
+from hopperbot.database import AsyncDatabase, Database
+from hopperbot.config import RoutingIndex
+from hopperbot.pipeline import PostPipeline
+from hopperbot.work_queue import DurableQueue, retry_delay
+
+
+class FakePost:
+    def __init__(self, identifier: str, name: str, log: list, fail: bool = False) -> None:
+        self.identifier = identifier
+        self.name = name
+        self.log = log
+        self.fail = fail
+
+    def to_job(self):
+        return (f"fake:{self.name}", "fake", {"identifier": self.identifier, "name": self.name, "fail": self.fail})
+
+    def route_keys(self):
+        return [self.identifier]
+
+    async def post(self, blogname, api, renderers, images=None):
+        self.log.append((blogname, self.name))
+        if self.fail:
+            return {"meta": {"status": 500, "msg": "Internal Server Error"}, "errors": ["oops"]}
+        return {"id": len(self.log)}
+
+
+def make_queue(tmp_path, log: list, **params) -> DurableQueue:
+    database = AsyncDatabase(Database(str(tmp_path / "queue.db")))
+
+    def decode(payload) -> FakePost:
+        return FakePost(payload["identifier"], payload["name"], log, payload["fail"])
+
+    return DurableQueue(database, {"fake": decode}, poll_interval=0.01, **params)
+
+
+def test_retry_delay():
+    assert [retry_delay(attempts, 30, 100) for attempts in range(1, 5)] == [30, 60, 100, 100]
+
+
+def test_jobs_are_queued_once(tmp_path):
+    log = []
+    queue = make_queue(tmp_path, log)
+
+    async def put_twice():
+        return [await queue.put(FakePost("space_stew", "a", log)) for _ in range(2)]
+
+    assert asyncio.run(put_twice()) == [True, False]
+    assert queue.database.database.count_jobs() == (1, 0)
+
+
+def test_lease_and_ack(tmp_path):
+    log = []
+    queue = make_queue(tmp_path, log)
+
+    async def lease_and_ack():
+        await queue.put(FakePost("space_stew", "a", log))
+        post = await queue.get()
+        # The job is leased, so it can not be leased a second time
+        assert await queue.database.lease_job(60) is None
+        await queue.done(post)
+        return post
+
+    post = asyncio.run(lease_and_ack())
+
+    assert post.name == "a"
+    assert queue.database.database.count_jobs() == (0, 0)
+
+
+def test_leases_are_renewed(tmp_path):
+    log = []
+    queue = make_queue(tmp_path, log, lease_time=0.1)
+
+    async def lease_and_wait():
+        await queue.put(FakePost("space_stew", "a", log))
+        await queue.get()
+        renewer = asyncio.create_task(queue.renew_leases())
+        # Well past the lease time, but the post is still being worked on
+        await asyncio.sleep(0.3)
+        leased_again = await queue.database.lease_job(0.1)
+        renewer.cancel()
+        return leased_again
+
+    assert asyncio.run(lease_and_wait()) is None
+
+
+def test_jobs_survive_restart(tmp_path):
+    log = []
+    queue = make_queue(tmp_path, log)
+
+    async def lease_and_crash():
+        await queue.put(FakePost("space_stew", "a", log))
+        await queue.get()
+
+    asyncio.run(lease_and_crash())
+
+    restarted = make_queue(tmp_path, log)
+
+    async def recover():
+        released = await restarted.recover()
+        return (released, await restarted.get())
+
+    (released, post) = asyncio.run(recover())
+
+    assert released == 1
+    assert post.name == "a"
+
+
+def test_failing_job_is_buried(tmp_path):
+    log = []
+    queue = make_queue(tmp_path, log, max_attempts=3, backoff=0)
+    routes = RoutingIndex({"space_stew": "test37"})
+
+    async def run_pipeline():
+        pipeline = PostPipeline(queue, routes, None, None)
+        await queue.put(FakePost("space_stew", "good", log))
+        await queue.put(FakePost("space_stew", "bad", log, fail=True))
+        task = asyncio.create_task(pipeline.run())
+        while queue.database.database.count_jobs() != (0, 1):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run_pipeline())
+
+    assert log == [("test37", "good")] + [("test37", "bad")] * 3